@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+CRC32 benchmark.
+Compares the throughput of the gapylib CRC32 engine against the bit-by-bit loop previously used
+by the flash tools, and checks that all implementations give the same result.
+"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+# pylint: disable=wrong-import-position
+import gapylib.crc
+
+
+def compute_crc_bitwise(init: int, buff: bytes) -> int:
+    """Bit-by-bit CRC32, as it was done before the table-driven engine."""
+    crc = init
+    for data in buff:
+        crc = crc ^ data
+        for _ in range(7, -1, -1):
+            if crc & 1 == 1:
+                mask = 0xffffffff
+            else:
+                mask = 0
+            crc = (crc >> 1) ^ (0xEDB88320 & mask)
+    return crc ^ 0xffffffff
+
+
+def compute_crc_streaming(init: int, buff: bytes) -> int:
+    """Incremental CRC32, fed with 64KB chunks."""
+    crc = gapylib.crc.Crc32(init)
+    view = memoryview(buff)
+    for offset in range(0, len(view), 1 << 16):
+        crc.update(view[offset:offset + (1 << 16)])
+    return crc.digest()
+
+
+def compute_crc_blocks(init: int, buff: bytes) -> int:
+    """Per-4KB block CRC32 table, the result is the CRC of the table."""
+    crcs = gapylib.crc.compute_block_crcs(buff, init=init)
+    return gapylib.crc.compute_crc(init, b''.join(crc.to_bytes(4, 'little') for crc in crcs))
+
+
+IMPLEMENTATIONS = [
+    # Name, function, maximum size in bytes (slow implementations are limited)
+    ['bitwise (legacy)', compute_crc_bitwise, 1 << 18],
+    ['table', gapylib.crc.compute_crc_table, 1 << 21],
+    ['whole buffer', gapylib.crc.compute_crc, None],
+    ['streaming', compute_crc_streaming, None],
+    ['4KB blocks', compute_crc_blocks, None],
+]
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark the gapylib CRC32 engine')
+
+    parser.add_argument('--size', dest='size', type=lambda x: int(x, 0), default=16 << 20,
+        help='size in bytes of the buffer')
+
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3,
+        help='number of times each measure is repeated, the best one is kept')
+
+    args = parser.parse_args()
+
+    buff = os.urandom(args.size)
+
+    print(f'{"Implementation":20s} {"Size":>12s} {"MB/s":>12s}')
+
+    for name, func, max_size in IMPLEMENTATIONS:
+        size = args.size if max_size is None else min(max_size, args.size)
+        data = buff[:size]
+
+        best = None
+        for _ in range(0, args.repeat):
+            start = time.perf_counter()
+            func(0xffffffff, data)
+            duration = time.perf_counter() - start
+            if best is None or duration < best:
+                best = duration
+
+        # All implementations must give the same result as the legacy one on a common prefix
+        check_data = buff[:4096]
+        expected = compute_crc_bitwise(0xffffffff, check_data)
+        if name == '4KB blocks':
+            crc = gapylib.crc.compute_block_crcs(check_data)[0]
+        else:
+            crc = func(0xffffffff, check_data)
+        if crc != expected:
+            raise RuntimeError(f'CRC mismatch for implementation: {name}')
+
+        print(f'{name:20s} {size:12d} {size / best / (1 << 20):12.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+CStruct packing benchmark.
+Compares the time needed to generate section images with many fields, using compiled layouts
+packed into a single buffer, against the list rebuilding and concatenation previously done, and
+checks that both give the same image.
+"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import argparse
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+# pylint: disable=wrong-import-position
+from gapylib.flash import Flash, FlashSection
+from gapylib.utils import CStruct, CStructParent
+
+
+def build_table_section(nb_fields: int) -> FlashSection:
+    """Section with a single structure containing all fields, like a big table."""
+    section = FlashSection(Flash(None, 'flash', 1 << 30), 'table', 0)
+    top_struct = CStructParent('table', parent=section)
+    cstruct = CStruct('entries', top_struct)
+    for index in range(0, nb_fields):
+        cstruct.add_field(f'entry_{index}', 'I').set(index)
+    return section
+
+
+def build_headers_section(nb_fields: int) -> FlashSection:
+    """Section with many small structures, like readfs file headers."""
+    section = FlashSection(Flash(None, 'flash', 1 << 30), 'headers', 0)
+    top_struct = CStructParent('headers', parent=section)
+    for index in range(0, nb_fields // 4):
+        cstruct = CStruct(f'header_{index}', top_struct)
+        cstruct.add_field('offset', 'I').set(index * 16)
+        cstruct.add_field('size', 'I').set(index)
+        cstruct.add_field('path_size', 'I').set(12)
+        cstruct.add_field_array('path', 12).set(f'file_{index}'.encode('utf-8'))
+    return section
+
+
+def get_image_legacy(section: FlashSection, structs: dict) -> bytes:
+    """Section image generated by rebuilding the values and concatenating the packed bytes."""
+    image = bytearray()
+    for top_struct in section.structs:
+        top_image = bytearray()
+        for cstruct in top_struct.structs:
+            values = []
+            for field in cstruct.fields.values():
+                values.append(field.value)
+            top_image += structs[cstruct].pack(*values)
+        image += top_image
+
+    if len(image) < section.get_size():
+        image += bytes(section.get_size() - len(image))
+
+    return image
+
+
+def measure(func: any, repeat: int) -> (float, any):
+    """Return the best duration of several calls and the result of the last one."""
+    best = None
+    result = None
+    for _ in range(0, repeat):
+        start = time.perf_counter()
+        result = func()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best, result
+
+
+LAYOUTS = [
+    ['single structure', build_table_section],
+    ['small structures', build_headers_section],
+]
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark the gapylib CStruct packing')
+
+    parser.add_argument('--fields', dest='fields', type=int, default=50000,
+        help='number of fields of each section')
+
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+        help='number of times each measure is repeated, the best one is kept')
+
+    args = parser.parse_args()
+
+    print(f'{"Layout":20s} {"Fields":>8s} {"Build (ms)":>12s} {"Legacy (ms)":>12s} '
+        f'{"Compiled (ms)":>14s} {"Speedup":>8s}')
+
+    for name, build in LAYOUTS:
+        start = time.perf_counter()
+        section = build(args.fields)
+        build_duration = time.perf_counter() - start
+
+        structs = {}
+        for top_struct in section.structs:
+            for cstruct in top_struct.structs:
+                structs[cstruct] = struct.Struct(cstruct.format)
+
+        legacy_duration, legacy_image = measure(
+            lambda: get_image_legacy(section, structs), args.repeat)
+        compiled_duration, compiled_image = measure(section.get_image, args.repeat)
+
+        if bytes(legacy_image) != compiled_image:
+            raise RuntimeError(f'Image mismatch for layout: {name}')
+
+        print(f'{name:20s} {args.fields:8d} {build_duration * 1000:12.2f} '
+            f'{legacy_duration * 1000:12.2f} {compiled_duration * 1000:14.2f} '
+            f'{legacy_duration / compiled_duration:8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+"""
+Flash image generation benchmark.
+Builds synthetic targets with the default flash of pulp chips and various contents (readfs with
+many files, ROM with big binaries, LittleFS and raw sections filling big flashes), executes gapy
+commands on them and reports, for each command, the wall time, the peak memory and the bytes
+written, optionally to a JSON file so that results can be compared over time.
+"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import argparse
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+
+GAPY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+
+# Version of the JSON report format
+REPORT_VERSION = 1
+
+MIB = 1024 * 1024
+
+COMMANDS = ['image', 'flash_layout', 'flash_dump_sections']
+
+TARGET_MODULE = '''
+import os
+import gapylib.target
+from gapylib.chips.pulp.flash import DefaultFlashRomV2
+
+class Target(gapylib.target.Target):
+    gapy_description = "Flash benchmark target"
+
+    def __init__(self, parser, options):
+        super().__init__(parser, options)
+        self.register_flash(DefaultFlashRomV2(self, 'flash', int(os.environ['BENCH_FLASH_SIZE']),
+            flash_attributes={'littlefs_block_size': 4096}))
+'''
+
+
+def write_pattern(file_desc: any, size: int):
+    """Write non-zero content, so that it is not stored as holes."""
+    chunk = bytes(range(1, 256)) * (MIB // 255 + 1)
+    remaining = size
+    while remaining > 0:
+        file_desc.write(chunk[:min(remaining, MIB)])
+        remaining -= min(remaining, MIB)
+
+
+def write_pattern_file(path: str, size: int):
+    """Write a file with non-zero content."""
+    with open(path, 'wb') as file_desc:
+        write_pattern(file_desc, size)
+
+
+def write_elf(path: str, segment_size: int, base: int=0x1c000000, zero_size: int=0):
+    """Write a 32-bit RISC-V ELF executable with a single PT_LOAD segment.
+
+    The last zero_size bytes of the segment content are zeros.
+    """
+    header_size = 52
+    phdr_size = 32
+    data_offset = 0x1000
+
+    with open(path, 'wb') as file_desc:
+        file_desc.write(b'\x7fELF' + bytes([1, 1, 1, 0]) + bytes(8))
+        file_desc.write(struct.pack('<HHIIIIIHHHHHH', 2, 243, 1, base, header_size, 0, 0,
+            header_size, phdr_size, 1, 40, 0, 0))
+        file_desc.write(struct.pack('<IIIIIIII', 1, data_offset, base, base, segment_size,
+            segment_size, 7, 0x1000))
+        file_desc.write(bytes(data_offset - header_size - phdr_size))
+        write_pattern(file_desc, segment_size - zero_size)
+        file_desc.write(bytes(zero_size))
+
+
+def build_readfs(work_dir: str, nb_files: int, file_size: int=256) -> (int, dict):
+    """Flash with a readfs section containing many small files."""
+    files_dir = os.path.join(work_dir, 'files')
+    os.makedirs(files_dir)
+
+    files = []
+    for index in range(0, nb_files):
+        path = os.path.join(files_dir, f'file_{index}.bin')
+        with open(path, 'wb') as file_desc:
+            file_desc.write(index.to_bytes(4, 'little') * (file_size // 4))
+        files.append(path)
+
+    return 256 * MIB, {'sections': [
+        {'name': 'rom', 'template': 'rom'},
+        {'name': 'partition table', 'template': 'partition table'},
+        {'name': 'readfs', 'template': 'readfs', 'properties': {'files': files}},
+    ]}
+
+
+def build_rom(work_dir: str, segment_size: int, block_crcs: bool=False,
+        zero_size: int=0) -> (int, dict):
+    """Flash with a ROM section booting a binary with a big segment."""
+    binary = os.path.join(work_dir, 'binary.elf')
+    write_elf(binary, segment_size, zero_size=zero_size)
+
+    return max(2 * segment_size, 16 * MIB), {'sections': [
+        {'name': 'rom', 'template': 'rom',
+            'properties': {'binary': binary, 'boot': True, 'block_crcs': block_crcs,
+                'fill_segments': zero_size != 0}},
+    ]}
+
+
+def build_lfs(work_dir: str, size: int) -> (int, dict):
+    """Flash with a LittleFS section built from a directory."""
+    root_dir = os.path.join(work_dir, 'lfs')
+    os.makedirs(root_dir)
+    for index in range(0, 64):
+        write_pattern_file(os.path.join(root_dir, f'file_{index}.bin'), size // 256)
+    properties = {'size': size, 'root_dir': root_dir}
+
+    return 2 * size, {'sections': [
+        {'name': 'rom', 'template': 'rom'},
+        {'name': 'partition table', 'template': 'partition table'},
+        {'name': 'lfs', 'template': 'lfs', 'properties': properties},
+    ]}
+
+
+def build_raw(work_dir: str, flash_size: int) -> (int, dict):
+    """Flash whose space is filled by a raw section."""
+    # pylint: disable=unused-argument
+    return flash_size, {'sections': [
+        {'name': 'rom', 'template': 'rom'},
+        {'name': 'partition table', 'template': 'partition table'},
+        {'name': 'raw', 'template': 'raw', 'properties': {'size': -1}},
+    ]}
+
+
+SCENARIOS = [
+    ['readfs-10', 'readfs with 10 files', lambda work_dir: build_readfs(work_dir, 10)],
+    ['readfs-1k', 'readfs with 1000 files', lambda work_dir: build_readfs(work_dir, 1000)],
+    ['readfs-50k', 'readfs with 50000 files', lambda work_dir: build_readfs(work_dir, 50000)],
+    ['rom-1M', 'ROM with a 1 MiB segment', lambda work_dir: build_rom(work_dir, 1 * MIB)],
+    ['rom-16M', 'ROM with a 16 MiB segment', lambda work_dir: build_rom(work_dir, 16 * MIB)],
+    ['rom-64M', 'ROM with a 64 MiB segment', lambda work_dir: build_rom(work_dir, 64 * MIB)],
+    ['rom-crc-64M', 'ROM with a 64 MiB segment and block CRCs',
+        lambda work_dir: build_rom(work_dir, 64 * MIB, True)],
+    ['rom-fill-64M', 'ROM with a 64 MiB segment whose second half is zeros',
+        lambda work_dir: build_rom(work_dir, 64 * MIB, zero_size=32 * MIB)],
+    ['lfs-16M', '16 MiB LittleFS', lambda work_dir: build_lfs(work_dir, 16 * MIB)],
+    ['raw-256M', 'raw section filling a 256 MiB flash',
+        lambda work_dir: build_raw(work_dir, 256 * MIB)],
+]
+
+
+def get_dir_usage(path: str) -> (int, int):
+    """Return the size of the files of a directory and the disk space they really use."""
+    size = 0
+    disk_size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            stat = os.stat(os.path.join(root, file))
+            size += stat.st_size
+            disk_size += stat.st_blocks * 512
+    return size, disk_size
+
+
+def run_command(bench_dir: str, content_path: str, flash_size: int, command: str,
+        gapy_args: list) -> dict:
+    """Execute a gapy command in a new work directory and measure it."""
+    work_dir = tempfile.mkdtemp(dir=bench_dir, prefix=f'{command}-')
+
+    cmd = [sys.executable, os.path.join(GAPY_DIR, 'gapy'), '--platform=gvsoc',
+        f'--target-dir={bench_dir}', '--target=bench_target', f'--work-dir={work_dir}',
+        f'--flash-content={content_path}@flash', '--flash-no-incremental'] + gapy_args + \
+        [command]
+
+    env = dict(os.environ, BENCH_FLASH_SIZE=str(flash_size))
+    # The command must be executed by this process, not by a gapy server
+    env.pop('GAPY_SERVER', None)
+
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        with subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=stderr) as proc:
+            # Wait for this process only, to get its own resource usage
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+        duration = time.perf_counter() - start
+
+        if proc.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f'Command failed: {" ".join(cmd)}\n'
+                f'{stderr.read().decode("utf-8")}')
+
+    size, disk_size = get_dir_usage(work_dir)
+    shutil.rmtree(work_dir)
+
+    # Linux reports the peak RSS in KiB and macOS in bytes
+    peak_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+    return {
+        'wall_time': round(duration, 6),
+        'user_time': round(usage.ru_utime, 6),
+        'system_time': round(usage.ru_stime, 6),
+        'peak_rss': peak_rss,
+        'bytes_written': size,
+        'disk_bytes': disk_size,
+    }
+
+
+def run_scenario(name: str, build: any, commands: list, repeat: int, gapy_args: list,
+        keep: bool) -> list:
+    """Build the inputs of a scenario and measure each command, the fastest run is kept."""
+    bench_dir = tempfile.mkdtemp(prefix=f'gapy-bench-{name}-')
+
+    try:
+        with open(os.path.join(bench_dir, 'bench_target.py'), 'w', encoding='utf-8') as file:
+            file.write(TARGET_MODULE)
+
+        flash_size, content = build(bench_dir)
+        content_path = os.path.join(bench_dir, 'content.json')
+        with open(content_path, 'w', encoding='utf-8') as file:
+            json.dump(content, file)
+
+        results = []
+        for command in commands:
+            best = None
+            for _ in range(0, repeat):
+                result = run_command(bench_dir, content_path, flash_size, command, gapy_args)
+                if best is None or result['wall_time'] < best['wall_time']:
+                    best = result
+
+            results.append(dict({'scenario': name, 'command': command,
+                'flash_size': flash_size}, **best))
+
+        return results
+
+    finally:
+        if keep:
+            print(f'Inputs of scenario {name} kept in {bench_dir}', file=sys.stderr)
+        else:
+            shutil.rmtree(bench_dir)
+
+
+def get_commit() -> str:
+    """Return the commit of the sources being measured, if they are in a git repository."""
+    try:
+        proc = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=GAPY_DIR, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return proc.stdout.decode('utf-8').strip()
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark the gapy flash image generation')
+
+    parser.add_argument('--scenario', dest='scenarios', action='append', default=[],
+        help='scenario to be executed, can be a glob pattern and be given several times '
+            '(default: all)')
+
+    parser.add_argument('--command', dest='commands', action='append', default=[],
+        choices=COMMANDS, help='gapy command to be measured (default: all)')
+
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1,
+        help='number of times each command is executed, the fastest run is kept')
+
+    parser.add_argument('--gapy-arg', dest='gapy_args', action='append', default=[],
+        help='additional gapy argument, like --gapy-arg=--jobs=4')
+
+    parser.add_argument('--output', dest='output', default=None,
+        help='JSON file where results are written')
+
+    parser.add_argument('--keep', dest='keep', action='store_true',
+        help='keep the generated inputs')
+
+    parser.add_argument('--list', dest='list', action='store_true',
+        help='list the scenarios')
+
+    args = parser.parse_args()
+
+    if args.list:
+        for name, description, _ in SCENARIOS:
+            print(f'{name:12s} {description}')
+        return
+
+    patterns = args.scenarios if len(args.scenarios) > 0 else ['*']
+    commands = args.commands if len(args.commands) > 0 else COMMANDS
+
+    print(f'{"Scenario":12s} {"Command":20s} {"Wall (s)":>9s} {"CPU (s)":>9s} '
+        f'{"Peak RSS (MiB)":>15s} {"Written (MiB)":>14s} {"Disk (MiB)":>11s}')
+
+    results = []
+    for name, _, build in SCENARIOS:
+        if not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            continue
+
+        for result in run_scenario(name, build, commands, args.repeat, args.gapy_args,
+                args.keep):
+            results.append(result)
+            print(f'{name:12s} {result["command"]:20s} {result["wall_time"]:9.3f} '
+                f'{result["user_time"] + result["system_time"]:9.3f} '
+                f'{result["peak_rss"] / MIB:15.1f} {result["bytes_written"] / MIB:14.2f} '
+                f'{result["disk_bytes"] / MIB:11.2f}', flush=True)
+
+    if args.output is not None:
+        report = {
+            'version': REPORT_VERSION,
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'gapy_args': args.gapy_args,
+            'results': results,
+        }
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+"""Provides the execution of a manifest of gapy jobs from a single gapy process"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+#
+# A batch manifest is a JSON file of this form, where everything is optional except the list of
+# jobs:
+#
+# {
+#     "args": ["--flash-property=..."],
+#     "commands": ["image"],
+#     "jobs": [
+#         {
+#             "name": "test0",
+#             "binary": "test0/test.elf",
+#             "properties": ["name=value"],
+#             "args": ["--flash-property=..."],
+#             "work_dir": "build/test0",
+#             "commands": ["image", "flash_layout"]
+#         }
+#     ]
+# }
+#
+# Each job is executed with the options of the gapy command line, then the common arguments of
+# the manifest, then its own arguments. Relative paths are relative to the current directory,
+# like on the command line.
+#
+
+
+import json
+import os
+import sys
+import time
+
+import gapylib.target
+
+
+# Commands executed by jobs which do not specify any
+DEFAULT_COMMANDS = ['image']
+
+# Name of the file, in the job work directory, receiving the job output
+LOG_FILE = 'gapy.log'
+
+
+class BatchJob():
+    """
+    Gapy job of a batch manifest.
+
+    Attributes
+    ----------
+    name : str
+        Name of the job.
+    argv : list
+        Gapy command-line arguments of the job, without the executable name.
+    work_dir : str
+        Work directory of the job.
+    """
+
+    def __init__(self, name: str, argv: list, work_dir: str):
+        self.name = name
+        self.argv = argv
+        self.work_dir = work_dir
+        self.log = os.path.join(work_dir, LOG_FILE)
+        self.start = None
+
+
+    def get_result(self, status: int) -> dict:
+        """Return the result of the job, as reported in the batch output.
+
+        Parameters
+        ----------
+        status : int
+            The exit status of the job.
+
+        Returns
+        -------
+        dict
+            The result.
+        """
+        outputs = []
+        for root, _, files in os.walk(self.work_dir):
+            for file in files:
+                path = os.path.join(root, file)
+                if path != self.log:
+                    outputs.append(path)
+
+        return {
+            'name': self.name,
+            'status': status,
+            'time': round(time.perf_counter() - self.start, 6),
+            'work_dir': self.work_dir,
+            'log': self.log,
+            'outputs': sorted(outputs)
+        }
+
+
+def get_jobs(manifest_path: str, base_argv: list, work_dir: str) -> list:
+    """Return the jobs of a batch manifest.
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path of the manifest.
+    base_argv : list
+        Arguments given to all jobs.
+    work_dir : str
+        Directory where jobs which do not specify their work directory get one.
+
+    Returns
+    -------
+    list
+        The jobs.
+    """
+    try:
+        with open(manifest_path, 'rb') as file_desc:
+            manifest = json.load(file_desc)
+    except OSError as exc:
+        raise RuntimeError(f'Unable to open batch manifest: {exc}') from exc
+    except ValueError as exc:
+        raise RuntimeError(f'Invalid batch manifest {manifest_path}: {exc}') from exc
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('jobs'), list):
+        raise RuntimeError(f'Invalid batch manifest {manifest_path}: it must contain a list '
+            'of jobs')
+
+    common_args = _get_list(manifest, 'args', [], manifest_path)
+    common_commands = _get_list(manifest, 'commands', DEFAULT_COMMANDS, manifest_path)
+
+    result = []
+    names = set()
+    for index, job in enumerate(manifest['jobs']):
+        if not isinstance(job, dict):
+            raise RuntimeError(f'Invalid batch manifest {manifest_path}: job {index} must be '
+                'an object')
+
+        name = str(job.get('name', f'job{index}'))
+        if name in names:
+            raise RuntimeError(f'Invalid batch manifest {manifest_path}: job name {name} is '
+                'used several times')
+        names.add(name)
+
+        argv = base_argv + common_args
+
+        if job.get('binary') is not None:
+            argv.append(f'--binary={job["binary"]}')
+
+        for prop in _get_list(job, 'properties', [], manifest_path):
+            argv.append(f'--target-property={prop}')
+
+        argv += _get_list(job, 'args', [], manifest_path)
+
+        job_work_dir = os.path.abspath(job.get('work_dir', os.path.join(work_dir, name)))
+        argv.append(f'--work-dir={job_work_dir}')
+
+        argv += _get_list(job, 'commands', common_commands, manifest_path)
+
+        result.append(BatchJob(name, argv, job_work_dir))
+
+    return result
+
+
+def _get_list(desc: dict, name: str, default: list, manifest_path: str) -> list:
+    value = desc.get(name, default)
+    if not isinstance(value, list):
+        raise RuntimeError(f'Invalid batch manifest {manifest_path}: {name} must be a list')
+    return [str(item) for item in value]
+
+
+def run_batch(manifest_path: str, base_argv: list, target: str, work_dir: str,
+        nb_workers: int) -> int:
+    """Execute the jobs of a batch manifest.
+
+    The target is imported once, then each job is executed in a process forked from this one,
+    with its own target instance, work directory and flash contents, going through the same
+    flow as a gapy command. The result of each job is printed as a JSON line on the standard
+    output as soon as it is finished, while the job output goes to a log file in its work
+    directory.
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path of the manifest.
+    base_argv : list
+        Arguments given to all jobs, usually the gapy command-line options.
+    target : str
+        Name of the target, or None.
+    work_dir : str
+        Directory where jobs which do not specify their work directory get one.
+    nb_workers : int
+        Maximum number of jobs executed concurrently.
+
+    Returns
+    -------
+    int
+        The exit status, 0 if all jobs succeeded.
+    """
+    jobs = get_jobs(manifest_path, base_argv, work_dir)
+
+    # Import the target now so that jobs do not need to
+    if target is not None:
+        gapylib.target.get_target(target.split(':')[0])
+
+    pending = list(reversed(jobs))
+    running = {}
+    status = 0
+
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < max(nb_workers, 1):
+            job = pending.pop()
+            running[_start_job(job)] = job
+
+        pid, wait_status = os.wait()
+        job = running.pop(pid, None)
+        if job is None:
+            continue
+
+        job_status = os.waitstatus_to_exitcode(wait_status)
+        if job_status != 0:
+            status = 1
+
+        print(json.dumps(job.get_result(job_status)), flush=True)
+
+    return status
+
+
+def _start_job(job: BatchJob) -> int:
+    # Flush what is pending so that it is not output again by the job
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    job.start = time.perf_counter()
+
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    status = 1
+    try:
+        os.makedirs(job.work_dir, exist_ok=True)
+
+        log_fd = os.open(job.log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        null_fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null_fd, 0)
+        os.dup2(log_fd, 1)
+        os.dup2(log_fd, 2)
+        os.close(null_fd)
+        os.close(log_fd)
+
+        # pylint: disable=import-outside-toplevel
+        import gapylib.cli
+        status = gapylib.cli.execute([sys.argv[0]] + job.argv)
+
+    except OSError as exc:
+        print(f'Unable to start job {job.name}: {exc}', file=sys.stderr)
+
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except (OSError, ValueError):
+            pass
+
+        # pylint: disable=protected-access
+        os._exit(status & 0xff)
@@ -0,0 +1,61 @@
+"""Provides the location of the persistent gapy caches"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import logging
+import os
+
+
+def get_cache_dir(name: str=None) -> str:
+    """Return the directory where gapy keeps persistent data between executions.
+
+    The directory is given by the GAPY_CACHE_DIR environment variable, or is the gapy
+    directory of the user cache directory. It is created if it does not exist.
+
+    Parameters
+    ----------
+    name : str
+        Name of a sub-directory to be returned instead of the main directory.
+
+    Returns
+    -------
+    str
+        The directory path, or None if it can not be created, in which case nothing should be
+        cached.
+    """
+    path = os.environ.get('GAPY_CACHE_DIR')
+    if path is None:
+        cache_home = os.environ.get('XDG_CACHE_HOME')
+        if cache_home is None:
+            cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+        path = os.path.join(cache_home, 'gapy')
+
+    if name is not None:
+        path = os.path.join(path, name)
+
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError as exc:
+        logging.debug('Unable to create cache directory %s: %s', path, exc)
+        return None
+
+    return path
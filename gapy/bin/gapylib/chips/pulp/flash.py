@@ -21,16 +21,50 @@
 #
 
 
+import copy
+import functools
 import json
+import os
 from collections import OrderedDict
 from gapylib.target import Target
 from gapylib.flash import Flash
-from gapylib.fs.littlefs import LfsSection
-from gapylib.fs.readfs import ReadfsSection
-from gapylib.fs.hostfs import HostfsSection
-from gapylib.fs.raw import RawSection
-from gapylib.chips.pulp.rom_v2 import RomFlashSection
-from gapylib.fs.partition import PartitionTableSection
+
+
+# Default layout of the flash, relative to the python path
+DEFAULT_CONTENT_FILE = 'gapylib/chips/pulp/default_flash_content.json'
+
+
+def load_default_flash_content() -> OrderedDict:
+    """Return the default layout of the flash.
+
+    The file is only parsed again when it is modified, which matters for processes executing
+    several gapy commands, like the gapy server.
+
+    Returns
+    -------
+    OrderedDict
+        The flash content, which can be modified by the caller.
+    """
+    content_path = Target.get_file_path(DEFAULT_CONTENT_FILE)
+
+    if content_path is None:
+        raise RuntimeError('Could not find flash property file: ' + DEFAULT_CONTENT_FILE)
+
+    try:
+        stat = os.stat(content_path)
+        content = _parse_flash_content(content_path, stat.st_mtime_ns, stat.st_size)
+    except OSError as exc:
+        raise RuntimeError('Unable to open flash content file: ' + str(exc)) from exc
+
+    return copy.deepcopy(content)
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_flash_content(path: str, mtime_ns: int, size: int) -> OrderedDict:
+    # The modification time and size are only there to invalidate the cache
+    # pylint: disable=unused-argument
+    with open(path, 'rb') as file_desc:
+        return json.load(file_desc, object_pairs_hook=OrderedDict)
 
 
 class DefaultFlashRomV2(Flash):
@@ -51,23 +85,14 @@ class DefaultFlashRomV2(Flash):
     def __init__(self, target: Target, name: str, size: int, *kargs, **kwargs):
         super().__init__(target, name, size, *kargs, **kwargs)
 
-        # Declare all the available flash section
-        self.register_section_template('rom', RomFlashSection)
-        self.register_section_template('partition table', PartitionTableSection)
-        self.register_section_template('readfs', ReadfsSection)
-        self.register_section_template('hostfs', HostfsSection)
-        self.register_section_template('lfs', LfsSection)
-        self.register_section_template('raw', RawSection)
+        # Declare all the available flash section. They are only imported if they are used.
+        self.register_section_template('rom', 'gapylib.chips.pulp.rom_v2:RomFlashSection')
+        self.register_section_template('partition table',
+            'gapylib.fs.partition:PartitionTableSection')
+        self.register_section_template('readfs', 'gapylib.fs.readfs:ReadfsSection')
+        self.register_section_template('hostfs', 'gapylib.fs.hostfs:HostfsSection')
+        self.register_section_template('lfs', 'gapylib.fs.littlefs:LfsSection')
+        self.register_section_template('raw', 'gapylib.fs.raw:RawSection')
 
         # And give the default layout
-        content_file = 'gapylib/chips/pulp/default_flash_content.json'
-        content_path = target.get_file_path(content_file)
-
-        if content_path is None:
-            raise RuntimeError('Could not find flash property file: ' + content_file)
-
-        try:
-            with open(content_path, 'rb') as file_desc:
-                self.set_content(json.load(file_desc, object_pairs_hook=OrderedDict))
-        except OSError as exc:
-            raise RuntimeError('Unable to open flash content file: ' + str(exc)) from exc
+        self.set_content(load_default_flash_content())
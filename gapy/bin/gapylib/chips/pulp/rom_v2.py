@@ -21,11 +21,35 @@
 #
 
 
+import contextlib
+import mmap
+import re
+import struct
 import typing
 import dataclasses
-from elftools.elf.elffile import ELFFile
 from gapylib.flash import FlashSection, Flash
 from gapylib.utils import CStruct, CStructParent
+from gapylib.crc import Crc32, BlockCrc32, CRC32_BLOCK_SIZE, CRC32_INIT
+import gapylib.elf
+import gapylib.trace
+
+
+# ROM header flag telling the block CRC tables follow the segment headers
+ROM_FLAG_BLOCK_CRCS = 1 << 0
+# ROM header flag telling segments can be fill segments
+ROM_FLAG_FILL_SEGMENTS = 1 << 1
+
+# Flash offset of fill segments, whose memory is filled with zeros instead of being loaded
+ROM_FILL_SEGMENT_OFFSET = 0xffffffff
+
+# Default minimum size of the runs of zeros turned into fill segments
+ROM_FILL_MIN_SIZE = 1024
+
+# Size of a segment header, runs of zeros smaller than this are not worth a fill segment
+ROM_SEGMENT_HEADER_SIZE = 16
+
+_NON_ZERO = re.compile(rb'[^\x00]')
+_ZERO_CHUNK = bytes(1 << 16)
 
 
 
@@ -34,6 +58,10 @@ class BinarySegment():
     """
     Class for describing an ELF segment.
 
+    The content is made of extents, which can either be given directly or as ranges of the ELF
+    file, in which case they are only read when needed. Fill segments have no content, the ROM
+    fills them with zeros.
+
     Attributes
     ----------
     base : int
@@ -41,28 +69,266 @@ class BinarySegment():
 
     data : bytes
         Content of the section
+
+    path : str
+        Path of the ELF file containing the segment content, if data is not given.
+
+    file_offset : int
+        Offset of the segment content in the ELF file.
+
+    size : int
+        Size of the segment content in the ELF file, if data is not given.
+
+    mem_size : int
+        Size of the segment in memory, which is bigger than its content when it ends with BSS.
+
+    fill : bool
+        True if the segment must be filled with zeros instead of being loaded from flash.
     """
-    def __init__(self, base: int, data: bytes):
+    def __init__(self, base: int, data: bytes=None, path: str=None, file_offset: int=0,
+            size: int=None, mem_size: int=None, fill: bool=False):
         self.base = base
-        self.data = data
-        self.size = len(data)
-        self.crc = self._compute_crc()
+        self.fill = fill
+        # Extents of the content, as [data, path, file_offset, size] lists
+        self.extents = []
+        self.size = 0
+        self.__data = None
+        self.__crc = None
+
+        size = len(data) if data is not None else size
+        if fill:
+            self.size = size
+        else:
+            self.add_extent(data, path, file_offset, size)
+
+        self.mem_size = mem_size if mem_size is not None else self.size
+
+    @property
+    def data(self) -> bytes:
+        """Content of the segment."""
+        if self.__data is None:
+            self.__data = b''.join(bytes(chunk) for chunk in self.__iter_chunks())
+
+        return self.__data
+
+    @property
+    def crc(self) -> int:
+        """CRC32 of the segment content."""
+        if self.__crc is None:
+            self.__crc = self._compute_crc()
+
+        return self.__crc
+
+    def get_content_size(self) -> int:
+        """Return the size of the segment content stored in flash.
+
+        Returns
+        -------
+        int
+            The content size, which is 0 for fill segments.
+        """
+        return 0 if self.fill else self.size
+
+    def add_extent(self, data: bytes=None, path: str=None, file_offset: int=0, size: int=None):
+        """Append content to the segment.
+
+        Parameters
+        ----------
+        data : bytes
+            Content, if it is given directly.
+        path : str
+            Path of the ELF file containing the content, if data is not given.
+        file_offset : int
+            Offset of the content in the ELF file.
+        size : int
+            Size of the content in the ELF file, if data is not given.
+        """
+        size = len(data) if data is not None else size
+
+        # Contiguous contents are merged so that they are written at once
+        last = self.extents[-1] if len(self.extents) != 0 else None
+        if last is not None and data is not None and last[0] is not None:
+            last[0] += data
+            last[3] += size
+        elif last is not None and path is not None and last[1] == path and \
+                last[2] + last[3] == file_offset:
+            last[3] += size
+        else:
+            self.extents.append([data, path, file_offset, size])
+
+        self.size += size
+        self.mem_size = self.size
+        self.__data = None
+        self.__crc = None
+
+    def append(self, segment: 'BinarySegment'):
+        """Append the content of a segment starting where this one ends.
+
+        Parameters
+        ----------
+        segment : BinarySegment
+            The segment, whose zeros are explicitly stored if it is a fill segment.
+        """
+        if segment.fill:
+            self.add_extent(bytes(segment.size))
+        else:
+            for data, path, file_offset, size in segment.extents:
+                self.add_extent(data, path, file_offset, size)
+
+    def split_zero_runs(self, min_size: int) -> list:
+        """Split the segment around the runs of zeros found in its content.
+
+        Parameters
+        ----------
+        min_size : int
+            Minimum size of the runs of zeros which are turned into fill segments.
+
+        Returns
+        -------
+        list
+            The segments covering the content, where the runs of zeros are fill segments.
+        """
+        result = []
+        offset = 0
+        for extent in self.extents:
+            with _map_extent(extent) as (buff, start):
+                end = start + extent[3]
+                pos = start
+                zeros = bytes(min_size)
+                while True:
+                    # The buffer is searched in place, without being copied, since it may be the
+                    # whole mapped ELF file
+                    index = buff.find(zeros, pos, end)
+                    if index == -1:
+                        break
+                    run_end = _find_non_zero(buff, index + min_size, end)
+
+                    if index > pos:
+                        result.append(self.__get_range(extent, offset, pos - start, index - pos))
+                    result.append(BinarySegment(self.base + offset + index - start,
+                        size=run_end - index, fill=True))
+                    pos = run_end
+
+                if pos < end:
+                    result.append(self.__get_range(extent, offset, pos - start, end - pos))
+
+            offset += extent[3]
+
+        return result
 
     def _compute_crc(self):
         """
         Compute the CRC32 for an ELF segment.
         """
-        crc = 0xffffffff
-        for data in self.data:
-            crc = crc ^ data
-            for _ in range(7, -1, -1):
-                if crc & 1 == 1:
-                    mask = 0xffffffff
-                else:
-                    mask = 0
-                crc = (crc >> 1) ^ (0xEDB88320 & mask)
+        crc = Crc32(CRC32_INIT)
+        for chunk in self.__iter_chunks():
+            crc.update(chunk)
+        return crc.digest()
+
+    def get_block_crcs(self, block_size: int=CRC32_BLOCK_SIZE) -> list:
+        """Compute the CRC32 of each block of the segment content.
 
-        return crc ^ 0xffffffff
+        Parameters
+        ----------
+        block_size : int
+            Size of the blocks. The last block can be smaller.
+
+        Returns
+        -------
+        list
+            The CRC of each block.
+        """
+        # The segment CRC is computed at the same time so that the content is only mapped once
+        crc = Crc32(CRC32_INIT)
+        block_crcs = BlockCrc32(block_size, CRC32_INIT)
+        for chunk in self.__iter_chunks():
+            crc.update(chunk)
+            block_crcs.update(chunk)
+
+        self.__crc = crc.digest()
+        return block_crcs.digest()
+
+    def __get_range(self, extent: list, extent_base: int, offset: int, size: int) \
+            -> 'BinarySegment':
+        data, path, file_offset, __ = extent
+        base = self.base + extent_base + offset
+        if data is not None:
+            return BinarySegment(base, data=data[offset:offset + size])
+        return BinarySegment(base, path=path, file_offset=file_offset + offset, size=size)
+
+    def __iter_chunks(self) -> typing.Iterator[memoryview]:
+        # Contents kept in the ELF file are mapped instead of read, so that big segments are
+        # never copied into python buffers
+        if self.__data is not None:
+            yield memoryview(self.__data)
+            return
+
+        for extent in self.extents:
+            with _map_extent(extent) as (buff, start), memoryview(buff) as view, \
+                    view[start:start + extent[3]] as chunk:
+                yield chunk
+
+
+
+@contextlib.contextmanager
+def _map_extent(extent: list) -> typing.Iterator[tuple]:
+    # Give the buffer containing an extent and the offset of the extent in it
+    data, path, file_offset, size = extent
+    if data is not None or size == 0:
+        yield (data if data is not None else b''), 0
+        return
+
+    with contextlib.ExitStack() as stack:
+        try:
+            file_desc = stack.enter_context(open(path, 'rb'))
+            image = stack.enter_context(
+                mmap.mmap(file_desc.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError) as exc:
+            raise RuntimeError(f'Unable to read binary {path}: {exc}') from exc
+
+        if file_offset + size > len(image):
+            raise RuntimeError(f'Binary {path} is too small to contain segment '
+                f'0x{file_offset:x}-0x{file_offset + size:x}')
+
+        yield image, file_offset
+
+
+
+def _find_non_zero(buff: bytes, pos: int, end: int) -> int:
+    # Whole chunks are compared first, which is much faster than searching byte per byte
+    while pos + len(_ZERO_CHUNK) <= end and buff[pos:pos + len(_ZERO_CHUNK)] == _ZERO_CHUNK:
+        pos += len(_ZERO_CHUNK)
+
+    non_zero = _NON_ZERO.search(buff, pos, end)
+    return non_zero.start() if non_zero is not None else end
+
+
+
+def _merge_segments(segments: list, min_fill_size: int) -> list:
+    # Merge the segments which are contiguous in memory, small fill segments are turned into
+    # explicit zeros when they are next to a segment with content, since a segment header is
+    # not worth it
+    result = []
+    for segment in segments:
+        if segment.size == 0:
+            continue
+
+        last = result[-1] if len(result) != 0 else None
+        if last is None or last.base + last.size != segment.base:
+            result.append(segment)
+        elif last.fill and segment.fill:
+            last.size += segment.size
+            last.mem_size = last.size
+        elif not last.fill and (not segment.fill or segment.size < min_fill_size):
+            last.append(segment)
+        elif last.fill and not segment.fill and last.size < min_fill_size:
+            merged = BinarySegment(last.base, data=bytes(last.size))
+            merged.append(segment)
+            result[-1] = merged
+        else:
+            result.append(segment)
+
+    return result
 
 
 
@@ -82,13 +348,75 @@ class Binary():
 
         # Go through the ELF binary to find the entry point and the segments
         self.segments = []
+        self.entry = None
+
+        # When the binary is a real file, segment contents are not extracted, they are kept as
+        # ranges of the ELF file which are copied to the flash image when it is written
+        path = getattr(file_desc, 'name', None)
+        if not isinstance(path, str):
+            path = None
+
+        # Only the ELF and program headers are needed, pyelftools is only used for the ELF files
+        # that the minimal reader does not support
+        with gapylib.elf.open_elf(file_desc) as elffile:
+            if elffile is not None:
+                self.__parse(elffile, path)
+                return
+
+        self.__parse_elftools(file_desc, path)
+
+    def __parse(self, elffile: gapylib.elf.ElfFile, path: str):
+        self.entry = elffile.entry
+
+        for segment in elffile.get_load_segments():
+            if path is not None:
+                self.segments.append(BinarySegment(segment.paddr, path=path,
+                    file_offset=segment.offset, size=segment.filesz, mem_size=segment.memsz))
+            else:
+                with elffile.get_segment_data(segment) as data:
+                    self.segments.append(BinarySegment(segment.paddr, bytes(data),
+                        mem_size=segment.memsz))
+
+    def __parse_elftools(self, file_desc: typing.BinaryIO, path: str):
+        from elftools.elf.elffile import ELFFile # pylint: disable=import-outside-toplevel
 
         elffile = ELFFile(file_desc)
         self.entry = elffile['e_entry']
 
         for segment in elffile.iter_segments():
             if segment['p_type'] == 'PT_LOAD':
-                self.segments.append(BinarySegment(segment['p_paddr'], segment.data()))
+                if path is not None:
+                    self.segments.append(BinarySegment(segment['p_paddr'], path=path,
+                        file_offset=segment['p_offset'], size=segment['p_filesz'],
+                        mem_size=segment['p_memsz']))
+                else:
+                    self.segments.append(BinarySegment(segment['p_paddr'], segment.data(),
+                        mem_size=segment['p_memsz']))
+
+    def get_fill_segments(self, min_fill_size: int=ROM_FILL_MIN_SIZE) -> list:
+        """Return the segments to be loaded, with fill segments for the zeros.
+
+        The runs of zeros of the segment contents and the BSS at the end of the segments are
+        described by fill segments, and the segments which are contiguous in memory are merged.
+
+        Parameters
+        ----------
+        min_fill_size : int
+            Minimum size of the runs of zeros which are turned into fill segments.
+
+        Returns
+        -------
+        list
+            The segments.
+        """
+        segments = []
+        for segment in self.segments:
+            segments += segment.split_zero_runs(min_fill_size)
+            if segment.mem_size > segment.size:
+                segments.append(BinarySegment(segment.base + segment.size,
+                    size=segment.mem_size - segment.size, fill=True))
+
+        return _merge_segments(segments, min_fill_size)
 
 
 
@@ -139,8 +467,8 @@ class RomHeader(CStruct):
         self.add_field('nb_segments', 'I')
         # Binary entry point
         self.add_field('entry', 'I')
-        # Unused
-        self.add_field('unused', 'I')
+        # Flags (ROM_FLAG_*) describing the optional header extensions
+        self.add_field('flags', 'I')
 
 
 
@@ -168,11 +496,64 @@ class RomSegmentHeader(CStruct):
         self.add_field('mem_addr', 'I')
         # Size of the segment
         self.add_field('size', 'I')
-        # Unused
+        # Number of blocks of the segment, CRC32_BLOCK_SIZE bytes each
         self.add_field('crc', 'I')
 
 
 
+@dataclasses.dataclass
+class RomBlockCrcHeader(CStruct):
+    """
+    Class for generating rom sub-section containing the header of the block CRC tables.
+
+    It is followed by one RomSegmentCrcs per segment, in the same order as the segment headers.
+
+    Attributes
+    ----------
+    name : str
+        Name of this sub-section.
+
+    parent : str
+        Parent, which is aggregating all rom sub-sections.
+    """
+
+    def __init__(self, name, parent: CStructParent):
+        super().__init__(name, parent)
+
+        # Size of the blocks covered by each CRC
+        self.add_field('block_size', 'I')
+        # Total number of block CRCs of all segments
+        self.add_field('nb_blocks', 'I')
+
+
+
+@dataclasses.dataclass
+class RomSegmentCrcs(CStruct):
+    """
+    Class for generating rom sub-section containing the CRC table of a segment.
+
+    Attributes
+    ----------
+    name : str
+        Name of this sub-section.
+
+    nb_blocks : int
+        Number of blocks of the segment.
+
+    parent : str
+        Parent, which is aggregating all rom sub-sections.
+    """
+
+    def __init__(self, name, nb_blocks: int, parent: CStructParent):
+        super().__init__(name, parent)
+
+        # CRC32 of the whole segment
+        self.add_field('crc', 'I')
+        # CRC32 of each block of the segment, the last one covers only the end of the segment
+        self.add_field_array('block_crcs', nb_blocks * 4)
+
+
+
 @dataclasses.dataclass
 class RomSegment(CStruct):
     """
@@ -191,7 +572,7 @@ class RomSegment(CStruct):
         super().__init__(name, parent)
 
         # Segment content
-        self.add_field_array('data', size)
+        self.add_field_extent_array('data', size)
 
 
 
@@ -213,10 +594,13 @@ class RomFlashSection(FlashSection):
         super().__init__(parent, name, section_id)
 
         self.segment_headers = []
+        self.segment_crcs = []
         self.segments = []
         self.binary = None
+        self.binary_segments = None
         self.top_struct = None
         self.header = None
+        self.crc_header = None
         self.boot = False
 
         self.declare_property(name='binary', value=None,
@@ -227,6 +611,22 @@ class RomFlashSection(FlashSection):
             description="True if the ROM will boot using this ROM section."
         )
 
+        self.declare_property(name='block_crcs', value=False,
+            description="Add a table with the CRC32 of each segment and of each of its "
+                "blocks, so that corrupted or modified blocks can be found without comparing "
+                "whole segments."
+        )
+
+        self.declare_property(name='fill_segments', value=False,
+            description="Describe the runs of zeros and the BSS of the binary with fill "
+                "segments, which the ROM fills with zeros instead of loading them from flash, "
+                "and merge the segments which are contiguous in memory."
+        )
+
+        self.declare_property(name='fill_min_size', value=ROM_FILL_MIN_SIZE,
+            description="Minimum size of the runs of zeros which are turned into fill segments."
+        )
+
     def set_content(self, offset: int, content_dict: dict):
         """Set the content of the section.
 
@@ -254,39 +654,80 @@ class RomFlashSection(FlashSection):
             # Main header
             self.header = RomHeader('ROM header', parent=self.top_struct)
 
-            binary_segments = self.binary.segments
+            fill_segments = self.get_property('fill_segments')
+            if fill_segments:
+                fill_min_size = self.get_property('fill_min_size')
+                if isinstance(fill_min_size, str):
+                    fill_min_size = int(fill_min_size, 0)
+                if fill_min_size < ROM_SEGMENT_HEADER_SIZE:
+                    raise RuntimeError(f'Invalid fill_min_size {fill_min_size} for section '
+                        f'{self.get_name()}, it must be at least {ROM_SEGMENT_HEADER_SIZE} bytes')
+                with gapylib.trace.span('rom fill segments'):
+                    binary_segments = self.binary.get_fill_segments(fill_min_size)
+            else:
+                binary_segments = self.binary.segments
+            self.binary_segments = binary_segments
 
             # One header per binary segment for describing it (size, etc)
             for __ in binary_segments:
                 segment = RomSegmentHeader('Binary segment header', parent=self.top_struct)
                 self.segment_headers.append(segment)
 
-            # One header per binary segment
+            # The CRC tables come after the segment headers so that the headers keep the same
+            # layout
+            block_crcs = self.get_property('block_crcs')
+            if block_crcs:
+                self.crc_header = RomBlockCrcHeader('Block CRC header', parent=self.top_struct)
+                for binary_segment in binary_segments:
+                    self.segment_crcs.append(RomSegmentCrcs('Segment CRCs',
+                        _get_nb_blocks(binary_segment.get_content_size()),
+                        parent=self.top_struct))
+
+            # One content per binary segment, except for fill segments which have none
             for binary_segment in binary_segments:
-                segment = RomSegment('Binary segment', binary_segment.size, parent=self.top_struct)
+                segment = None
+                if not binary_segment.fill:
+                    segment = RomSegment('Binary segment', binary_segment.size,
+                        parent=self.top_struct)
                 self.segments.append(segment)
 
             # Now that the offsets have been computed, we can fill-in the various fields
 
             # Main header
             self.header.set_field('rom_header_size', self.get_size())
-            self.header.set_field('nb_segments', len(self.binary.segments))
+            self.header.set_field('nb_segments', len(binary_segments))
             self.header.set_field('entry', self.binary.entry)
+            self.header.set_field('flags', (ROM_FLAG_BLOCK_CRCS if block_crcs else 0) |
+                (ROM_FLAG_FILL_SEGMENTS if fill_segments else 0))
+
+            if block_crcs:
+                self.crc_header.set_field('block_size', CRC32_BLOCK_SIZE)
+                self.crc_header.set_field('nb_blocks', sum(
+                    _get_nb_blocks(segment.get_content_size()) for segment in binary_segments))
 
             for i, binary_segment in enumerate(binary_segments):
                 segment_header = self.segment_headers[i]
                 segment = self.segments[i]
 
                 # Per-segment header
-                segment_header.set_field('flash_offset', segment.get_field('data').get_offset())
+                if segment is None:
+                    segment_header.set_field('flash_offset', ROM_FILL_SEGMENT_OFFSET)
+                else:
+                    segment_header.set_field('flash_offset',
+                        segment.get_field('data').get_offset())
                 segment_header.set_field('mem_addr', binary_segment.base)
                 segment_header.set_field('size', binary_segment.size)
-                block_size = 4096
-                nb_blocks = int((binary_segment.size + block_size - 1) / block_size)
-                segment_header.set_field('crc', nb_blocks)
+                segment_header.set_field('crc',
+                    _get_nb_blocks(binary_segment.get_content_size()))
 
                 # Per segment content
-                segment.set_field('data', binary_segment.data)
+                if segment is not None:
+                    data = segment.get_field('data')
+                    for extent_data, path, file_offset, size in binary_segment.extents:
+                        if extent_data is not None:
+                            data.add_bytes(extent_data)
+                        else:
+                            data.add_file(path, file_offset, size)
 
         else:
             # Case where the ROM is empty. In this case, we just have the ROM section size
@@ -295,6 +736,23 @@ class RomFlashSection(FlashSection):
             self.header.set_field('rom_header_size', self.get_size())
 
 
+    def materialize(self):
+        """Build the section payloads.
+
+        This computes the CRC tables, which needs the content of the segments.
+        """
+        if not self.segment_crcs:
+            return
+
+        for binary_segment, segment_crcs in zip(self.binary_segments, self.segment_crcs):
+            with gapylib.trace.span('rom block crcs', size=binary_segment.size):
+                block_crcs = binary_segment.get_block_crcs(CRC32_BLOCK_SIZE)
+
+            segment_crcs.set_field('crc', binary_segment.crc)
+            segment_crcs.set_field('block_crcs',
+                struct.pack(f'<{len(block_crcs)}I', *block_crcs))
+
+
     def __parse_binary(self):
         binary_path = self.get_property('binary')
 
@@ -315,3 +773,7 @@ class RomFlashSection(FlashSection):
     def is_empty(self):
         # In auto-mode flash it only if it has a binary and we are booting from this flash
         return self.binary is None or not self.boot
+
+
+def _get_nb_blocks(size: int) -> int:
+    return (size + CRC32_BLOCK_SIZE - 1) // CRC32_BLOCK_SIZE
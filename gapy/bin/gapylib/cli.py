@@ -0,0 +1,308 @@
+"""Provides the gapy command-line flow"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import argparse
+import contextlib
+import logging
+import os
+import sys
+
+import gapylib.startup_profile
+import gapylib.target
+import gapylib.trace
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Return the parser of the generic gapy options.
+
+    These options are for specifying the target and its options. The target then adds its own
+    options.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+        The parser.
+    """
+    parser = argparse.ArgumentParser(description='Execute commands on the target',
+        formatter_class=argparse.RawDescriptionHelpFormatter, add_help=False)
+
+    parser.add_argument('command', metavar='CMD', type=str, nargs='*',
+                        help='a command to be executed (execute the command "commands" to '
+                        'get the list of commands), or "batch <manifest>" to execute the jobs '
+                        'of a batch manifest')
+
+    parser.add_argument("--target", dest="target", default=None, help="specify the target")
+
+    parser.add_argument("--target-dir", dest="target_dirs", default=[], action="append",
+        help="append the specified directory to the list of directories where to look for "
+        "targets")
+
+    parser.add_argument("--target-property", dest="target_properties", default=[],
+        action="append", help="specify the value of a target property")
+
+    parser.add_argument('--target-opt', dest='target_opt', action="append", default=[],
+        help='Specifies target options.')
+
+    parser.add_argument('--config-opt', dest='config_opt', action="append", default=[],
+        help='Specifies target options (use only for backward-compatibility).')
+
+    parser.add_argument('--verbose', dest='verbose', type=str, default='critical', choices=[
+        'debug', 'info', 'warning', 'error', 'critical'],
+        help='Specifies verbose level.')
+
+    parser.add_argument('--py-stack', dest='py_stack', action="store_true",
+        help='Show python exception stack.')
+
+    parser.add_argument("--model-dir", dest="install_dirs", action="append",
+        type=str, help="specify an installation path where to find models (only for GVSOC)")
+
+    parser.add_argument('--work-dir',  dest='work_dir', default=None,
+        help='Specifies working directory.')
+
+    parser.add_argument("--platform", dest="platform", required=True,
+        choices=['fpga', 'board', 'rtl', 'gvsoc'],
+        type=str, help="specify the platform used for the target")
+
+    parser.add_argument('--profile-startup', dest='profile_startup', action="store_true",
+        help='Print the time spent in each startup phase and in each imported module.')
+
+    parser.add_argument('--gapy-trace', dest='gapy_trace', default=None, metavar='FILE',
+        help='Record the time spent in each gapy phase, flash and section to the specified '
+        'file in Chrome trace format, and print a summary on exit.')
+
+    parser.add_argument('--batch-jobs', dest='batch_jobs', type=int, default=os.cpu_count(),
+        help='Maximum number of batch jobs executed concurrently.')
+
+    _add_server_argument(parser)
+
+    return parser
+
+
+def _add_server_argument(parser: argparse.ArgumentParser):
+    parser.add_argument('--server', dest='server', nargs='?', const='', default=None,
+        metavar='SOCKET', help='Start a gapy server listening on the specified unix socket '
+        '(--server=<path>), or on the default one. Gapy commands are forwarded to it when the '
+        'GAPY_SERVER environment variable contains the socket path.')
+
+
+def main(argv: list=None, profiler: gapylib.startup_profile.StartupProfiler=None) -> int:
+    """Execute gapy commands.
+
+    Parameters
+    ----------
+    argv : list
+        Command-line arguments, without the executable name. Targets may also parse sys.argv
+        so they should be the same.
+    profiler : gapylib.startup_profile.StartupProfiler
+        Profiler recording the startup phases, or None.
+
+    Returns
+    -------
+    int
+        The exit status.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if profiler is None:
+        profiler = gapylib.startup_profile.StartupProfiler(enabled=False)
+
+    server_path = get_server_path(argv)
+    if server_path is not None:
+        # pylint: disable=import-outside-toplevel
+        from gapylib.server import Server
+        Server(server_path).serve_forever()
+        return 0
+
+    parser = get_parser()
+
+    # Do a first argument parse so that we can get the target and add more arguments, depending
+    # on the target
+    with profiler.phase('argument parsing'):
+        [args, _] = parser.parse_known_args(argv)
+
+    if args.gapy_trace is not None:
+        gapylib.trace.enable(args.gapy_trace)
+
+    try:
+
+        logging.basicConfig(level=getattr(logging, args.verbose.upper(), None),
+            format='\033[94m[GAPY]\033[0m %(asctime)s - %(levelname)s - %(message)s')
+
+        # Targets will be imported as python modules so the specified target directories must be
+        # appended to the python path
+        sys.path = args.target_dirs + sys.path
+
+        if len(args.command) > 0 and args.command[0] == 'batch':
+            return _run_batch(argv, args)
+
+        # Instantiate the specified target or if no target is specified, instantiate an empty one
+        # since we need a target to handle commands
+        if args.target is not None:
+            # Check if the target name has target properties inlined and if so, inject them
+            # into the list of target properties
+            target_name = args.target
+            target_properties = []
+            if target_name.find(':') != -1:
+                target_name, target_properties = target_name.split(':')
+                args.target_properties.append(target_properties)
+
+            with _phase(profiler, 'target import'):
+                target_class = gapylib.target.get_target(target_name,
+                    target_dirs=args.target_dirs)
+
+            with _phase(profiler, 'target instantiation'):
+                target = target_class(
+                    parser=parser,
+                    options=args.config_opt + args.target_opt
+                )
+        else:
+            target = gapylib.target.Target(parser)
+
+        target.set_target_dirs(args.target_dirs)
+
+        # Let the target add its options, and then reparse them
+        with _phase(profiler, 'append_args'):
+            target.append_args(parser)
+
+        with _phase(profiler, 'parse_args'):
+            parser = argparse.ArgumentParser(
+                parents=[parser],
+                formatter_class=argparse.RawDescriptionHelpFormatter,
+            )
+
+            args = parser.parse_args(argv)
+            target.parse_args(args)
+            target.check_args()
+
+        # Finally ask the target to handle the commands
+        for cmd in args.command:
+            with _phase(profiler, f'command {cmd}'):
+                target.handle_command(cmd)
+
+    except RuntimeError as exc:
+        if args.py_stack:
+            raise
+
+        print('Input error: ' + str(exc), file = sys.stderr)
+        return 1
+
+    finally:
+        try:
+            gapylib.trace.dump()
+        except RuntimeError as exc:
+            print('Input error: ' + str(exc), file = sys.stderr)
+
+        profiler.dump()
+
+    return 0
+
+
+@contextlib.contextmanager
+def _phase(profiler: gapylib.startup_profile.StartupProfiler, name: str):
+    # Phases are both profiled and traced
+    with profiler.phase(name), gapylib.trace.span(name):
+        yield
+
+
+def execute(argv: list) -> int:
+    """Execute gapy commands as the gapy executable would, in the current process.
+
+    This is used to execute commands in processes forked from a process where gapy is already
+    loaded. sys.argv is set to the specified arguments since targets also parse it. Errors
+    are printed and converted to an exit status.
+
+    Parameters
+    ----------
+    argv : list
+        Command-line arguments, including the executable name.
+
+    Returns
+    -------
+    int
+        The exit status.
+    """
+    sys.argv = argv
+
+    try:
+        return main(argv[1:])
+
+    except SystemExit as exc:
+        if exc.code is None:
+            return 0
+        if isinstance(exc.code, int):
+            return exc.code
+        print(exc.code, file=sys.stderr)
+        return 1
+
+    except BaseException: # pylint: disable=broad-except
+        # pylint: disable=import-outside-toplevel
+        import traceback
+        traceback.print_exc()
+        return 1
+
+
+def _run_batch(argv: list, args: argparse.Namespace) -> int:
+    if len(args.command) != 2:
+        raise RuntimeError('The batch command must be given exactly one manifest and no other '
+            'command')
+
+    # Jobs get all the options of the command line
+    base_argv = list(argv)
+    for arg in args.command:
+        base_argv.remove(arg)
+
+    # pylint: disable=import-outside-toplevel
+    import gapylib.batch
+    work_dir = args.work_dir if args.work_dir is not None else os.getcwd()
+    return gapylib.batch.run_batch(args.command[1], base_argv, args.target, work_dir,
+        args.batch_jobs)
+
+
+def get_server_path(argv: list) -> str:
+    """Return the socket path if the arguments ask for starting a gapy server.
+
+    This is checked before the real parsing since a server does not need the other options.
+
+    Parameters
+    ----------
+    argv : list
+        Command-line arguments, without the executable name.
+
+    Returns
+    -------
+    str
+        The socket path, an empty string for the default one, or None if no server should be
+        started.
+    """
+    # The option is parsed with the same definition as the real parsing so that all its forms
+    # are accepted
+    parser = argparse.ArgumentParser(add_help=False)
+    _add_server_argument(parser)
+
+    try:
+        [args, _] = parser.parse_known_args(argv)
+    except SystemExit:
+        return None
+
+    return args.server
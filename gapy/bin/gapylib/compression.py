@@ -0,0 +1,292 @@
+"""Provides the compression of file contents stored in flash sections"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import logging
+import os
+import threading
+import time
+
+import gapylib.trace
+from gapylib.utils import hash_file
+
+
+# Content stored as is
+CODEC_NONE = 0
+# Content stored as a single raw LZ4 block, without frame, so that it can be decompressed on the
+# target with the reference LZ4_decompress_safe
+CODEC_LZ4 = 1
+
+# Codecs by name, as given in section properties
+CODECS = {
+    'none': CODEC_NONE,
+    'lz4': CODEC_LZ4,
+}
+
+# Suffix of the cached blobs of each codec, which changes if the way they are compressed changes
+_BLOB_SUFFIXES = {
+    CODEC_LZ4: 'lz4hc',
+}
+
+# Default maximum size in MiB of the cache of compressed contents, it can be changed with the
+# GAPY_COMPRESSION_CACHE_SIZE environment variable
+CACHE_MAX_SIZE = 1024
+
+# Blobs used more recently than this, in seconds, are never evicted since other processes may
+# still have to copy them to their images. Temporary files older than this were left by
+# interrupted processes.
+CACHE_MIN_AGE = 3600
+
+# Minimum time in seconds between two trims of the cache
+CACHE_TRIM_PERIOD = 600
+
+
+def get_codec(name: str) -> int:
+    """Return the id of a codec.
+
+    Parameters
+    ----------
+    name : str
+        Name of the codec.
+
+    Returns
+    -------
+    int
+        The codec id.
+    """
+    codec = CODECS.get(name)
+    if codec is None:
+        raise RuntimeError(f'Unknown compression codec {name}, available codecs: '
+            f'{", ".join(CODECS.keys())}')
+    return codec
+
+
+def compress(codec: int, data: bytes) -> bytes:
+    """Compress a buffer.
+
+    Parameters
+    ----------
+    codec : int
+        Codec id.
+    data : bytes
+        Buffer to be compressed.
+
+    Returns
+    -------
+    bytes
+        The compressed buffer.
+    """
+    if codec == CODEC_NONE:
+        return data
+
+    try:
+        import lz4.block # pylint: disable=import-outside-toplevel
+    except ImportError as exc:
+        raise RuntimeError('LZ4 compression needs the lz4 python package') from exc
+
+    # Compressing harder only costs time on the host, the target decompresses at the same speed
+    return lz4.block.compress(data, mode='high_compression', compression=9, store_size=False)
+
+
+def decompress(codec: int, data: bytes, size: int) -> bytes:
+    """Decompress a buffer.
+
+    Parameters
+    ----------
+    codec : int
+        Codec id.
+    data : bytes
+        Buffer to be decompressed.
+    size : int
+        Size of the decompressed buffer.
+
+    Returns
+    -------
+    bytes
+        The decompressed buffer.
+    """
+    if codec == CODEC_NONE:
+        return data
+
+    try:
+        import lz4.block # pylint: disable=import-outside-toplevel
+    except ImportError as exc:
+        raise RuntimeError('LZ4 decompression needs the lz4 python package') from exc
+
+    return lz4.block.decompress(data, uncompressed_size=size)
+
+
+def compress_file(path: str, codec: int, cache_dir: str) -> (str, bytes, int):
+    """Compress the content of a host file.
+
+    Compressed contents are kept in the cache directory, keyed by the hash of the file content,
+    so that a file is only compressed again when its content changes.
+
+    Parameters
+    ----------
+    path : str
+        Path of the host file.
+    codec : int
+        Codec id.
+    cache_dir : str
+        Directory where compressed contents are cached, or None if they should not be.
+
+    Returns
+    -------
+    (str, bytes, int)
+        The path of the file containing the compressed content, or None if it is not cached,
+        in which case the compressed content is returned instead, and the size of the compressed
+        content.
+    """
+    with gapylib.trace.span('compress file', path=path) as span:
+        blob_path = None
+        if cache_dir is not None:
+            blob_path = os.path.join(cache_dir,
+                f'{hash_file(path)}.{_BLOB_SUFFIXES[codec]}')
+            try:
+                size = os.path.getsize(blob_path)
+                # The modification time is the last use, for evicting the least recently used
+                # blobs
+                os.utime(blob_path)
+                span.set_arg('hit', True)
+                return blob_path, None, size
+            except OSError:
+                pass
+
+        try:
+            with open(path, 'rb') as file_desc:
+                data = compress(codec, file_desc.read())
+        except OSError as exc:
+            raise RuntimeError(f'Unable to read file {path}: {exc}') from exc
+
+        span.set_arg('hit', False)
+        span.set_arg('bytes', len(data))
+
+        if blob_path is not None:
+            tmp_path = f'{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(tmp_path, 'wb') as file_desc:
+                    file_desc.write(data)
+                os.replace(tmp_path, blob_path)
+                return blob_path, None, len(data)
+            except OSError:
+                # The cache is just an optimization
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+        return None, data, len(data)
+
+
+def trim_cache(cache_dir: str, max_size: int=None):
+    """Evict the least recently used compressed contents until the cache fits in its size.
+
+    Nothing is done if the cache was trimmed recently or if another process is already doing it.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory where compressed contents are cached.
+    max_size : int
+        Maximum size in bytes of the cache, or None to take it from the
+        GAPY_COMPRESSION_CACHE_SIZE environment variable, in MiB, or from the default one.
+    """
+    if max_size is None:
+        try:
+            max_size = int(os.environ.get('GAPY_COMPRESSION_CACHE_SIZE', CACHE_MAX_SIZE))
+        except ValueError as exc:
+            raise RuntimeError('Invalid GAPY_COMPRESSION_CACHE_SIZE, it must be a size in MiB: '
+                f'{exc}') from exc
+        max_size *= 1024 * 1024
+
+    try:
+        # pylint: disable=import-outside-toplevel
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    lock_path = os.path.join(cache_dir, 'lock')
+    try:
+        # The lock file modification time is the time of the last trim
+        if time.time() - os.path.getmtime(lock_path) < CACHE_TRIM_PERIOD:
+            return
+    except OSError:
+        pass
+
+    try:
+        with open(lock_path, 'a', encoding='utf-8') as lock_desc:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_desc.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return
+
+            os.utime(lock_path)
+
+            with gapylib.trace.span('compression cache trim', path=cache_dir):
+                _trim_cache(cache_dir, max_size)
+    except OSError as exc:
+        logging.debug('Unable to trim compression cache %s: %s', cache_dir, exc)
+
+
+def _trim_cache(cache_dir: str, max_size: int):
+    now = time.time()
+
+    blobs = []
+    total_size = 0
+    for entry in os.scandir(cache_dir):
+        if not entry.is_file(follow_symlinks=False) or entry.name == 'lock':
+            continue
+
+        try:
+            stat = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+
+        if entry.name.endswith('.tmp'):
+            if now - stat.st_mtime > CACHE_MIN_AGE:
+                _remove(entry.path)
+            continue
+
+        blobs.append([stat.st_mtime, stat.st_size, entry.path])
+        total_size += stat.st_size
+
+    if total_size <= max_size:
+        return
+
+    for last_use, size, path in sorted(blobs):
+        if now - last_use < CACHE_MIN_AGE:
+            break
+
+        _remove(path)
+
+        total_size -= size
+        if total_size <= max_size:
+            break
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
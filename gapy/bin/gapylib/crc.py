@@ -0,0 +1,241 @@
+"""Provides the CRC32 engine shared by all section templates"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import zlib
+
+
+# Reflected polynomial of the CRC32 used by the ROM and the flash tools
+CRC32_POLY = 0xEDB88320
+
+# Default initial value, the final value is always xored with the same mask
+CRC32_INIT = 0xffffffff
+
+# Default size of the blocks for per-block CRC tables
+CRC32_BLOCK_SIZE = 4096
+
+
+def _build_table() -> list:
+    table = []
+    for index in range(0, 256):
+        crc = index
+        for _ in range(0, 8):
+            if crc & 1 == 1:
+                crc = (crc >> 1) ^ CRC32_POLY
+            else:
+                crc = crc >> 1
+        table.append(crc)
+    return table
+
+CRC32_TABLE = _build_table()
+
+
+def compute_crc_table(init: int, buff: bytes) -> int:
+    """Compute the CRC32 of a buffer with the byte-wise lookup table.
+
+    This is the pure python reference implementation, it is only meant to check the fast path.
+
+    Parameters
+    ----------
+    init : int
+        Initial value of the CRC.
+    buff : bytes
+        Data buffer.
+
+    Returns
+    -------
+    int
+        The CRC of the buffer.
+    """
+    crc = init
+    table = CRC32_TABLE
+    for data in buff:
+        crc = (crc >> 8) ^ table[(crc ^ data) & 0xff]
+    return crc ^ 0xffffffff
+
+
+def compute_crc(init: int, buff: bytes) -> int:
+    """Compute the CRC32 of a whole buffer.
+
+    This gives the same result as the bit-by-bit computation with polynomial 0xEDB88320 where the
+    final value is xored with 0xffffffff.
+
+    Parameters
+    ----------
+    init : int
+        Initial value of the CRC.
+    buff : bytes
+        Data buffer.
+
+    Returns
+    -------
+    int
+        The CRC of the buffer.
+    """
+    # zlib implements the same CRC, it just expects the initial value to be already xored.
+    return zlib.crc32(buff, init ^ 0xffffffff)
+
+
+def compute_block_crcs(buff: bytes, block_size: int=CRC32_BLOCK_SIZE,
+        init: int=CRC32_INIT) -> list:
+    """Compute the CRC32 of each block of a buffer.
+
+    Each block is computed independently, starting from the same initial value. The last block
+    can be smaller than the block size.
+
+    Parameters
+    ----------
+    buff : bytes
+        Data buffer.
+    block_size : int
+        Size of each block in bytes.
+    init : int
+        Initial value of the CRC of each block.
+
+    Returns
+    -------
+    list
+        The CRC of each block.
+    """
+    view = memoryview(buff)
+    result = []
+    for offset in range(0, len(view), block_size):
+        result.append(compute_crc(init, view[offset:offset + block_size]))
+    return result
+
+
+class Crc32():
+    """
+    Incremental CRC32 computation.
+
+    Data can be given in several chunks through update, the final CRC is returned by digest.
+
+    Attributes
+    ----------
+    init : int
+        Initial value of the CRC.
+    """
+
+    def __init__(self, init: int=CRC32_INIT):
+        # The running value is kept xored so that it can be directly given to zlib
+        self.__value = init ^ 0xffffffff
+
+    def update(self, buff: bytes):
+        """Add data to the CRC.
+
+        Parameters
+        ----------
+        buff : bytes
+            Data buffer.
+        """
+        self.__value = zlib.crc32(buff, self.__value)
+
+    def digest(self) -> int:
+        """Return the CRC of all data given so far.
+
+        The CRC can still be updated after this call.
+
+        Returns
+        -------
+        int
+            The CRC.
+        """
+        return self.__value
+
+    def copy(self) -> 'Crc32':
+        """Return a copy of the current CRC state.
+
+        Returns
+        -------
+        Crc32
+            The copy.
+        """
+        result = Crc32()
+        result.__value = self.__value
+        return result
+
+
+class BlockCrc32():
+    """
+    Incremental per-block CRC32 computation.
+
+    Data can be given in several chunks through update, whose sizes do not need to be multiples
+    of the block size. The CRC of each block is returned by digest.
+
+    Attributes
+    ----------
+    block_size : int
+        Size of each block in bytes.
+    init : int
+        Initial value of the CRC of each block.
+    """
+
+    def __init__(self, block_size: int=CRC32_BLOCK_SIZE, init: int=CRC32_INIT):
+        self.block_size = block_size
+        self.init = init
+        self.__crcs = []
+        # CRC of the current block, when only a part of it has been given
+        self.__crc = None
+        self.__size = 0
+
+    def update(self, buff: bytes):
+        """Add data to the CRCs.
+
+        Parameters
+        ----------
+        buff : bytes
+            Data buffer.
+        """
+        view = memoryview(buff)
+
+        # First complete the current block, if any
+        if self.__crc is not None:
+            size = min(self.block_size - self.__size, len(view))
+            self.__crc.update(view[:size])
+            self.__size += size
+            view = view[size:]
+            if self.__size == self.block_size:
+                self.__crcs.append(self.__crc.digest())
+                self.__crc = None
+
+        # Then all full blocks at once, and keep the remaining data for the next update
+        full_size = len(view) - len(view) % self.block_size
+        self.__crcs += compute_block_crcs(view[:full_size], self.block_size, self.init)
+
+        if full_size < len(view):
+            self.__crc = Crc32(self.init)
+            self.__crc.update(view[full_size:])
+            self.__size = len(view) - full_size
+
+    def digest(self) -> list:
+        """Return the CRC of each block given so far.
+
+        The last block can be smaller than the block size.
+
+        Returns
+        -------
+        list
+            The CRC of each block.
+        """
+        if self.__crc is None:
+            return list(self.__crcs)
+        return self.__crcs + [self.__crc.digest()]
@@ -0,0 +1,219 @@
+"""Provides a minimal ELF reader, only parsing what is needed to load binaries"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import contextlib
+import mmap
+import struct
+import typing
+
+
+# Program header type of the segments to be loaded
+PT_LOAD = 1
+
+_ELF_MAGIC = b'\x7fELF'
+
+# Value of e_phnum telling the real number of program headers is in the first section header
+_PN_XNUM = 0xffff
+
+# Identification bytes giving the class and the byte order, and the corresponding formats of the
+# ELF header after the identification bytes and of a program header
+_ELF_FORMATS = {
+    (1, 1): ('<HHIIIIIHHHHHH', '<IIIIIIII'),
+    (1, 2): ('>HHIIIIIHHHHHH', '>IIIIIIII'),
+    (2, 1): ('<HHIQQQIHHHHHH', '<IIQQQQQQ'),
+    (2, 2): ('>HHIQQQIHHHHHH', '>IIQQQQQQ'),
+}
+
+_ELF_IDENT_SIZE = 16
+
+
+class ElfSegment():
+    """
+    Class for describing a segment of an ELF file, as given by its program header.
+
+    Attributes
+    ----------
+    p_type : int
+        Type of the segment.
+    offset : int
+        Offset of the segment content in the file.
+    vaddr : int
+        Virtual address of the segment.
+    paddr : int
+        Physical address of the segment.
+    filesz : int
+        Size of the segment content in the file.
+    memsz : int
+        Size of the segment in memory.
+    flags : int
+        Segment flags.
+    """
+
+    def __init__(self, p_type: int, offset: int, vaddr: int, paddr: int, filesz: int, memsz: int,
+            flags: int):
+        self.p_type = p_type
+        self.offset = offset
+        self.vaddr = vaddr
+        self.paddr = paddr
+        self.filesz = filesz
+        self.memsz = memsz
+        self.flags = flags
+
+
+class ElfFile():
+    """
+    Class for reading an ELF file.
+
+    Only the ELF header and the program headers are parsed, and the segment contents are given
+    as views of the file buffer, so that nothing is copied.
+
+    Attributes
+    ----------
+    elf_class : int
+        ELF class, 1 for 32 bits and 2 for 64 bits.
+    machine : int
+        Target architecture.
+    entry : int
+        Entry point.
+    segments : list
+        The segments, as ElfSegment.
+    """
+
+    def __init__(self, buff: bytes, elf_class: int, machine: int, entry: int, segments: list):
+        self.elf_class = elf_class
+        self.machine = machine
+        self.entry = entry
+        self.segments = segments
+        self.__view = memoryview(buff)
+
+    @staticmethod
+    def parse(buff: bytes) -> 'ElfFile':
+        """Parse an ELF file.
+
+        Parameters
+        ----------
+        buff : bytes
+            Content of the ELF file.
+
+        Returns
+        -------
+        ElfFile
+            The ELF file, or None if it is not an ELF file that this reader supports, in which
+            case a complete ELF parser should be used instead.
+        """
+        if len(buff) < _ELF_IDENT_SIZE or buff[0:4] != _ELF_MAGIC:
+            return None
+
+        formats = _ELF_FORMATS.get((buff[4], buff[5]))
+        if formats is None:
+            return None
+
+        header_format, phdr_format = formats
+        if len(buff) < _ELF_IDENT_SIZE + struct.calcsize(header_format):
+            return None
+
+        __, machine, __, entry, phoff, __, __, __, phentsize, phnum, __, __, __ = \
+            struct.unpack_from(header_format, buff, _ELF_IDENT_SIZE)
+
+        phdr_size = struct.calcsize(phdr_format)
+        if phnum == _PN_XNUM or (phnum != 0 and phentsize < phdr_size) or \
+                phoff + phnum * phentsize > len(buff):
+            return None
+
+        segments = []
+        for index in range(0, phnum):
+            fields = struct.unpack_from(phdr_format, buff, phoff + index * phentsize)
+            if buff[4] == 1:
+                p_type, offset, vaddr, paddr, filesz, memsz, flags, __ = fields
+            else:
+                p_type, flags, offset, vaddr, paddr, filesz, memsz, __ = fields
+
+            if p_type == PT_LOAD and offset + filesz > len(buff):
+                return None
+
+            segments.append(ElfSegment(p_type, offset, vaddr, paddr, filesz, memsz, flags))
+
+        return ElfFile(buff, buff[4], machine, entry, segments)
+
+    def get_load_segments(self) -> list:
+        """Return the segments to be loaded.
+
+        Returns
+        -------
+        list
+            The PT_LOAD segments, as ElfSegment.
+        """
+        return [segment for segment in self.segments if segment.p_type == PT_LOAD]
+
+    def get_segment_data(self, segment: ElfSegment) -> memoryview:
+        """Return the content of a segment.
+
+        Parameters
+        ----------
+        segment : ElfSegment
+            The segment.
+
+        Returns
+        -------
+        memoryview
+            A view of the segment content in the file buffer, which must be released before the
+            file is closed.
+        """
+        return self.__view[segment.offset:segment.offset + segment.filesz]
+
+    def close(self):
+        """Release the file buffer."""
+        self.__view.release()
+
+
+@contextlib.contextmanager
+def open_elf(file_desc: typing.BinaryIO) -> typing.Iterator[ElfFile]:
+    """Parse an ELF file.
+
+    The file is mapped when possible instead of being read.
+
+    Parameters
+    ----------
+    file_desc : typing.BinaryIO
+        The opened ELF file.
+
+    Returns
+    -------
+    typing.Iterator[ElfFile]
+        The ELF file, or None if it is not an ELF file that this reader supports, in which case
+        a complete ELF parser should be used instead.
+    """
+    with contextlib.ExitStack() as stack:
+        try:
+            buff = stack.enter_context(
+                mmap.mmap(file_desc.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError):
+            # Files which can not be mapped, like empty files or in-memory ones, are read
+            file_desc.seek(0)
+            buff = file_desc.read()
+
+        elf = ElfFile.parse(buff)
+        if elf is not None:
+            stack.callback(elf.close)
+
+        yield elf
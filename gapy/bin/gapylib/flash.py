@@ -24,13 +24,106 @@ The same for each flash.
 # Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
 #
 
+import hashlib
+import importlib
+import io
 import json
-import traceback
+import logging
+import mmap
 from collections import OrderedDict
 import os.path
-from typing import Any, Dict
+from typing import Any, BinaryIO, Dict
+
+from gapylib.image_writer import ImageWriter
+from gapylib.crc import Crc32
+from gapylib.parallel import run_parallel
+import gapylib.trace
+
+class SectionDigest():
+    """
+    Digests of the content of a section, computed while it is written.
+
+    It can be given to ImageWriter.add_digest, which only uses its update method. The digests
+    are the MD5 and the CRC32 computed by gapylib.crc.
+    """
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.crc32 = Crc32()
+        # Digests given with set, when they are known without the data
+        self.value = None
+
+    def update(self, data: bytes):
+        """Add data to the digests.
+
+        Parameters
+        ----------
+        data : bytes
+            The data.
+        """
+        self.md5.update(data)
+        self.crc32.update(data)
+
+    def set(self, value: list):
+        """Set the digests, when they are known without going through the data.
+
+        Parameters
+        ----------
+        value : list
+            The MD5 digest as bytes and the CRC32.
+        """
+        self.value = value
+
+    def get(self) -> list:
+        """Return the digests of all data given so far.
+
+        Returns
+        -------
+        list
+            The MD5 digest as bytes and the CRC32.
+        """
+        if self.value is not None:
+            return self.value
+        return [self.md5.digest(), self.crc32.digest()]
+
+    @staticmethod
+    def get_file_digests(path: str, offset: int, size: int) -> list:
+        """Return the digests of a range of an existing file.
+
+        The file is mapped instead of read, so that big images are never copied into python
+        buffers.
+
+        Parameters
+        ----------
+        path : str
+            Path of the file.
+        offset : int
+            Offset of the range in the file.
+        size : int
+            Size of the range, which must be within the file.
+
+        Returns
+        -------
+        list
+            The MD5 digest as bytes and the CRC32.
+        """
+        digest = SectionDigest()
+        if size == 0:
+            return digest.get()
+
+        try:
+            with open(path, 'rb') as file_desc, \
+                    mmap.mmap(file_desc.fileno(), 0, access=mmap.ACCESS_READ) as image:
+                if offset + size > len(image):
+                    raise RuntimeError(f'File {path} is too small to contain range '
+                        f'0x{offset:x}-0x{offset + size:x}')
+                with memoryview(image) as view:
+                    digest.update(view[offset:offset + size])
+        except (OSError, ValueError) as exc:
+            raise RuntimeError(f'Unable to read file {path}: {exc}') from exc
+
+        return digest.get()
 
-from prettytable import PrettyTable
 
 class FlashSectionProperty():
     """
@@ -103,6 +196,7 @@ class FlashSection():
 
 
         if self.properties.get(name) is not None:
+            import traceback # pylint: disable=import-outside-toplevel
             traceback.print_stack()
             raise RuntimeError(f'Property {name} already declared')
 
@@ -271,20 +365,38 @@ class FlashSection():
         file_desc
             File descriptor.
         """
-        result = bytearray()
+        file_desc = io.BytesIO()
+        writer = ImageWriter(file_desc, sparse=False,
+            erased_value=self.get_flash().get_erased_value())
+        self.write_image(writer)
+        writer.close()
+
+        return file_desc.getvalue()
+
+
+    def write_image(self, writer: ImageWriter):
+        """Stream the content of the section in binary form to the specified writer.
+
+        The section is written starting at the current writer position and is padded to match
+        its expected size with an uninitialized region.
+
+        Parameters
+        ----------
+        writer : ImageWriter
+            The writer where the section is dumped.
+        """
+        start = writer.tell()
         for cstruct in self.structs:
-            result += cstruct.pack()
+            cstruct.write_image(writer)
 
         # pad the section to match its expected size
-        image_len = len(result)
+        image_len = writer.tell() - start
         if image_len < self.get_size():
-            result += bytearray(self.get_size() - image_len)
+            writer.write_uninitialized(self.get_size() - image_len)
         elif image_len > self.get_size():
             raise RuntimeError('Section image is too big (expected'
                                f'{self.get_size()}, got {image_len})')
 
-        return result
-
 
     def dump_table(self, level: int) -> str:
         """Dump the section as a table.
@@ -309,6 +421,8 @@ class FlashSection():
         if len(self.properties) == 0:
             return ''
 
+        from prettytable import PrettyTable # pylint: disable=import-outside-toplevel
+
         table = PrettyTable()
         table.field_names = ["Property name", "Property value", "Property description"]
         for prop in self.properties.values():
@@ -377,6 +491,59 @@ class FlashSection():
         # Nothing to do, should be overloaded by real sections when needed.
 
 
+    def materialize(self):
+        """Build the section payloads.
+
+        This is called once all sections are finalized, to produce the payloads which are not
+        needed to compute the layout, like images generated by external tools.
+        Sections may be materialized concurrently, so this step must only modify the section
+        itself.
+        """
+        # Nothing to do, should be overloaded by real sections when needed.
+
+
+    def get_host_files(self) -> list:
+        """Return the host files streamed into the section image.
+
+        This can be overloaded by sections made of many host files, so that their hashes are
+        computed concurrently before the section fingerprint.
+
+        Returns
+        -------
+        list
+            The paths of the host files.
+        """
+        return []
+
+
+    def get_digested_sections(self) -> list:
+        """Return the sections whose digests are stored in this section.
+
+        This can be overloaded by sections like partition tables which protect the content of
+        other sections. The digests are computed while the sections are written, so that the
+        image is never read back, and are then given to this section with set_digests before it
+        is written again.
+
+        Returns
+        -------
+        list
+            The sections.
+        """
+        return []
+
+
+    def set_digests(self, digests: list):
+        """Set the digests of the sections returned by get_digested_sections.
+
+        Parameters
+        ----------
+        digests : list
+            For each section, its [md5, crc32] digests, as returned by SectionDigest.get, or None
+            if the section is not part of the generated image. None instead of the list means
+            going back to the content without digests, which is the one used for fingerprints.
+        """
+
+
     def get_property(self, name: str) -> any:
         """Return the value of a property.
 
@@ -494,6 +661,15 @@ class FlashSection():
         return section_desc
 
 
+def _section_span(name: str, section: FlashSection, **args: any) -> 'gapylib.trace.Span':
+    # Return the trace span of a section step, identified by its flash, name and template
+    if not gapylib.trace.is_enabled():
+        return gapylib.trace.span(name)
+
+    return gapylib.trace.span(name, flash=section.get_flash().get_name(),
+        section=section.get_name(), template=type(section).__name__, **args)
+
+
 class Flash():
     """
     Parent class for all flashes. This provides utility functions for describing a flash.
@@ -524,6 +700,9 @@ class Flash():
         self.properties = {}
         self.flash_attributes = {} if flash_attributes is None else flash_attributes
         self.target = target
+        self.incremental = True
+        self.jobs = 1
+        self.image_store = None
         if image_name is None:
             self.image_name = name + '.bin'
         else:
@@ -591,7 +770,8 @@ class Flash():
             Name of the template
 
         section_template : FlashSection
-            Section template
+            Section template. It can also be given as a string "module:class", in which case
+            the module is only imported if a section is instantiated from this template.
         """
         self.sections_templates[template_name] = section_template
 
@@ -610,6 +790,8 @@ class Flash():
 
         # The flash layout is displayed as a table which can embed deeper level
         # table in a cell
+        from prettytable import PrettyTable # pylint: disable=import-outside-toplevel
+
         table = PrettyTable()
         names = ["Section offset", "Section name", "Section size"]
         if level > 0:
@@ -636,8 +818,10 @@ class Flash():
 
         print(f'Dumping flash \"{self.name}\" section content.')
 
-        self.__dump_sections(is_app=False, pem_path=pem_path, dgst=sign_dgst)
-        self.__dump_sections_description(is_app=False, pem_path=pem_path)
+        signature_sizes = self.__dump_sections(is_app=False, pem_path=pem_path,
+            dgst=sign_dgst)
+        self.__dump_sections_description(is_app=False, pem_path=pem_path,
+            signature_sizes=signature_sizes)
 
     def dump_app_sections(self, pem_path: str, sign_dgst: str):
         """Dump the sections images and a description of each section
@@ -649,10 +833,12 @@ class Flash():
 
         print(f'Dumping flash \"{self.name}\" section content.')
 
-        self.__dump_sections(is_app=True, pem_path=pem_path, dgst=sign_dgst)
-        self.__dump_sections_description(is_app=True, pem_path=pem_path)
+        signature_sizes = self.__dump_sections(is_app=True, pem_path=pem_path,
+            dgst=sign_dgst)
+        self.__dump_sections_description(is_app=True, pem_path=pem_path,
+            signature_sizes=signature_sizes)
 
-    def __dump_sections_description(self, is_app: bool, pem_path: str):
+    def __dump_sections_description(self, is_app: bool, pem_path: str, signature_sizes: dict):
 
         section_descriptions = []
         for section in self.sections.values():
@@ -660,7 +846,9 @@ class Flash():
                 section_desc = section.dump_section_description()
                 if pem_path is not None:
                     section_desc['signature'] = f'{section_desc["image_file"]}' + '.sig'
-                    signature_size = os.path.getsize(section_desc["image_file"]+'.sig')
+                    signature_size = signature_sizes.get(section.get_name())
+                    if signature_size is None:
+                        signature_size = os.path.getsize(section.get_image_path() + '.sig')
                     section_desc['signature_size'] = signature_size
                 section_descriptions.append(section_desc)
 
@@ -676,25 +864,153 @@ class Flash():
                                'writing ' + str(exc)) from exc
 
     def __dump_sections(self, is_app: bool, pem_path : str, dgst='sha256'):
+        sections = []
         for section in self.sections.values():
             if not (is_app and (section.get_partition_type() == 0x2)):
-                image = section.get_image()
+                sections.append(section)
+
+        signer = None
+        if pem_path is not None:
+            from gapylib.signing import get_signer # pylint: disable=import-outside-toplevel
+            signer = get_signer(pem_path, dgst)
+
+        store_keys = self.__get_sections_store_keys(sections, pem_path, dgst)
+
+        # Sections storing the digests of other sections are dumped once the other ones are
+        # done, so that their digests are known
+        digested_names = self.__get_digested_names(sections)
+        digests = {}
+        first_indexes = []
+        last_indexes = []
+        for index, section in enumerate(sections):
+            if section.get_name() in digested_names:
+                digests[section.get_name()] = SectionDigest()
+            if len(section.get_digested_sections()) == 0:
+                first_indexes.append(index)
+            else:
+                last_indexes.append(index)
+
+        signature_sizes = [None] * len(sections)
+
+        def dump(indexes: list):
+            sizes = run_parallel(self.jobs,
+                lambda index: self.__dump_section(sections[index], signer, store_keys[index],
+                    digests.get(sections[index].get_name())),
+                indexes)
+            for index, size in zip(indexes, sizes):
+                signature_sizes[index] = size
+
+        dump(first_indexes)
+
+        digest_values = {name: digest.get() for name, digest in digests.items()}
+        try:
+            for index in last_indexes:
+                self.__set_section_digests(sections[index], digest_values)
+            dump(last_indexes)
+        finally:
+            for index in last_indexes:
+                sections[index].set_digests(None)
+
+        if self.image_store is not None:
+            self.image_store.trim()
+
+        return dict(zip([section.get_name() for section in sections], signature_sizes))
+
+    def __get_sections_store_keys(self, sections: list, pem_path: str, dgst: str) -> list:
+        # Return the keys of the section images and signatures in the image store
+        if self.image_store is None:
+            return [[None, None]] * len(sections)
+
+        # The manifest is only used for computing section fingerprints, it is not saved
+        from gapylib.image_manifest import ImageManifest # pylint: disable=import-outside-toplevel
+
+        manifest = ImageManifest(self.get_manifest_path(), self.get_erased_value())
+        manifest.add_sections(sections, jobs=self.jobs)
+
+        pem_hash = None
+        if pem_path is not None:
+            pem_hash = manifest.get_file_hash(pem_path)
+
+        result = []
+        for entry in manifest.sections:
+            image_key = self.image_store.get_key('section', self.get_erased_value(),
+                entry['size'], entry['fingerprint'])
+            signature_key = None
+            if pem_hash is not None:
+                signature_key = self.image_store.get_key('signature', image_key, pem_hash, dgst)
+            result.append([image_key, signature_key])
+
+        return result
+
+    def __dump_section(self, section: FlashSection, signer: 'gapylib.signing.Signer',
+            store_keys: list, section_digest: SectionDigest=None) -> int:
+        section_path = section.get_image_path()
+        image_key, signature_key = store_keys
 
-                section_path = section.get_image_path()
+        # pylint: disable=import-outside-toplevel
+        from gapylib.image_store import unshare_file
+
+        if image_key is not None and self.image_store.get(image_key, section_path):
+            if section_digest is not None:
+                # The image was not written, its digests must be computed from the file
+                section_digest.set(SectionDigest.get_file_digests(section_path, 0,
+                    section.get_size()))
+
+            if signer is None:
+                return None
+
+            signature_path = section_path + '.sig'
+            if self.image_store.get(signature_key, signature_path):
+                return os.path.getsize(signature_path)
+
+            # The image was not written, its digest must be computed from the file
+            digest = signer.new_digest()
+            if digest is not None:
                 try:
-                    with open(section_path, 'wb') as file_desc:
-                        file_desc.write(image)
+                    with open(section_path, 'rb') as file_desc:
+                        for data in iter(lambda: file_desc.read(1 << 20), b''):
+                            digest.update(data)
                 except OSError as exc:
-                    raise RuntimeError('Unable to open flash section image for '
-                                       'writing ' + str(exc)) from exc
+                    raise RuntimeError('Unable to read flash section image ' +
+                        str(exc)) from exc
 
-                if pem_path is not None:
-                    openssl_cmd = f'openssl dgst -{dgst} -sign "{pem_path}" '
-                    openssl_cmd += f'-out "{section_path}.sig" "{section_path}"'
-                    error = os.system(openssl_cmd)
+            unshare_file(signature_path, keep_content=False)
+            signature_size = signer.sign(section_path, digest)
+            if signature_size is not None:
+                self.image_store.add(signature_key, signature_path)
+            return signature_size
+
+        digest = None
+        try:
+            unshare_file(section_path, keep_content=False)
+            with open(section_path, 'wb') as file_desc:
+                writer = ImageWriter(file_desc, erased_value=section.get_flash().get_erased_value())
+                # The digest is computed while the section is written, to avoid reading it back
+                # for signing it
+                if signer is not None:
+                    digest = signer.new_digest()
+                    if digest is not None:
+                        writer.add_digest(digest)
+                if section_digest is not None:
+                    writer.add_digest(section_digest)
+                with _section_span('section write', section, bytes=section.get_size()):
+                    section.write_image(writer)
+                writer.close()
+        except OSError as exc:
+            raise RuntimeError('Unable to open flash section image for '
+                               'writing ' + str(exc)) from exc
+
+        if image_key is not None:
+            self.image_store.add(image_key, section_path)
 
-                    if error != 0:
-                        print(f'Failed to sign binary {section_path}')
+        if signer is not None:
+            unshare_file(section_path + '.sig', keep_content=False)
+            signature_size = signer.sign(section_path, digest)
+            if signature_size is not None and signature_key is not None:
+                self.image_store.add(signature_key, section_path + '.sig')
+            return signature_size
+
+        return None
 
     def dump_section_properties(self):
         """Dump the section properties of the flash.
@@ -705,6 +1021,8 @@ class Flash():
 
         # The flash layout is displayed as a table which can embed deeper level
         # table in a cell
+        from prettytable import PrettyTable # pylint: disable=import-outside-toplevel
+
         table = PrettyTable()
         table.field_names = ["Section name", "Section properties"]
 
@@ -720,6 +1038,15 @@ class Flash():
         """Dump the content of the flash in binary form to the specified file.
         May dump only a subset if first and last are parameters are used.
 
+        The image is streamed section by section, and empty regions become holes in the file,
+        so that the memory needed does not depend on the flash size.
+        In incremental mode, a manifest of the section contents is dumped next to the image, and
+        only the sections which changed since the previous generation are written.
+        If an image store is set, the image is taken from it when the same content was already
+        generated, and added to it otherwise.
+        The digests stored by some sections, like partition tables, are computed while the other
+        sections are written, and these sections are written again at the end.
+
         Parameters
         ----------
         first
@@ -727,13 +1054,196 @@ class Flash():
         last
             Last section to be dumped
         """
+        self.__parse_content()
+
+        if first is None:
+            first = 0
+
+        if last is None:
+            last = len(self.sections)
+
+        sections = list(self.sections.values())[first:last+1]
+        image_path = self.get_image_path()
+
+        # Compare the fingerprint of each section with the ones of the previous generation to
+        # only write the sections which changed
+        # pylint: disable=import-outside-toplevel
+        from gapylib.image_manifest import ImageManifest
+        from gapylib.image_store import unshare_file
+
+        manifest = ImageManifest(self.get_manifest_path(), self.get_erased_value())
+        with gapylib.trace.span('flash fingerprint', flash=self.name):
+            manifest.add_sections(sections, jobs=self.jobs)
+
+        changed_sections = None
+        if self.incremental:
+            changed_sections = manifest.get_changed_sections(image_path)
+
+        manifest.invalidate()
+
+        # Digests computed while the sections are written
+        digests = {name: SectionDigest() for name in self.__get_digested_names(sections)}
+
+        # The fingerprints of the sections cover everything the image content depends on
+        store_key = None
+        if self.image_store is not None:
+            store_key = self.image_store.get_key('image', self.get_erased_value(),
+                [[section[key] for key in ['offset', 'size', 'fingerprint']]
+                    for section in manifest.sections])
+
+        written_sections = []
         try:
-            with open(self.get_image_path(), 'wb') as file_desc:
-                file_desc.write(self.get_image(first,last))
+            if changed_sections != [] and store_key is not None and \
+                    self.image_store.get(store_key, image_path):
+                logging.debug('Taking flash image %s from image store', image_path)
+
+            elif changed_sections is None:
+                logging.debug('Generating flash image %s', image_path)
+                written_sections = sections
+                unshare_file(image_path, keep_content=False)
+                # An empty range has no section to size the image, the sequential path just
+                # creates an empty image
+                if self.jobs <= 1 or len(sections) == 0:
+                    with open(image_path, 'wb') as file_desc:
+                        writer = ImageWriter(file_desc, erased_value=self.get_erased_value())
+                        self.write_image(writer, first, last, digests=digests)
+                        writer.close()
+                else:
+                    # Create the image with its final size, it is then full of zeros and each
+                    # section can be written concurrently at its offset.
+                    with open(image_path, 'wb') as file_desc:
+                        file_desc.truncate(sections[-1].get_offset() + sections[-1].get_size() -
+                            sections[0].get_offset())
+
+                        # Holes between sections must get the erased value if it is not zero
+                        if self.get_erased_value() != 0:
+                            self.__write_image_gaps(file_desc, sections)
+
+                    run_parallel(self.jobs,
+                        lambda section: self.__write_image_section(image_path, section,
+                            sections[0].get_offset(), sparse=True,
+                            section_digest=digests.get(section.get_name())),
+                        sections)
+
+            elif len(changed_sections) > 0:
+                # Patch the image in place. Zeros must really be written since the previous
+                # content is still there.
+                unshare_file(image_path, keep_content=True)
+                written_sections = [sections[index] for index in changed_sections]
+                for index in changed_sections:
+                    logging.debug('Updating section %s of flash image %s',
+                        sections[index].get_name(), image_path)
+
+                run_parallel(self.jobs,
+                    lambda index: self.__write_image_section(image_path, sections[index],
+                        sections[0].get_offset(), sparse=False,
+                        section_digest=digests.get(sections[index].get_name())),
+                    changed_sections)
+
+            self.__update_image_digests(image_path, sections, manifest, digests,
+                written_sections)
+
         except OSError as exc:
             raise RuntimeError('Unable to open flash image for '
                                'writing ' + str(exc)) from exc
 
+        if store_key is not None:
+            self.image_store.add(store_key, image_path)
+            self.image_store.trim()
+
+        manifest.save(image_path)
+
+
+    def __write_image_gaps(self, file_desc: BinaryIO, sections: list):
+        for prev_section, section in zip(sections[:-1], sections[1:]):
+            gap_offset = prev_section.get_offset() + prev_section.get_size()
+            file_desc.seek(gap_offset - sections[0].get_offset())
+            writer = ImageWriter(file_desc, erased_value=self.get_erased_value())
+            writer.write_uninitialized(section.get_offset() - gap_offset)
+            writer.close()
+
+
+    def __update_image_digests(self, image_path: str, sections: list,
+            manifest: 'gapylib.image_manifest.ImageManifest', digests: dict,
+            written_sections: list):
+        # Get the digests of all sections, from the previous generation for the ones which were
+        # not written, and write again the sections storing them if anything was written
+        written_names = [section.get_name() for section in written_sections]
+        digest_values = {}
+        for index, section in enumerate(sections):
+            name = section.get_name()
+            if name not in digests:
+                continue
+
+            if name in written_names:
+                value = digests[name].get()
+            else:
+                value = manifest.get_section_digests(index)
+                if value is None and len(written_sections) != 0:
+                    value = SectionDigest.get_file_digests(image_path,
+                        section.get_offset() - sections[0].get_offset(), section.get_size())
+
+            if value is not None:
+                manifest.set_section_digests(index, value)
+                digest_values[name] = value
+
+        if len(written_sections) != 0 and len(digests) != 0:
+            with open(image_path, 'r+b') as file_desc:
+                self.__write_digests(file_desc, sections, digest_values)
+
+
+    def __write_digests(self, file_desc: BinaryIO, sections: list, digest_values: dict):
+        # Write again the sections storing digests, now that they are known. The file starts
+        # with the first section.
+        for section in sections:
+            if len(section.get_digested_sections()) == 0:
+                continue
+
+            self.__set_section_digests(section, digest_values)
+            try:
+                file_desc.seek(section.get_offset() - sections[0].get_offset())
+                writer = ImageWriter(file_desc, sparse=False, erased_value=self.get_erased_value())
+                with _section_span('section digests write', section, bytes=section.get_size()):
+                    section.write_image(writer)
+                writer.close()
+            finally:
+                section.set_digests(None)
+
+
+    @staticmethod
+    def __set_section_digests(section: FlashSection, digest_values: dict):
+        # Sections which are not part of the generated image, like trailing empty ones, do not
+        # have digests
+        section.set_digests([digest_values.get(digested.get_name())
+            for digested in section.get_digested_sections()])
+
+
+    @staticmethod
+    def __get_digested_names(sections: list) -> set:
+        # Return the names of the sections whose digests are stored by other sections
+        names = set(section.get_name() for section in sections)
+        result = set()
+        for section in sections:
+            for digested in section.get_digested_sections():
+                if digested.get_name() in names:
+                    result.add(digested.get_name())
+        return result
+
+
+    @staticmethod
+    def __write_image_section(image_path: str, section: FlashSection, image_offset: int,
+            sparse: bool, section_digest: SectionDigest=None):
+        # Each section uses its own file descriptor so that sections can be written concurrently
+        with open(image_path, 'r+b') as file_desc:
+            file_desc.seek(section.get_offset() - image_offset)
+            writer = ImageWriter(file_desc, sparse=sparse,
+                erased_value=section.get_flash().get_erased_value())
+            if section_digest is not None:
+                writer.add_digest(section_digest)
+            with _section_span('section write', section, bytes=section.get_size()):
+                section.write_image(writer)
+            writer.close()
+
 
     def get_image(self, first: int=None, last: int=None) -> bytes:
         """Return the content of the flash.
@@ -747,7 +1257,44 @@ class Flash():
         last: int
             The index of the last section until which the image must be generated
         """
-        result = bytearray()
+        self.__parse_content()
+
+        if first is None:
+            first = 0
+
+        if last is None:
+            last = len(self.sections)
+
+        sections = list(self.sections.values())[first:last+1]
+        digests = {name: SectionDigest() for name in self.__get_digested_names(sections)}
+
+        file_desc = io.BytesIO()
+        writer = ImageWriter(file_desc, sparse=False, erased_value=self.get_erased_value())
+        self.write_image(writer, first, last, digests=digests)
+        writer.close()
+
+        if len(digests) != 0:
+            self.__write_digests(file_desc, sections,
+                {name: digest.get() for name, digest in digests.items()})
+
+        return file_desc.getvalue()
+
+
+    def write_image(self, writer: ImageWriter, first: int=None, last: int=None,
+            digests: dict=None):
+        """Stream the content of the flash to the specified writer.
+
+        Parameters
+        ----------
+        writer : ImageWriter
+            The writer where the flash content is dumped.
+        first: int
+            The index of the first section from which the image must be generated
+        last: int
+            The index of the last section until which the image must be generated
+        digests: dict
+            SectionDigest to be updated with the content of some sections, by section name.
+        """
         self.__parse_content()
 
         if first is None:
@@ -763,11 +1310,20 @@ class Flash():
             if prev_section is not None:
                 padding = section.get_offset() - prev_section.get_offset() - \
                     prev_section.get_size()
-                result += bytearray(padding)
+                writer.write_uninitialized(padding)
+
+            section_digest = None
+            if digests is not None:
+                section_digest = digests.get(section.get_name())
+            if section_digest is not None:
+                writer.add_digest(section_digest)
+
+            with _section_span('section write', section, bytes=section.get_size()):
+                section.write_image(writer)
 
-            result += section.get_image()
+            if section_digest is not None:
+                writer.remove_digest(section_digest)
             prev_section = section
-        return result
 
 
     def get_image_path(self) -> str:
@@ -781,6 +1337,59 @@ class Flash():
         return self.target.get_abspath(self.get_image_name())
 
 
+    def get_manifest_path(self) -> str:
+        """Return the path of the manifest describing how the flash image was generated.
+
+        Returns
+        -------
+        str
+            The manifest file path.
+        """
+        return os.path.splitext(self.get_image_path())[0] + '-manifest.json'
+
+
+    def set_jobs(self, jobs: int):
+        """Set the number of jobs used to generate the flash content.
+
+        Sections are independent once the layout is known, so their payloads can be built and
+        written concurrently. The generated images are the same whatever the number of jobs.
+
+        Parameters
+        ----------
+        jobs : int
+            Maximum number of sections processed concurrently.
+        """
+        self.jobs = jobs
+
+
+    def set_image_store(self, image_store: 'gapylib.image_store.ImageStore'):
+        """Set the store where generated images are shared with other work directories.
+
+        Images whose content was already generated are then taken from the store instead of
+        being generated again.
+
+        Parameters
+        ----------
+        image_store : gapylib.image_store.ImageStore
+            The image store, or None to always generate images.
+        """
+        self.image_store = image_store
+
+
+    def set_incremental(self, incremental: bool):
+        """Enable or disable incremental image generation.
+
+        When it is enabled, only the sections which changed since the previous generation are
+        written to the image.
+
+        Parameters
+        ----------
+        incremental : bool
+            True to enable incremental generation.
+        """
+        self.incremental = incremental
+
+
     def set_content(self, content_dict: dict):
         """Set the content of the flash.
 
@@ -831,6 +1440,31 @@ class Flash():
         self.flash_attributes[name] = value
 
 
+    def get_erased_value(self) -> int:
+        """Get the value of the bytes of an erased flash.
+
+        This is given by the erased_value flash attribute, for example 0xff for NOR flashes, and
+        is used for the uninitialized regions of the image. It is 0 by default.
+
+        Returns
+        -------
+        int
+            The byte value.
+        """
+        value = self.get_flash_attribute('erased_value')
+        if value is None:
+            return 0
+
+        # Value is a string to be converted if it comes from command-line
+        if isinstance(value, str):
+            value = int(value, 0)
+
+        if value < 0 or value > 0xff:
+            raise RuntimeError(f'Invalid erased value for flash {self.name}: 0x{value:x}')
+
+        return value
+
+
     def get_size(self) -> int:
         """Get flash size.
 
@@ -902,7 +1536,18 @@ class Flash():
 
 
     def __get_section_template(self, template_name: str) -> FlashSection:
-        return self.sections_templates.get(template_name)
+        section_template = self.sections_templates.get(template_name)
+
+        if isinstance(section_template, str):
+            module_name, class_name = section_template.split(':')
+            try:
+                section_template = getattr(importlib.import_module(module_name), class_name)
+            except (ImportError, AttributeError) as exc:
+                raise RuntimeError(f'Unable to load section template {template_name} from '
+                    f'{section_template}: {exc}') from exc
+            self.sections_templates[template_name] = section_template
+
+        return section_template
 
 
     def __parse_content(self, check_overflow: bool=True):
@@ -911,61 +1556,76 @@ class Flash():
         if not self.content_parsed and self.content_dict is not None:
             self.content_parsed = True
 
+            with gapylib.trace.span('flash parse content', flash=self.name):
+                self.__parse_sections(check_overflow)
+
 
-            # Now create all the sections
-            if self.content_dict.get('sections') is not None:
-                for content_section in self.content_dict.get('sections'):
+    def __parse_sections(self, check_overflow: bool):
+        # Now create all the sections
+        if self.content_dict.get('sections') is not None:
+            for content_section in self.content_dict.get('sections'):
 
-                    if content_section.get('name') is None:
-                        raise RuntimeError("Section does not have any name:\n" +  \
-                            json.dumps(content_section, indent=4))
+                if content_section.get('name') is None:
+                    raise RuntimeError("Section does not have any name:\n" +  \
+                        json.dumps(content_section, indent=4))
 
-                    if content_section.get('template') is None:
-                        raise RuntimeError("Section does not have any template:\n" + \
-                            json.dumps(content_section, indent=4))
+                if content_section.get('template') is None:
+                    raise RuntimeError("Section does not have any template:\n" + \
+                        json.dumps(content_section, indent=4))
 
-                    section_template = self.__get_section_template(content_section.get('template'))
+                section_template = self.__get_section_template(content_section.get('template'))
 
-                    if section_template is None:
-                        raise RuntimeError("Unknown section template: " + \
-                            content_section.get('template'))
+                if section_template is None:
+                    raise RuntimeError("Unknown section template: " + \
+                        content_section.get('template'))
 
-                    section = section_template(self, content_section.get('name'),
-                        len(self.sections))
-                    self.sections[content_section.get('name')] = section
+                section = section_template(self, content_section.get('name'),
+                    len(self.sections))
+                self.sections[content_section.get('name')] = section
 
-            # Take the properties set from command-line and overwrite the ones from
-            # the content
-            self.__handle_section_properties()
+        # Take the properties set from command-line and overwrite the ones from
+        # the content
+        self.__handle_section_properties()
 
-            # And finally set the content of each section and give it its starting offset
-            if self.content_dict.get('sections') is not None:
-                flash_offset = 0
-                section_start_align = self.get_flash_attribute('section_start_align')
-                section_size_align = self.get_flash_attribute('section_size_align')
+        # And finally set the content of each section and give it its starting offset
+        if self.content_dict.get('sections') is not None:
+            flash_offset = 0
+            section_start_align = self.get_flash_attribute('section_start_align')
+            section_size_align = self.get_flash_attribute('section_size_align')
 
-                for content_section in self.content_dict.get('sections'):
-                    section = self.sections[content_section.get('name')]
+            for content_section in self.content_dict.get('sections'):
+                section = self.sections[content_section.get('name')]
 
-                    section.set_alignments(section_start_align, section_size_align)
+                section.set_alignments(section_start_align, section_size_align)
+                with _section_span('section set_content', section):
                     section.set_content(flash_offset, content_section)
-                    flash_offset = section.get_offset() + section.get_size()
-
-                    if flash_offset > self.size:
-                        if check_overflow:
-                            raise RuntimeError(
-                                f'Section "{section.get_name()}" overflowed flash "{self.name}",'
-                                f' flash size is 0x{self.size:x}, current content size is'
-                                f' 0x{flash_offset:x}.')
-                        break
-
-            # And finally set the content of each section and give it its starting offset
-            if self.content_dict.get('sections') is not None:
-                flash_offset = 0
-                for content_section in self.content_dict.get('sections'):
-                    section = self.sections[content_section.get('name')]
+                flash_offset = section.get_offset() + section.get_size()
+
+                if flash_offset > self.size:
+                    if check_overflow:
+                        raise RuntimeError(
+                            f'Section "{section.get_name()}" overflowed flash "{self.name}",'
+                            f' flash size is 0x{self.size:x}, current content size is'
+                            f' 0x{flash_offset:x}.')
+                    break
+
+        # And finally set the content of each section and give it its starting offset
+        if self.content_dict.get('sections') is not None:
+            flash_offset = 0
+            for content_section in self.content_dict.get('sections'):
+                section = self.sections[content_section.get('name')]
+                with _section_span('section finalize', section):
                     section.finalize()
 
+        # Now that the layout is fixed, the section payloads can be built independently
+        run_parallel(self.jobs, self.__materialize_section, self.sections.values())
+
+
+    @staticmethod
+    def __materialize_section(section: FlashSection):
+        with _section_span('section materialize', section):
+            section.materialize()
+
 
     def __handle_section_properties(self):
         property_sections = self.properties
@@ -21,17 +21,29 @@
 
 
 
+import json
+import logging
 import os.path
 import shutil
+import threading
 from gapylib.flash import FlashSection, Flash
+from gapylib.parallel import run_parallel
+import gapylib.trace
+from gapylib.utils import clone_file, hash_file
 
 
+# Version of the sync manifest, all files are copied again if it changes
+HOSTFS_MANIFEST_VERSION = 1
 
 
 class HostfsSection(FlashSection):
     """
     Class for generating a hostfs section.
 
+    The files are synchronized to the work directory: a manifest records what was copied, so
+    that only the files which changed since the last invocation are copied again, and the files
+    which are no longer listed are removed.
+
     Attributes
     ----------
     parent: gapylib.flash.Flash
@@ -45,10 +57,24 @@ class HostfsSection(FlashSection):
     def __init__(self, parent: Flash, name, section_id: int):
         super().__init__(parent, name, section_id)
 
+        self.hash = False
+        self.hardlink = False
+
         self.declare_property(name='files', value=[],
             description="List of files to be included in the HostFS."
         )
 
+        self.declare_property(name='hash', value=False,
+            description="Compare the content of the files whose size or modification time "
+                "changed, to avoid copying files which were only touched."
+        )
+
+        self.declare_property(name='hardlink', value=False,
+            description="Use hardlinks when files can not be cloned. The work directory then "
+                "shares the files with the host, which is only safe if the target does not "
+                "modify them."
+        )
+
 
     def set_content(self, offset: int, content_dict: dict):
         """Set the content of the section.
@@ -62,8 +88,136 @@ class HostfsSection(FlashSection):
         """
         super().set_content(offset, content_dict)
 
+        self.hash = self.get_property('hash')
+        self.hardlink = self.get_property('hardlink')
+
         # Get the list of files from the properties and determine basenames from the path, which
-        # will be used as name in the readfs
+        # will be used as name in the hostfs. The last file wins if several have the same name.
+        files = {}
         for file in content_dict.get('properties').get('files'):
-            abspath = self.get_flash().get_target().get_abspath(os.path.basename(file))
-            shutil.copy(file, abspath)
+            files[os.path.basename(file)] = os.path.abspath(file)
+
+        with gapylib.trace.span('hostfs sync', section=self.get_name()):
+            self.__sync(files)
+
+
+    def get_manifest_path(self) -> str:
+        """Return the path of the manifest describing the files copied to the work directory.
+
+        Returns
+        -------
+        str
+            The manifest file path.
+        """
+        return os.path.splitext(self.get_image_path())[0] + '-manifest.json'
+
+
+    def __sync(self, files: dict):
+        manifest_path = self.get_manifest_path()
+        previous = self.__load_manifest(manifest_path)
+        target = self.get_flash().get_target()
+
+        entries = {}
+        changed = []
+        for name, path in files.items():
+            try:
+                stat = os.stat(path)
+            except OSError as exc:
+                raise RuntimeError(f'Unable to access file {path}: {exc}') from exc
+
+            entry = previous.get(name)
+            dst_path = target.get_abspath(name)
+            if entry is not None and entry['path'] == path and entry['size'] == stat.st_size \
+                    and entry['mtime'] == stat.st_mtime_ns and self.__is_intact(entry, dst_path):
+                entries[name] = entry
+            else:
+                changed.append([name, path, stat, dst_path, entry])
+
+        for entry in run_parallel(self.get_flash().jobs, self.__sync_file, changed):
+            entries[entry['name']] = entry
+
+        # Only the files copied by a previous invocation are removed, not the other ones which
+        # may be in the work directory
+        for name in previous.keys():
+            if name not in entries:
+                logging.debug('Removing stale hostfs file %s', name)
+                try:
+                    os.remove(target.get_abspath(name))
+                except OSError:
+                    pass
+
+        if entries != previous:
+            self.__save_manifest(manifest_path, entries)
+
+
+    def __sync_file(self, item: list) -> dict:
+        name, path, stat, dst_path, entry = item
+
+        with gapylib.trace.span('hostfs sync file', path=path) as span:
+            file_hash = None
+            if self.hash:
+                file_hash = hash_file(path)
+
+                # The file was only touched, just update its modification time in the manifest
+                if entry is not None and entry['path'] == path and entry['hash'] == file_hash \
+                        and self.__is_intact(entry, dst_path):
+                    span.set_arg('copied', False)
+                    return dict(entry, size=stat.st_size, mtime=stat.st_mtime_ns)
+
+            tmp_path = f'{dst_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                clone_file(path, tmp_path, hardlink=self.hardlink)
+                shutil.copymode(path, tmp_path)
+                os.replace(tmp_path, dst_path)
+                dst_stat = os.stat(dst_path)
+            except OSError as exc:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise RuntimeError(f'Unable to copy file {path} to {dst_path}: {exc}') from exc
+
+            span.set_arg('copied', True)
+            span.set_arg('bytes', stat.st_size)
+
+        return {
+            'name': name, 'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+            'hash': file_hash, 'dst_size': dst_stat.st_size, 'dst_mtime': dst_stat.st_mtime_ns
+        }
+
+
+    @staticmethod
+    def __is_intact(entry: dict, dst_path: str) -> bool:
+        # Check the copy was not modified or removed since it was done, for example by the target
+        try:
+            stat = os.stat(dst_path)
+        except OSError:
+            return False
+        return stat.st_size == entry['dst_size'] and stat.st_mtime_ns == entry['dst_mtime']
+
+
+    @staticmethod
+    def __load_manifest(path: str) -> dict:
+        try:
+            with open(path, 'r', encoding='utf-8') as file_desc:
+                manifest = json.load(file_desc)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(manifest, dict) or manifest.get('version') != HOSTFS_MANIFEST_VERSION:
+            return {}
+
+        return manifest.get('files', {})
+
+
+    @staticmethod
+    def __save_manifest(path: str, entries: dict):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as file_desc:
+                json.dump({'version': HOSTFS_MANIFEST_VERSION, 'files': entries}, file_desc,
+                    indent=4)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            # The manifest is just an optimization, everything is copied again next time
+            logging.debug('Unable to write hostfs manifest %s: %s', path, exc)
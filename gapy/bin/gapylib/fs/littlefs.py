@@ -21,17 +21,323 @@
 
 
 
-import logging
-import shlex
-import subprocess
+import os
+import struct
 from gapylib.flash import FlashSection, Flash
-from gapylib.utils import CStruct, CStructParent
+import gapylib.trace
+from gapylib.crc import compute_crc
+from gapylib.utils import CStruct, CStructParent, CStructExtentArray
+
+
+# On-disk version of the generated images. 2.0 can be mounted by any 2.x LittleFS, newer ones
+# upgrade it on their first write
+LFS_DISK_VERSION = 0x00020000
+# Limits recorded in the superblock, which are the LittleFS defaults
+LFS_NAME_MAX = 255
+LFS_FILE_MAX = 2147483647
+LFS_ATTR_MAX = 1022
+# Program size the commits are aligned to, which is the one mklfs was used with
+LFS_PROG_SIZE = 16
+
+# Metadata tag types
+_LFS_TYPE_REG = 0x001
+_LFS_TYPE_DIR = 0x002
+_LFS_TYPE_SUPERBLOCK = 0x0ff
+_LFS_TYPE_DIRSTRUCT = 0x200
+_LFS_TYPE_INLINESTRUCT = 0x201
+_LFS_TYPE_CTZSTRUCT = 0x202
+_LFS_TYPE_CRC = 0x500
+_LFS_TYPE_SOFTTAIL = 0x600
+_LFS_TYPE_HARDTAIL = 0x601
+
+# Id of the tags which are not attached to an entry
+_LFS_ID_NONE = 0x3ff
+# Maximum number of entries of a metadata pair, above which LittleFS splits it
+_LFS_PAIR_MAX_ENTRIES = 0xfe
+# Size of a tag
+_LFS_TAG_SIZE = 4
+# Size of the struct tags of files and directories, with their data
+_LFS_STRUCT_SIZE = _LFS_TAG_SIZE + 8
+# Size of the superblock entry, made of its name and inline struct tags
+_LFS_SUPERBLOCK_SIZE = _LFS_TAG_SIZE + 8 + _LFS_TAG_SIZE + 24
+# Size of the revision count at the beginning of metadata blocks
+_LFS_REV_SIZE = 4
+
+
+def _lfs_tag(tag_type: int, tag_id: int, size: int) -> int:
+    return (tag_type << 20) | (tag_id << 10) | size
+
+
+def _lfs_ctz(value: int) -> int:
+    return (value & -value).bit_length() - 1
+
+
+class _LfsDir():
+    # Directory of the generated image. Entries are [name, host path, size, directory] lists,
+    # sorted by name, where directory is None for files. Each directory is stored in one or
+    # several metadata pairs, each one holding a group of entries.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = []
+        self.groups = []
+        self.pairs = []
+
+
+class LfsImageBuilder():
+    """
+    Builder of LittleFS images from a host directory.
+
+    The image is generated in a single pass, as if the directory content had been copied to a
+    freshly formatted file system: each directory is compacted into its own metadata pairs,
+    all linked together with tails, and file contents are stored as CTZ skip-lists in
+    consecutive blocks. File contents are never read, they are appended to the image as ranges
+    of the host files.
+
+    Attributes
+    ----------
+    block_size : int
+        Size of the file system blocks.
+    block_count : int
+        Number of blocks of the file system.
+    erased_value : int
+        Value of the bytes of an erased flash, which is needed to mark the end of commits.
+    """
+
+    def __init__(self, block_size: int, block_count: int, erased_value: int):
+        self.block_size = block_size
+        self.block_count = block_count
+        self.erased_value = erased_value
+        # Host files whose content is part of the image
+        self.host_files = []
+
+        # LittleFS splits a metadata pair when its compacted commit exceeds this size, so that
+        # there is room left for the next commits
+        self.pair_limit = min(block_size - 36,
+            (block_size // 2 + LFS_PROG_SIZE - 1) & ~(LFS_PROG_SIZE - 1))
+
+
+    def build(self, root_dir: str, field: CStructExtentArray):
+        """Generate the image of a host directory.
+
+        Parameters
+        ----------
+        root_dir : str
+            Host directory whose content becomes the content of the file system.
+        field : CStructExtentArray
+            Field where the image is appended.
+        """
+        root = self.__scan(root_dir)
+
+        directories = []
+        self.__get_directories(root, directories)
+
+        next_block = 0
+        for directory in directories:
+            self.__split(directory, directory is root)
+            for _ in directory.groups:
+                directory.pairs.append([next_block, next_block + 1])
+                next_block += 2
+
+        files = []
+        for directory in directories:
+            for entry in directory.entries:
+                if entry[3] is None and entry[2] != 0:
+                    nb_blocks = self.__get_nb_blocks(entry[2])
+                    files.append([entry, next_block, nb_blocks])
+                    entry.append(next_block + nb_blocks - 1)
+                    next_block += nb_blocks
+
+        if next_block > self.block_count:
+            raise RuntimeError(f'Content of {root_dir} does not fit into LittleFS image '
+                f'({next_block} blocks needed, {self.block_count} available)')
+
+        for index, directory in enumerate(directories):
+            next_dir = directories[index + 1] if index + 1 < len(directories) else None
+            for group_index, group in enumerate(directory.groups):
+                if group_index + 1 < len(directory.groups):
+                    tail = [_LFS_TYPE_HARDTAIL, directory.pairs[group_index + 1]]
+                elif next_dir is not None:
+                    tail = [_LFS_TYPE_SOFTTAIL, next_dir.pairs[0]]
+                else:
+                    tail = None
+
+                commit = self.__get_commit(group, tail, directory is root and group_index == 0)
+                field.add_bytes(commit)
+                # The second block of the pair is only used by the next compaction
+                field.add_uninitialized(2 * self.block_size - len(commit))
+
+        for entry, first_block, nb_blocks in files:
+            self.__add_file(field, entry, first_block, nb_blocks)
+
+
+    def __scan(self, path: str) -> _LfsDir:
+        directory = _LfsDir(path)
+
+        try:
+            host_entries = list(os.scandir(path))
+        except OSError as exc:
+            raise RuntimeError(f'Unable to read directory {path}: {exc}') from exc
+
+        for host_entry in host_entries:
+            name = os.fsencode(host_entry.name)
+            if len(name) > LFS_NAME_MAX:
+                raise RuntimeError(f'File name too long for LittleFS: {host_entry.path}')
+
+            try:
+                if host_entry.is_dir():
+                    # Directory links are not followed to avoid loops
+                    if not host_entry.is_symlink():
+                        directory.entries.append([name, host_entry.path, 0,
+                            self.__scan(host_entry.path)])
+                else:
+                    size = host_entry.stat().st_size
+                    if size > LFS_FILE_MAX:
+                        raise RuntimeError(f'File too big for LittleFS: {host_entry.path}')
+                    directory.entries.append([name, host_entry.path, size, None])
+                    if size != 0:
+                        self.host_files.append(host_entry.path)
+            except OSError as exc:
+                raise RuntimeError(f'Unable to access file {host_entry.path}: {exc}') from exc
+
+        # Same order as the one LittleFS uses to insert entries
+        directory.entries.sort(key=lambda entry: entry[0])
+
+        return directory
+
+
+    def __get_directories(self, directory: _LfsDir, directories: list):
+        directories.append(directory)
+        for entry in directory.entries:
+            if entry[3] is not None:
+                self.__get_directories(entry[3], directories)
+
+
+    def __get_commit_size(self, size: int) -> int:
+        # Size of a commit whose tags take the specified size, including the revision count and
+        # the CRC tag, which is aligned to the program size
+        size += _LFS_REV_SIZE + 2 * _LFS_TAG_SIZE
+        return (size + LFS_PROG_SIZE - 1) & ~(LFS_PROG_SIZE - 1)
+
+
+    def __split(self, directory: _LfsDir, is_root: bool):
+        # Split the directory entries into groups fitting into metadata pairs. The tail is always
+        # counted since the last pair may point to the next directory.
+        base_size = _LFS_TAG_SIZE + 8
+        if is_root:
+            base_size += _LFS_SUPERBLOCK_SIZE
+
+        group = []
+        size = base_size
+        for entry in directory.entries:
+            entry_size = _LFS_TAG_SIZE + len(entry[0])
+            if entry[3] is not None or entry[2] != 0:
+                entry_size += _LFS_STRUCT_SIZE
+            else:
+                entry_size += _LFS_TAG_SIZE
+
+            if len(group) != 0 and (len(group) == _LFS_PAIR_MAX_ENTRIES or
+                    self.__get_commit_size(size + entry_size) > self.pair_limit):
+                directory.groups.append(group)
+                group = []
+                size = _LFS_TAG_SIZE + 8
+
+            if self.__get_commit_size(size + entry_size) > self.block_size - 36:
+                raise RuntimeError(f'LittleFS block size {self.block_size} is too small for '
+                    f'{entry[1]}')
+
+            group.append(entry)
+            size += entry_size
+
+        directory.groups.append(group)
+
+
+    def __get_commit(self, group: list, tail: list, is_root: bool) -> bytes:
+        # Generate the compacted commit of a metadata pair
+        tags = []
+        first_id = 0
+        if is_root:
+            tags.append([_lfs_tag(_LFS_TYPE_SUPERBLOCK, 0, 8), b'littlefs'])
+            tags.append([_lfs_tag(_LFS_TYPE_INLINESTRUCT, 0, 24), struct.pack('<IIIIII',
+                LFS_DISK_VERSION, self.block_size, self.block_count, LFS_NAME_MAX,
+                LFS_FILE_MAX, LFS_ATTR_MAX)])
+            first_id = 1
+
+        for entry_id, entry in enumerate(group, start=first_id):
+            name, _, size, directory = entry[:4]
+            if directory is not None:
+                tags.append([_lfs_tag(_LFS_TYPE_DIR, entry_id, len(name)), name])
+                tags.append([_lfs_tag(_LFS_TYPE_DIRSTRUCT, entry_id, 8),
+                    struct.pack('<II', *directory.pairs[0])])
+            else:
+                tags.append([_lfs_tag(_LFS_TYPE_REG, entry_id, len(name)), name])
+                if size == 0:
+                    tags.append([_lfs_tag(_LFS_TYPE_INLINESTRUCT, entry_id, 0), b''])
+                else:
+                    tags.append([_lfs_tag(_LFS_TYPE_CTZSTRUCT, entry_id, 8),
+                        struct.pack('<II', entry[4], size)])
+
+        if tail is not None:
+            tags.append([_lfs_tag(tail[0], _LFS_ID_NONE, 8), struct.pack('<II', *tail[1])])
+
+        commit = bytearray(struct.pack('<I', 1))
+        ptag = 0xffffffff
+        for tag, data in tags:
+            commit += struct.pack('>I', tag ^ ptag)
+            commit += data
+            ptag = tag
+
+        # The CRC tag covers the padding up to the next program unit, and tells which value of
+        # the valid bit the next commit, which is read from erased flash, is invalid with
+        end = self.__get_commit_size(len(commit) - _LFS_REV_SIZE)
+        reset = (~self.erased_value & 0xff) >> 7
+        tag = _lfs_tag(_LFS_TYPE_CRC + reset, _LFS_ID_NONE, end - len(commit) - _LFS_TAG_SIZE)
+        commit += struct.pack('>I', tag ^ ptag)
+        # LittleFS CRC has no final inversion
+        commit += struct.pack('<I', compute_crc(0xffffffff, commit) ^ 0xffffffff)
+
+        return bytes(commit)
+
+
+    def __get_block_capacity(self, index: int) -> int:
+        # Each block of a CTZ skip-list starts with pointers to the blocks index - 2^n, for n from
+        # 0 to ctz(index), except the first one
+        if index == 0:
+            return self.block_size
+        return self.block_size - 4 * (_lfs_ctz(index) + 1)
+
+
+    def __get_nb_blocks(self, size: int) -> int:
+        index = 0
+        while True:
+            size -= self.__get_block_capacity(index)
+            if size <= 0:
+                return index + 1
+            index += 1
+
+
+    def __add_file(self, field: CStructExtentArray, entry: list, first_block: int,
+            nb_blocks: int):
+        path, size = entry[1], entry[2]
+        offset = 0
+        for index in range(0, nb_blocks):
+            if index != 0:
+                field.add_bytes(struct.pack(f'<{_lfs_ctz(index) + 1}I',
+                    *[first_block + index - (1 << skip)
+                        for skip in range(0, _lfs_ctz(index) + 1)]))
+
+            capacity = self.__get_block_capacity(index)
+            data_size = min(capacity, size - offset)
+            field.add_file(path, offset, data_size)
+            offset += data_size
+
+            if data_size < capacity:
+                field.add_uninitialized(capacity - data_size)
 
 
 class LfsHeader(CStruct):
     """
-    Class for generating readfs sub-section containing the main header.
-    This header contains global information like number of files.
+    Class for generating the lfs sub-section containing the file system image.
 
     Attributes
     ----------
@@ -39,12 +345,12 @@ class LfsHeader(CStruct):
         Name of this sub-section.
 
     parent : str
-        Parent, which is aggregating all readfs sub-sections.
+        Parent, which is aggregating all lfs sub-sections.
     """
     def __init__(self, name: str, parent: CStructParent, size: int):
         super().__init__(name, parent)
 
-        self.add_field_array('data', size)
+        self.add_field_extent_array('data', size)
 
 
 class LfsSection(FlashSection):
@@ -71,6 +377,8 @@ class LfsSection(FlashSection):
 
         self.img_path = None
         self.ext_img = None
+        self.header = None
+        self.host_files = []
 
         self.declare_property(name='root_dir', value=None,
             description="Workstation directory content to be included in the LittleFS."
@@ -94,9 +402,7 @@ class LfsSection(FlashSection):
         self.root_dir = content_dict.get('properties').get('root_dir')
         self.size = self.get_property('size')
         self.img_path = content_dict.get('properties').get('img_path')
-        if self.img_path is None:
-            self.img_path = self.parent.get_image_path() + '.' + self.get_name()
-        else:
+        if self.img_path is not None:
             self.ext_img = True
 
         # Size is a string to be converted if it comes from command-line
@@ -105,38 +411,45 @@ class LfsSection(FlashSection):
         if self.size == -1:
             self.size = self.parent.get_size() - self.get_offset()
 
-        block_size = self.parent.get_flash_attribute('littlefs_block_size')
-
         # Only initialize the FS if its size is not 0, otherwise keep it as an empty section
         if self.size > 0:
-            header = LfsHeader('header', parent=top_struct, size=self.size)
+            self.header = LfsHeader('header', parent=top_struct, size=self.size)
 
-            # Initialize the FS only if has a content since mklfs requires it. Otherwise, keep
-            # it as non-empty blank section, so that it can still be formatted at runtime
-            if self.root_dir is not None:
-                # Use mklfs to format the section with the specified folder
-                cmd = f'mklfs -b {block_size} -r 16 -p 16 -s {self.size} -i {self.img_path}'
+            if self.root_dir is None and self.ext_img is True:
+                try:
+                    img_size = os.path.getsize(self.img_path)
+                except OSError as exc:
+                    raise RuntimeError(f'Unable to access file {self.img_path}: {exc}') from exc
 
-                cmd += f' -c {self.root_dir}'
+                self.header.get_field('data').add_file(self.img_path, 0,
+                    min(img_size, self.size))
+                self.host_files = [self.img_path]
 
-                logging.debug('Generating LittleFS images with command:')
-                logging.debug('  %s', cmd)
 
-                proc = subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE)
+    def materialize(self):
+        # Initialize the FS only if has a content. Otherwise, keep it as non-empty blank section,
+        # so that it can still be formatted at runtime
+        if self.header is None or self.root_dir is None:
+            return
+
+        block_size = self.parent.get_flash_attribute('littlefs_block_size')
+        if block_size is None:
+            raise RuntimeError('The littlefs_block_size flash attribute is needed to generate '
+                f'LittleFS section {self.get_name()}')
+        if isinstance(block_size, str):
+            block_size = int(block_size, 0)
+
+        builder = LfsImageBuilder(block_size, self.size // block_size,
+            self.get_flash().get_erased_value())
 
-                for line in proc.stdout.splitlines():
-                    logging.debug('mklfs: %s', line.decode("utf-8"))
+        with gapylib.trace.span('lfs build', section=self.get_name(), bytes=self.size):
+            builder.build(self.root_dir, self.header.get_field('data'))
 
-                if proc.returncode != 0:
-                    raise RuntimeError('Failed to create LFS image file')
+        self.host_files = builder.host_files
 
-                # Mklfs will dump it to a file, redump it to the flash image
-                with open(self.img_path, 'rb') as file_desc:
-                    header.set_field('data', file_desc.read())
 
-            elif self.ext_img is True:
-                with open(self.img_path, 'rb') as file_desc:
-                    header.set_field('data', file_desc.read())
+    def get_host_files(self) -> list:
+        return self.host_files
 
 
     def is_empty(self):
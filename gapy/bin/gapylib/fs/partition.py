@@ -22,10 +22,23 @@
 
 
 import dataclasses
-from gapylib.flash import FlashSection
+import hashlib
+import struct
+from gapylib.crc import compute_crc
+from gapylib.flash import FlashSection, SectionDigest
 from gapylib.utils import CStruct, CStructParent
 
 
+# Magic number of the partition table header
+PARTITION_TABLE_MAGIC = 0x02BA
+# Magic number of the partition headers
+PARTITION_MAGIC = 0x01BA
+
+_HEADER = struct.Struct('<HBBB7sI16s')
+_PARTITION_HEADER = struct.Struct('<HBBII16sI')
+_PARTITION_DIGEST = struct.Struct('<16sI')
+
+
 
 @dataclasses.dataclass
 class PartitionTableHeader(CStruct):
@@ -53,8 +66,10 @@ class PartitionTableHeader(CStruct):
         # 1 if MD5 sum of sections is enabled
         self.add_field('crc', 'B')
         # Unused, just for padding
-        self.add_field_array('padding', 11)
-        # MD5 sum of all the sections
+        self.add_field_array('padding', 7)
+        # CRC32 of the table, which covers the digests of all the sections
+        self.add_field('crc32', 'I')
+        # MD5 sum of the table, which covers the digests of all the sections
         self.add_field_array('md5', 16)
 
 
@@ -93,6 +108,30 @@ class PartitionTableSectionHeader(CStruct):
 
 
 
+@dataclasses.dataclass
+class PartitionTableSectionDigest(CStruct):
+    """
+    Class for generating partition table sub-section containing the digests of a section.
+    These are only present if digests are enabled, after all the section headers.
+
+    Attributes
+    ----------
+    name : str
+        Name of this sub-section.
+
+    parent : str
+        Parent, which is aggregating all partition table sub-sections.
+    """
+    def __init__(self, name: str, parent: CStructParent):
+        super().__init__(name, parent)
+
+        # MD5 sum of the section
+        self.add_field_array('md5', 16)
+        # CRC32 of the section
+        self.add_field('crc32', 'I')
+
+
+
 class PartitionTableSection(FlashSection):
     """
     Class for generating a readfs section.
@@ -111,9 +150,16 @@ class PartitionTableSection(FlashSection):
         super().__init__(parent, name, section_id)
 
         self.section_headers = []
+        self.section_digests = []
         self.top_struct = None
         self.header = None
         self.sections = None
+        self.digests = False
+
+        self.declare_property(name='digests', value=False,
+            description="Store the MD5 and CRC32 of each partition and of the table, computed "
+                "while the image is written."
+        )
 
 
     def set_content(self, offset: int, content_dict: dict):
@@ -144,6 +190,13 @@ class PartitionTableSection(FlashSection):
             self.section_headers.append(
                 PartitionTableSectionHeader(f'section{i} header', parent=self.top_struct))
 
+        # The digests come after the headers so that the headers keep the same layout
+        self.digests = self.get_property('digests')
+        if self.digests:
+            for i, __ in enumerate(self.sections):
+                self.section_digests.append(
+                    PartitionTableSectionDigest(f'section{i} digest', parent=self.top_struct))
+
 
 
     def finalize(self):
@@ -164,6 +217,7 @@ class PartitionTableSection(FlashSection):
         self.header.set_field('magic_number', 0x02BA)
         self.header.set_field('partition_table_version', 1)
         self.header.set_field('nb_entries', len(sections))
+        self.header.set_field('crc', 1 if self.digests else 0)
 
         # Per-section header
         for i, section in enumerate(self.section_headers):
@@ -174,6 +228,34 @@ class PartitionTableSection(FlashSection):
             section.set_field('size', sections[i].get_size())
             section.set_field('name', sections[i].get_name().encode('utf-8') + bytes([0]))
 
+    def get_digested_sections(self) -> list:
+        if not self.digests:
+            return []
+        return self.sections
+
+    def set_digests(self, digests: list):
+        structs = [self.header] + self.section_headers + self.section_digests
+
+        self.header.set_field('md5', bytes(16))
+        self.header.set_field('crc32', 0)
+
+        if digests is None:
+            for section_digest in self.section_digests:
+                section_digest.set_field('md5', bytes(16))
+                section_digest.set_field('crc32', 0)
+            return
+
+        # Sections which are not part of the generated image get null digests
+        for section_digest, value in zip(self.section_digests, digests):
+            md5, crc32 = value if value is not None else [bytes(16), 0]
+            section_digest.set_field('md5', md5)
+            section_digest.set_field('crc32', crc32)
+
+        # The table digests are computed with their own fields set to 0
+        table = b''.join(cstruct.pack() for cstruct in structs)
+        self.header.set_field('md5', hashlib.md5(table).digest())
+        self.header.set_field('crc32', compute_crc(0xffffffff, table))
+
     def is_empty(self):
 
         # Partition table is considered empty in auto mode if all the partitions are considered
@@ -183,3 +265,105 @@ class PartitionTableSection(FlashSection):
                 return False
 
         return True
+
+
+
+class PartitionTableReader():
+    """
+    Host-side reader of the partition table of a flash image.
+
+    The table is parsed when the reader is created. The digests of the partitions are checked
+    by mapping the image, so that it is never copied into python buffers.
+
+    Attributes
+    ----------
+    path : str
+        Path of the flash image.
+    offset : int
+        Offset of the partition table in the flash.
+    base : int
+        Offset in the flash of the beginning of the image.
+    """
+
+    def __init__(self, path: str, offset: int=0, base: int=0):
+        self.path = path
+        self.offset = offset
+        self.base = base
+        self.partitions = []
+        self.has_digests = False
+        self.table = None
+        self.md5 = None
+        self.crc32 = None
+
+        try:
+            with open(path, 'rb') as file_desc:
+                self.__parse(file_desc)
+        except (OSError, struct.error) as exc:
+            raise RuntimeError(f'Unable to read partition table from {path}: {exc}') from exc
+
+    def get_partitions(self) -> list:
+        """Return the partitions.
+
+        Returns
+        -------
+        list
+            The partitions as dictionaries with name, type, subtype, offset and size.
+        """
+        return [{key: partition[key] for key in ['name', 'type', 'subtype', 'offset', 'size']}
+            for partition in self.partitions]
+
+    def verify(self):
+        """Verify the digests of the table and of all the partitions.
+
+        Partitions with null digests, which were not part of the generated image, are skipped.
+        """
+        if not self.has_digests:
+            raise RuntimeError(f'Partition table in {self.path} does not have digests')
+
+        if hashlib.md5(self.table).digest() != self.md5 or \
+                compute_crc(0xffffffff, self.table) != self.crc32:
+            raise RuntimeError(f'Invalid partition table in {self.path}: bad digests')
+
+        for partition in self.partitions:
+            # Partitions which were not part of the generated image can not be checked
+            if partition['md5'] == bytes(16) and partition['crc32'] == 0:
+                continue
+
+            md5, crc32 = SectionDigest.get_file_digests(self.path,
+                partition['offset'] - self.base, partition['size'])
+            if md5 != partition['md5'] or crc32 != partition['crc32']:
+                raise RuntimeError(f'Invalid partition {partition["name"]} in {self.path}: '
+                    'bad digests')
+
+    def __parse(self, file_desc):
+        file_desc.seek(self.offset - self.base)
+        header = file_desc.read(_HEADER.size)
+        magic, _, nb_entries, crc, _, self.crc32, self.md5 = _HEADER.unpack(header)
+        if magic != PARTITION_TABLE_MAGIC:
+            raise RuntimeError(f'Invalid partition table in {self.path}: bad magic number '
+                f'0x{magic:x}')
+
+        self.has_digests = crc != 0
+
+        headers = file_desc.read(_PARTITION_HEADER.size * nb_entries)
+        for index in range(0, nb_entries):
+            magic, part_type, subtype, offset, size, name, _ = \
+                _PARTITION_HEADER.unpack_from(headers, index * _PARTITION_HEADER.size)
+            if magic != PARTITION_MAGIC:
+                raise RuntimeError(f'Invalid partition table in {self.path}: bad magic number '
+                    f'0x{magic:x} for partition {index}')
+
+            self.partitions.append({
+                'name': name.split(b'\0', 1)[0].decode('utf-8', errors='replace'),
+                'type': part_type, 'subtype': subtype, 'offset': offset, 'size': size
+            })
+
+        digests = b''
+        if self.has_digests:
+            digests = file_desc.read(_PARTITION_DIGEST.size * nb_entries)
+            for index, partition in enumerate(self.partitions):
+                partition['md5'], partition['crc32'] = \
+                    _PARTITION_DIGEST.unpack_from(digests, index * _PARTITION_DIGEST.size)
+
+        # The table digests are computed with their own fields set to 0
+        self.table = header[:_HEADER.size - 20] + bytes(20) + headers + digests
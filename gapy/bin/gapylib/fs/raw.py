@@ -42,7 +42,9 @@ class RawHeader(CStruct):
     def __init__(self, name: str, parent: CStructParent, size: int):
         super().__init__(name, parent)
 
-        self.add_field_array('data', size)
+        # The content of raw sections is not known, leave it uninitialized so that nothing
+        # is allocated and it gets the erased value of the flash
+        self.add_field_reserved('data', size)
 
 
 
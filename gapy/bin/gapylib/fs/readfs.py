@@ -23,8 +23,86 @@
 
 import os.path
 import dataclasses
+import fnmatch
+import hashlib
+import struct
+import gapylib.compression
+from gapylib.cache import get_cache_dir
 from gapylib.flash import FlashSection, Flash
-from gapylib.utils import CStruct, CStructParent
+from gapylib.parallel import run_parallel, FILE_BATCH_SIZE
+from gapylib.utils import CStruct, CStructParent, compute_crc, hash_file
+
+
+#
+# The readfs starts with a header chain, made of the main header and of one header per file, and
+# fs_size gives the size of this chain. Readers scan it to find a file, and then use the file
+# header offset to get its content.
+#
+# Version 1 of the format can add an index right after the header chain, which is ignored by
+# readers not knowing it since file contents are found through their offset. The index starts
+# on the first 4 bytes boundary after the chain, with a header followed by one entry per file,
+# sorted by name hash and then by name:
+#
+#   index header:  magic ('RFSI'), version, nb_entries, CRC32 of the entries
+#   index entry:   FNV-1a hash of the name, offset of the file header in the section
+#
+# Looking-up a file is then a binary search on the hashes followed by a name comparison with
+# the file header, instead of a linear scan of the header chain.
+#
+# Several file headers can give the same content offset when files have the same content and
+# deduplication is enabled. With deduplication across sections, the offset can even be in a
+# previous readfs section of the flash, in which case it is negative and stored modulo 2^32,
+# so that adding it to the section address with 32 bits arithmetic gives the content address.
+#
+# Version 2 of the format is used when files are compressed. The version is given in the upper
+# 32 bits of fs_size, and each file header gets the codec and uncompressed size of the file
+# after name_len, file_size being the size of the content stored in flash. Files which do not
+# get smaller when compressed are stored as is with codec 0.
+#
+
+# Magic number of the index header, 'RFSI' in little endian
+READFS_INDEX_MAGIC = 0x49534652
+
+# Version of the readfs format introducing the index
+READFS_INDEX_VERSION = 1
+
+# Version of the readfs format introducing compression
+READFS_COMPRESSION_VERSION = 2
+
+# Deduplication modes, from the dedup property
+DEDUP_NONE = 'none'
+DEDUP_SECTION = 'section'
+DEDUP_FLASH = 'flash'
+
+# Format of an index entry
+READFS_INDEX_ENTRY = struct.Struct('<II')
+
+# Sizes of the main header, file header and index header, when read from an image
+_HEADER = struct.Struct('<QI')
+_FILE_HEADER = struct.Struct('<III')
+_FILE_HEADER_COMPRESSION = struct.Struct('<II')
+_INDEX_HEADER = struct.Struct('<IIII')
+
+
+def get_name_hash(name: str) -> int:
+    """Return the hash of a file name, as used in the readfs index.
+
+    This is the 32 bits FNV-1a hash of the name encoded in UTF-8, without the terminating 0.
+
+    Parameters
+    ----------
+    name : str
+        The file name in the readfs.
+
+    Returns
+    -------
+    int
+        The hash.
+    """
+    value = 0x811c9dc5
+    for byte in name.encode('utf-8'):
+        value = ((value ^ byte) * 0x01000193) & 0xffffffff
+    return value
 
 
 
@@ -70,22 +148,67 @@ class ReadfsFileHeader(CStruct):
 
     parent : str
         Parent, which is aggregating all readfs sub-sections.
+
+    compression : bool
+        True if the header describes the compression of the file.
     """
 
-    def __init__(self, name: str, name_len: int, parent: CStructParent):
+    def __init__(self, name: str, name_len: int, parent: CStructParent,
+            compression: bool=False):
         super().__init__(name, parent)
 
         # Offset in the flash where the file content is
         self.add_field('offset', 'I')
-        # Size of the file
+        # Size of the file, as stored in flash
         self.add_field('file_size', 'I')
         # Size of its name including the terminating 0.
         self.add_field('name_len', 'I')
+        if compression:
+            # Codec of the file content, 0 if it is not compressed
+            self.add_field('codec', 'I')
+            # Size of the file once decompressed
+            self.add_field('uncompressed_size', 'I')
         # Name of the file including the terminating 0.
         self.add_field_array('name', name_len)
 
 
 
+@dataclasses.dataclass
+class ReadfsIndex(CStruct):
+    """
+    Class for generating readfs sub-section containing the index of the files.
+
+    Attributes
+    ----------
+    name : str
+        Name of this sub-section.
+
+    nb_entries : int
+        Number of files in the index.
+
+    parent : str
+        Parent, which is aggregating all readfs sub-sections.
+    """
+
+    def __init__(self, name: str, nb_entries: int, parent: CStructParent):
+        super().__init__(name, parent)
+
+        # The index starts on the next 4 bytes boundary after the header chain
+        self.add_padding('padding', 4)
+        # Magic number telling that the index is present
+        self.add_field('magic', 'I')
+        # Version of the readfs format
+        self.add_field('version', 'I')
+        # Number of entries of the index, which is the number of files
+        self.add_field('nb_entries', 'I')
+        # CRC32 of the entries, so that a corrupted index is not used
+        self.add_field('entries_crc', 'I')
+        # Entries, sorted by name hash and name, each one with the name hash and the file header
+        # offset
+        self.add_field_array('entries', nb_entries * READFS_INDEX_ENTRY.size)
+
+
+
 @dataclasses.dataclass
 class ReadfsFile(CStruct):
     """
@@ -106,8 +229,8 @@ class ReadfsFile(CStruct):
     def __init__(self, name: str, size: int, parent: CStructParent):
         super().__init__(name, parent)
 
-        # File content
-        self.add_field_array('data', size)
+        # File content, only read from the host file when the image is written
+        self.add_field_file_array('data', size)
 
 
 
@@ -133,13 +256,55 @@ class ReadfsSection(FlashSection):
         self.files = []
         self.top_struct = None
         self.header = None
+        self.index = None
+        # Content of each file as stored in flash, as [codec, host path, data, size], the data
+        # being only there if the compressed content is not in a host file
+        self.contents = []
+        self.codec = gapylib.compression.CODEC_NONE
+        self.dedup = DEDUP_NONE
+        # Sub-section containing the content of each file, which is shared by files with the same
+        # content and may be in another section
+        self.file_contents = []
+        # Stored contents, as [codec, size, hash], of this section, for deduplication
+        self.content_keys = {}
+        # Index of the contents stored in this section, by codec and size, for deduplication
+        self.contents_by_size = {}
+        # Number of bytes saved by deduplication
+        self.dedup_saved = 0
 
         self.declare_property(name='files', value=[],
             description="List of files to be included in the ReadFS."
         )
 
         self.declare_property(name='dirs', value=[],
-            description="List of directories to be included in the ReadFS."
+            description="List of directories to be included in the ReadFS, with their "
+                "sub-directories."
+        )
+
+        self.declare_property(name='include', value=[],
+            description="Glob patterns of the files taken from the directories, matched against "
+                "their path in the directory. All files are taken if it is empty."
+        )
+
+        self.declare_property(name='exclude', value=[],
+            description="Glob patterns of the files and sub-directories skipped in the "
+                "directories, matched against their path in the directory."
+        )
+
+        self.declare_property(name='index', value=False,
+            description="True if an index of the files is added after the file headers, to "
+                "speed-up file look-ups. The readfs can still be read without using it."
+        )
+
+        self.declare_property(name='compression', value='none',
+            description="Codec used to compress the files, can be none or lz4. Files which do "
+                "not get smaller are stored uncompressed."
+        )
+
+        self.declare_property(name='dedup', value=DEDUP_NONE,
+            description="Deduplication of the file contents, can be none, section to store "
+                "identical contents once in the section, or flash to also share them with the "
+                "previous readfs sections of the flash having this mode."
         )
 
 
@@ -155,32 +320,40 @@ class ReadfsSection(FlashSection):
         """
         super().set_content(offset, content_dict)
 
+        jobs = self.get_flash().jobs
+
         # Get the list of files and directories from the properties and determine basenames from
         # the path, which will be used as name in the readfs
-        for file in content_dict.get('properties').get('files'):
+        files = []
+        for file in self.get_property('files'):
             if file.find(':') != -1:
                 ws_path, target_path = file.split(':')
-                self.file_paths.append(
-                    [os.path.join(target_path, os.path.basename(ws_path)), ws_path])
+                files.append([os.path.join(target_path, os.path.basename(ws_path)), ws_path])
             else:
-                self.file_paths.append([os.path.basename(file), file])
-
-
-        if content_dict.get('properties').get('dirs') is not None:
-            for directory in content_dict.get('properties').get('dirs'):
-                # The path is of the form <host_path>:<target_path>
-                # The second part is optional
-                target_directory = None
-                if directory.find(':') != -1:
-                    directory, target_directory = directory.split(':')
-
-                for file in os.listdir(directory):
-                    file_path = os.path.join(directory, file)
-                    if target_directory is not None:
-                        self.file_paths.append(
-                            [os.path.join(target_directory, file), file_path])
-                    else:
-                        self.file_paths.append([file, file_path])
+                files.append([os.path.basename(file), file])
+
+        self.file_paths = run_parallel(jobs, _stat_file, files, FILE_BATCH_SIZE)
+
+        if self.get_property('dirs') is not None:
+            include = _get_patterns(self.get_property('include'))
+            exclude = _get_patterns(self.get_property('exclude'))
+
+            for dir_files in run_parallel(jobs,
+                    lambda directory: _walk_dir(directory, include, exclude),
+                    self.get_property('dirs')):
+                self.file_paths += dir_files
+
+        self.codec = gapylib.compression.get_codec(self.get_property('compression'))
+        if self.codec == gapylib.compression.CODEC_NONE:
+            self.contents = [[self.codec, filepath, None, file_size]
+                for _, filepath, file_size in self.file_paths]
+        else:
+            cache_dir = get_cache_dir('compression')
+            self.contents = run_parallel(jobs,
+                lambda path: _compress_file(path[1], path[2], self.codec, cache_dir),
+                self.file_paths)
+            if cache_dir is not None:
+                gapylib.compression.trim_cache(cache_dir)
 
         # First declare the sub-sections so that the right offsets are computed
 
@@ -192,15 +365,16 @@ class ReadfsSection(FlashSection):
 
         # One header per file containig file size, name and flash offset
         for i, path in enumerate(self.file_paths):
-            filename, filepath = path
+            filename, _, _ = path
             self.file_headers.append(ReadfsFileHeader(f'file{i} header', len(filename)+1,
-                parent=self.top_struct))
+                parent=self.top_struct, compression=self.is_compressed()))
 
-        # File contents
-        for i, path in enumerate(self.file_paths):
-            filename, filepath = path
-            self.files.append(ReadfsFile(f'file{i}', os.path.getsize(filepath),
-                parent=self.top_struct))
+        # Optional index, after the header chain so that readers not knowing it ignore it
+        if self.get_property('index'):
+            self.index = ReadfsIndex('index', len(self.file_paths), parent=self.top_struct)
+
+        # File contents, identical contents being stored once if deduplication is enabled
+        self.__declare_contents(jobs)
 
 
 
@@ -211,23 +385,173 @@ class ReadfsSection(FlashSection):
         for file_header in self.file_headers:
             header_size += file_header.get_size()
 
+        if self.is_compressed():
+            header_size |= READFS_COMPRESSION_VERSION << 32
         self.header.set_field('fs_size', header_size)
-        self.header.set_field('nb_files', len(self.files))
+        self.header.set_field('nb_files', len(self.file_paths))
 
         for i, path in enumerate(self.file_paths):
-            filename, filepath = self.file_paths[i]
+            filename, _, file_size = path
+            codec, _, _, stored_size = self.contents[i]
             file_header = self.file_headers[i]
-            file = self.files[i]
+            file = self.file_contents[i]
 
             # Per-file header
-            file_header.set_field('offset', file.get_offset() - self.get_offset())
-            file_header.set_field('file_size', os.path.getsize(filepath))
+            file_header.set_field('offset', (file.get_offset() - self.get_offset()) & 0xffffffff)
+            file_header.set_field('file_size', stored_size)
             file_header.set_field('name_len', len(filename)+1)
+            if self.is_compressed():
+                file_header.set_field('codec', codec)
+                file_header.set_field('uncompressed_size', file_size)
             file_header.set_field('name', filename.encode('utf-8') + bytes([0]))
 
-            # Per-file content
-            with open(filepath, 'rb') as file_desc:
-                file.set_field('data', file_desc.read())
+        if self.index is not None:
+            entries = sorted(
+                [get_name_hash(filename), filename, file_header.get_offset() - self.get_offset()]
+                for (filename, _, _), file_header in zip(self.file_paths, self.file_headers))
+
+            entries = b''.join(READFS_INDEX_ENTRY.pack(name_hash, header_offset)
+                for name_hash, _, header_offset in entries)
+
+            self.index.set_field('magic', READFS_INDEX_MAGIC)
+            self.index.set_field('version', READFS_INDEX_VERSION)
+            self.index.set_field('nb_entries', len(self.file_paths))
+            self.index.set_field('entries_crc', compute_crc(0xffffffff, entries))
+            self.index.set_field('entries', entries)
+
+
+    def is_compressed(self) -> bool:
+        """Tell if the files are compressed.
+
+        Returns
+        -------
+        bool
+            True if the readfs uses the format with compressed files.
+        """
+        return self.codec != gapylib.compression.CODEC_NONE
+
+
+    def find_content(self, key: list) -> ReadfsFile:
+        """Find a content stored in this section.
+
+        This is used by the next sections of the flash to share their identical contents.
+
+        Parameters
+        ----------
+        key : list
+            The content as [codec, size, hash].
+
+        Returns
+        -------
+        ReadfsFile
+            The sub-section containing the content, or None if there is none.
+        """
+        for index in self.contents_by_size.get((key[0], key[1]), []):
+            if self.__get_content_key(index) == key:
+                return self.file_contents[index]
+        return None
+
+
+    def __declare_contents(self, jobs: int):
+        self.dedup = self.get_property('dedup')
+        if self.dedup not in [DEDUP_NONE, DEDUP_SECTION, DEDUP_FLASH]:
+            raise RuntimeError(f'Invalid dedup property {self.dedup} in section '
+                f'{self.get_name()}, must be {DEDUP_NONE}, {DEDUP_SECTION} or {DEDUP_FLASH}')
+
+        # Previous sections which can share their contents
+        sections = []
+        if self.dedup == DEDUP_FLASH:
+            for section in self.get_flash().sections.values():
+                if section is self:
+                    break
+                if isinstance(section, ReadfsSection) and section.dedup == DEDUP_FLASH:
+                    sections.append(section)
+
+        # Only contents with the same codec and size as another one can be identical, they are
+        # the only ones to be hashed
+        sizes = {}
+        if self.dedup != DEDUP_NONE:
+            for codec, _, _, stored_size in self.contents:
+                sizes[(codec, stored_size)] = sizes.get((codec, stored_size), 0) + 1
+            for section in sections:
+                for size in section.contents_by_size:
+                    sizes[size] = sizes.get(size, 0) + 1
+
+        candidates = [index for index, content in enumerate(self.contents)
+            if sizes.get((content[0], content[3]), 0) > 1]
+        run_parallel(jobs, self.__get_content_key, candidates, FILE_BATCH_SIZE)
+
+        contents = {}
+        for index, content in enumerate(self.contents):
+            codec, stored_path, stored_data, stored_size = content
+            key = self.content_keys.get(index)
+
+            file = None
+            if key is not None:
+                file = contents.get(tuple(key))
+                for section in sections:
+                    if file is not None:
+                        break
+                    file = section.find_content(key)
+
+            if file is not None:
+                self.dedup_saved += stored_size
+            else:
+                file = ReadfsFile(f'file{index}', stored_size, parent=self.top_struct)
+                self.files.append(file)
+
+                # The content is only read when the image is written
+                if stored_path is not None:
+                    file.get_field('data').set_file(stored_path, size=stored_size)
+                else:
+                    file.set_field('data', stored_data)
+
+                self.contents_by_size.setdefault((codec, stored_size), []).append(index)
+                if key is not None:
+                    contents[tuple(key)] = file
+
+            self.file_contents.append(file)
+
+
+    def __get_content_key(self, index: int) -> list:
+        key = self.content_keys.get(index)
+        if key is None:
+            codec, stored_path, stored_data, stored_size = self.contents[index]
+            if stored_path is not None:
+                content_hash = hash_file(stored_path)
+            else:
+                content_hash = hashlib.sha256(stored_data).hexdigest()
+
+            key = self.content_keys[index] = [codec, stored_size, content_hash]
+
+        return key
+
+
+    def dump_table(self, level: int) -> str:
+        result = super().dump_table(level)
+
+        if self.dedup != DEDUP_NONE:
+            nb_shared = len(self.file_paths) - len(self.files)
+            result += (f'\nDeduplication: {self.dedup}, {nb_shared}/{len(self.file_paths)} files '
+                f'sharing their content, saved {self.dedup_saved} bytes')
+
+        if self.is_compressed():
+            size = sum(file_size for _, _, file_size in self.file_paths)
+            stored_size = sum(content[3] for content in self.contents)
+            nb_compressed = sum(1 for content in self.contents
+                if content[0] != gapylib.compression.CODEC_NONE)
+            ratio = stored_size / size if size != 0 else 1.0
+
+            result += (f'\nCompression: {self.get_property("compression")}, {nb_compressed}/'
+                f'{len(self.contents)} files compressed, {size} -> {stored_size} bytes '
+                f'(ratio {ratio:.3f}, saved {size - stored_size} bytes)')
+
+        return result
+
+
+    def get_host_files(self) -> list:
+        return [file.get_field('data').path for file in self.files
+            if file.get_field('data').path is not None]
 
 
     def is_empty(self) -> bool:
@@ -238,3 +562,315 @@ class ReadfsSection(FlashSection):
 
     def get_partition_subtype(self) -> int:
         return 0x81
+
+
+
+class ReadfsReader():
+    """
+    Host-side reader of a readfs image.
+
+    The header chain is parsed when the reader is created, and the index is used for look-ups
+    when it is present.
+
+    Attributes
+    ----------
+    path : str
+        Path of the image file, which can be a whole flash image.
+    offset : int
+        Offset of the readfs section in the image file.
+    """
+
+    def __init__(self, path: str, offset: int=0):
+        self.path = path
+        self.offset = offset
+        # Files, as [name, header offset, content offset, stored size, codec, size], in header
+        # chain order
+        self.files = []
+        self.version = 0
+        # Index entries, as [name hash, header offset], or None if there is no index
+        self.index = None
+        self.index_crc = None
+        self.index_version = None
+        # Files by header offset, for index look-ups
+        self.__headers = {}
+
+        try:
+            with open(path, 'rb') as file_desc:
+                self.__parse(file_desc)
+        except OSError as exc:
+            raise RuntimeError(f'Unable to read readfs image {path}: {exc}') from exc
+        except struct.error as exc:
+            raise RuntimeError(f'Invalid readfs image {path}: truncated header') from exc
+
+
+    def has_index(self) -> bool:
+        """Tell if the readfs has an index.
+
+        Returns
+        -------
+        bool
+            True if the index is present.
+        """
+        return self.index is not None
+
+
+    def get_names(self) -> list:
+        """Return the names of the files.
+
+        Returns
+        -------
+        list
+            The names, in header chain order.
+        """
+        return [file[0] for file in self.files]
+
+
+    def find(self, name: str) -> list:
+        """Find a file.
+
+        Parameters
+        ----------
+        name : str
+            The file name in the readfs.
+
+        Returns
+        -------
+        list
+            The file as [name, header offset, content offset, stored size, codec, size], or None
+            if it is not found.
+        """
+        if self.index is None:
+            for file in self.files:
+                if file[0] == name:
+                    return file
+            return None
+
+        name_hash = get_name_hash(name)
+
+        # Binary search of the first entry with this hash, then compare the names of all entries
+        # with the same hash, like the target does
+        low, high = 0, len(self.index)
+        while low < high:
+            middle = (low + high) // 2
+            if self.index[middle][0] < name_hash:
+                low = middle + 1
+            else:
+                high = middle
+
+        while low < len(self.index) and self.index[low][0] == name_hash:
+            file = self.__headers.get(self.index[low][1])
+            if file is not None and file[0] == name:
+                return file
+            low += 1
+
+        return None
+
+
+    def read(self, name: str) -> bytes:
+        """Read the content of a file.
+
+        Parameters
+        ----------
+        name : str
+            The file name in the readfs.
+
+        Returns
+        -------
+        bytes
+            The file content, decompressed if it is compressed.
+        """
+        file = self.find(name)
+        if file is None:
+            raise RuntimeError(f'File {name} not found in readfs image {self.path}')
+
+        try:
+            with open(self.path, 'rb') as file_desc:
+                # Offsets of contents shared with previous sections wrap around
+                file_desc.seek((self.offset + file[2]) & 0xffffffff)
+                data = file_desc.read(file[3])
+        except OSError as exc:
+            raise RuntimeError(f'Unable to read readfs image {self.path}: {exc}') from exc
+
+        try:
+            data = gapylib.compression.decompress(file[4], data, file[5])
+        except Exception as exc: # pylint: disable=broad-except
+            # The codecs raise their own exceptions on corrupted data
+            raise RuntimeError(f'Unable to decompress file {name} of readfs image '
+                f'{self.path}: {exc}') from exc
+
+        if len(data) != file[5]:
+            raise RuntimeError(f'Invalid readfs image {self.path}: file {name} has '
+                f'{len(data)} bytes, expected {file[5]}')
+
+        return data
+
+
+    def verify(self):
+        """Verify the consistency of the readfs, including its index if any.
+
+        Every file must be found through the index, which must be sorted and protected by its
+        CRC.
+        """
+        if self.index is None:
+            return
+
+        entries = b''.join(READFS_INDEX_ENTRY.pack(*entry) for entry in self.index)
+        if compute_crc(0xffffffff, entries) != self.index_crc:
+            raise RuntimeError(f'Invalid readfs index in {self.path}: bad CRC')
+
+        files = dict(self.__headers)
+        previous = None
+        for name_hash, header_offset in self.index:
+            file = files.pop(header_offset, None)
+            if file is None:
+                raise RuntimeError(f'Invalid readfs index in {self.path}: entry with offset '
+                    f'0x{header_offset:x} is not a file header')
+
+            if get_name_hash(file[0]) != name_hash:
+                raise RuntimeError(f'Invalid readfs index in {self.path}: bad hash for file '
+                    f'{file[0]}')
+
+            if previous is not None and previous > [name_hash, file[0]]:
+                raise RuntimeError(f'Invalid readfs index in {self.path}: entries not sorted at '
+                    f'file {file[0]}')
+            previous = [name_hash, file[0]]
+
+        for name in self.get_names():
+            if self.find(name) is None:
+                raise RuntimeError(f'Invalid readfs index in {self.path}: file {name} cannot be '
+                    'found')
+
+
+    def __parse(self, file_desc):
+        file_desc.seek(self.offset)
+        fs_size, nb_files = _HEADER.unpack(file_desc.read(_HEADER.size))
+        self.version = fs_size >> 32
+        fs_size &= 0xffffffff
+
+        if self.version not in [0, READFS_COMPRESSION_VERSION]:
+            raise RuntimeError(f'Invalid readfs image {self.path}: unknown version '
+                f'{self.version}')
+
+        header_offset = _HEADER.size
+        for _ in range(0, nb_files):
+            offset, stored_size, name_len = \
+                _FILE_HEADER.unpack(file_desc.read(_FILE_HEADER.size))
+            header_size = _FILE_HEADER.size + name_len
+
+            codec, file_size = gapylib.compression.CODEC_NONE, stored_size
+            if self.version == READFS_COMPRESSION_VERSION:
+                codec, file_size = _FILE_HEADER_COMPRESSION.unpack(
+                    file_desc.read(_FILE_HEADER_COMPRESSION.size))
+                header_size += _FILE_HEADER_COMPRESSION.size
+
+            name = file_desc.read(name_len)
+            if len(name) != name_len or name_len == 0 or name[-1] != 0:
+                raise RuntimeError(f'Invalid readfs image {self.path}: bad file name at offset '
+                    f'0x{header_offset:x}')
+
+            self.files.append([name[:-1].decode('utf-8'), header_offset, offset, stored_size,
+                codec, file_size])
+            header_offset += header_size
+
+        if header_offset != fs_size:
+            raise RuntimeError(f'Invalid readfs image {self.path}: header chain size is '
+                f'{header_offset}, expected {fs_size}')
+
+        self.__headers = {file[1]: file for file in self.files}
+
+        # The index is only there if the magic number follows the header chain, old images have
+        # the content of a file there
+        file_desc.seek(self.offset + ((fs_size + 3) & ~3))
+        index_header = file_desc.read(_INDEX_HEADER.size)
+        if len(index_header) != _INDEX_HEADER.size:
+            return
+
+        magic, version, nb_entries, entries_crc = _INDEX_HEADER.unpack(index_header)
+        if magic != READFS_INDEX_MAGIC or nb_entries != nb_files:
+            return
+
+        entries = file_desc.read(nb_entries * READFS_INDEX_ENTRY.size)
+        if len(entries) != nb_entries * READFS_INDEX_ENTRY.size:
+            return
+
+        self.index_version = version
+        self.index_crc = entries_crc
+        self.index = [list(entry) for entry in READFS_INDEX_ENTRY.iter_unpack(entries)]
+
+
+
+def _compress_file(path: str, file_size: int, codec: int, cache_dir: str) -> list:
+    # Return the content of a file as stored in flash, as [codec, host path, data, size]
+    stored_path, stored_data, stored_size = gapylib.compression.compress_file(path, codec,
+        cache_dir)
+
+    if stored_size >= file_size:
+        return [gapylib.compression.CODEC_NONE, path, None, file_size]
+
+    return [codec, stored_path, stored_data, stored_size]
+
+
+def _get_patterns(patterns: any) -> list:
+    # Patterns coming from the command-line are strings
+    if patterns is None:
+        return []
+    if isinstance(patterns, str):
+        return [patterns]
+    return patterns
+
+
+def _stat_file(file: list) -> list:
+    name, path = file
+    try:
+        return [name, path, os.stat(path).st_size]
+    except OSError as exc:
+        raise RuntimeError(f'Unable to access file {path}: {exc}') from exc
+
+
+def _walk_dir(directory: str, include: list, exclude: list) -> list:
+    # Return the files of a directory and its sub-directories, as [readfs name, host path, size],
+    # sorted by name so that the image does not depend on the host file system order.
+    # The path is of the form <host_path>:<target_path>, the second part is optional.
+    target_directory = None
+    if directory.find(':') != -1:
+        directory, target_directory = directory.split(':')
+
+    result = []
+    pending = ['']
+    while len(pending) > 0:
+        rel_dir = pending.pop()
+        host_dir = os.path.join(directory, rel_dir)
+
+        try:
+            entries = list(os.scandir(host_dir))
+        except OSError as exc:
+            raise RuntimeError(f'Unable to read directory {host_dir}: {exc}') from exc
+
+        for entry in entries:
+            rel_path = rel_dir + entry.name
+
+            if any(fnmatch.fnmatchcase(rel_path, pattern) for pattern in exclude):
+                continue
+
+            try:
+                # Like os.walk, symbolic links to directories are not followed to avoid loops
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        pending.append(rel_path + '/')
+                    continue
+
+                if len(include) != 0 and \
+                        not any(fnmatch.fnmatchcase(rel_path, pattern) for pattern in include):
+                    continue
+
+                # The stat is cached by the entry and is the only one done on the file
+                file_size = entry.stat().st_size
+            except OSError as exc:
+                raise RuntimeError(f'Unable to access file {entry.path}: {exc}') from exc
+
+            if target_directory is not None:
+                rel_path = os.path.join(target_directory, rel_path)
+
+            result.append([rel_path, entry.path, file_size])
+
+    return sorted(result)
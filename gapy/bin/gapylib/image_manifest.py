@@ -0,0 +1,439 @@
+"""Provides the manifest used to incrementally rebuild flash images"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import hashlib
+import json
+import os
+
+from gapylib.parallel import run_parallel, FILE_BATCH_SIZE
+from gapylib.utils import hash_file
+import gapylib.trace
+
+
+# Version of the manifest format, a manifest with a different version is ignored
+MANIFEST_VERSION = 2
+
+
+class FingerprintWriter():
+    """
+    Writer computing the fingerprint of a section instead of dumping it.
+
+    It has the same interface as gapylib.image_writer.ImageWriter so that the fingerprint is
+    computed by the same code which writes the section. Host file ranges are not read, they are
+    identified by the hash of the file, which is only computed when the file has changed.
+
+    Attributes
+    ----------
+    manifest : ImageManifest
+        Manifest used to get the hash of host files.
+    """
+
+    def __init__(self, manifest: 'ImageManifest'):
+        self.manifest = manifest
+        self.position = 0
+        self.hash = hashlib.sha256()
+
+    def tell(self) -> int:
+        """Return the current position in the section.
+
+        Returns
+        -------
+        int
+            The position.
+        """
+        return self.position
+
+    def write(self, data: bytes):
+        """Add data to the fingerprint.
+
+        Parameters
+        ----------
+        data : bytes
+            The data.
+        """
+        self.hash.update(b'd' + len(data).to_bytes(8, 'little'))
+        self.hash.update(data)
+        self.position += len(data)
+
+    def write_zeros(self, size: int):
+        """Add zeros to the fingerprint.
+
+        Parameters
+        ----------
+        size : int
+            Number of zero bytes.
+        """
+        if size <= 0:
+            return
+        self.hash.update(b'z' + size.to_bytes(8, 'little'))
+        self.position += size
+
+    def write_fill(self, size: int, pattern: bytes):
+        """Add a region filled with a pattern to the fingerprint.
+
+        Parameters
+        ----------
+        size : int
+            Size of the region.
+        pattern : bytes
+            The pattern.
+        """
+        if size <= 0:
+            return
+        self.hash.update(b'p' + size.to_bytes(8, 'little') + len(pattern).to_bytes(8, 'little'))
+        self.hash.update(pattern)
+        self.position += size
+
+    def write_uninitialized(self, size: int):
+        """Add an uninitialized region to the fingerprint.
+
+        Parameters
+        ----------
+        size : int
+            Size of the region.
+        """
+        if size <= 0:
+            return
+        self.hash.update(b'u' + size.to_bytes(8, 'little'))
+        self.position += size
+
+    def copy_file(self, path: str, file_offset: int, size: int):
+        """Add a range of a host file to the fingerprint.
+
+        Parameters
+        ----------
+        path : str
+            Path of the host file.
+        file_offset : int
+            Offset in the host file of the first byte of the range.
+        size : int
+            Number of bytes of the range.
+        """
+        if size <= 0:
+            return
+        file_hash = self.manifest.get_file_hash(path)
+        self.hash.update(b'f' + file_offset.to_bytes(8, 'little') + size.to_bytes(8, 'little'))
+        self.hash.update(file_hash.encode('utf-8'))
+        self.position += size
+
+    def close(self):
+        """Close the writer."""
+
+    def digest(self) -> str:
+        """Return the fingerprint.
+
+        Returns
+        -------
+        str
+            The fingerprint as an hexadecimal string.
+        """
+        return self.hash.hexdigest()
+
+
+class ImageManifest():
+    """
+    Manifest of the inputs used to generate a flash image.
+
+    The manifest records, for each section, its layout and a fingerprint of its content, and for
+    each host file used by the sections its size, modification time and hash.
+    Comparing it with the manifest of the previous generation tells which sections need to be
+    written again.
+
+    Attributes
+    ----------
+    path : str
+        Path of the manifest file.
+    erased_value : int
+        Byte value of the uninitialized regions of the image.
+    """
+
+    def __init__(self, path: str, erased_value: int=0):
+        self.path = path
+        self.erased_value = erased_value
+        self.files = {}
+        self.sections = []
+        self.previous = self.__load()
+
+
+    def get_file_hash(self, path: str) -> str:
+        """Return the hash of a host file.
+
+        The hash is taken from the previous manifest if the file size and modification time
+        did not change, otherwise it is computed.
+
+        Parameters
+        ----------
+        path : str
+            Path of the host file.
+
+        Returns
+        -------
+        str
+            The hash as an hexadecimal string.
+        """
+        path = os.path.abspath(path)
+        entry = self.files.get(path)
+        if entry is not None:
+            return entry['hash']
+
+        try:
+            stat = os.stat(path)
+        except OSError as exc:
+            raise RuntimeError(f'Unable to access file {path}: {exc}') from exc
+
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+        previous_entry = None
+        if self.previous is not None:
+            previous_entry = self.previous.get('files', {}).get(path)
+
+        if previous_entry is not None and previous_entry.get('size') == entry['size'] and \
+                previous_entry.get('mtime_ns') == entry['mtime_ns']:
+            entry['hash'] = previous_entry['hash']
+        else:
+            entry['hash'] = self.__hash_file(path)
+
+        self.files[path] = entry
+        return entry['hash']
+
+
+    def add_section(self, section: 'gapylib.flash.FlashSection'):
+        """Add a section to the manifest.
+
+        This computes the fingerprint of the section content.
+
+        Parameters
+        ----------
+        section : gapylib.flash.FlashSection
+            The section.
+        """
+        self.sections.append(self.__get_section_entry(section))
+
+
+    def add_sections(self, sections: list, jobs: int=1):
+        """Add several sections to the manifest.
+
+        The fingerprints of the sections are computed concurrently.
+
+        Parameters
+        ----------
+        sections : list
+            The sections, in layout order.
+        jobs : int
+            Maximum number of sections processed concurrently.
+        """
+        # Files of sections made of many host files are hashed concurrently first, their
+        # fingerprints then get the hashes from the manifest
+        paths = []
+        for section in sections:
+            paths += section.get_host_files()
+        run_parallel(jobs, self.get_file_hash, paths, FILE_BATCH_SIZE)
+
+        entries = run_parallel(jobs, self.__get_section_entry, sections)
+
+        # Sections storing the digests of other sections change when they change
+        fingerprints = {entry['name']: entry['fingerprint'] for entry in self.sections + entries}
+        for section, entry in zip(sections, entries):
+            digested = section.get_digested_sections()
+            if len(digested) != 0:
+                fingerprint = hashlib.sha256(entry['fingerprint'].encode('utf-8'))
+                for digested_section in digested:
+                    fingerprint.update(fingerprints.get(digested_section.get_name(), '')
+                        .encode('utf-8'))
+                entry['fingerprint'] = fingerprint.hexdigest()
+
+        self.sections += entries
+
+
+    def get_changed_sections(self, image_path: str) -> list:
+        """Return the sections which changed since the previous generation.
+
+        Parameters
+        ----------
+        image_path : str
+            Path of the image which was generated with the previous manifest.
+
+        Returns
+        -------
+        list
+            The indexes of the sections which changed, or None if the whole image must be
+            generated again.
+        """
+        if self.previous is None:
+            return None
+
+        # The image must be the one which was generated with the previous manifest
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+
+        previous_image = self.previous.get('image')
+        if previous_image is None or previous_image.get('size') != stat.st_size or \
+                previous_image.get('mtime_ns') != stat.st_mtime_ns or \
+                previous_image.get('erased_value') != self.erased_value:
+            return None
+
+        # And the layout must be the same, otherwise sections move and everything is written
+        previous_sections = self.previous.get('sections', [])
+        if len(previous_sections) != len(self.sections):
+            return None
+
+        result = []
+        for index, section in enumerate(self.sections):
+            previous_section = previous_sections[index]
+            for key in ['name', 'offset', 'size']:
+                if previous_section.get(key) != section[key]:
+                    return None
+
+            if previous_section.get('fingerprint') != section['fingerprint']:
+                result.append(index)
+
+        return result
+
+
+    def get_section_digests(self, index: int) -> list:
+        """Return the digests of a section from the previous generation.
+
+        Parameters
+        ----------
+        index : int
+            Index of the section.
+
+        Returns
+        -------
+        list
+            The MD5 digest as bytes and the CRC32, or None if they are not known or if the
+            section changed.
+        """
+        if self.previous is None:
+            return None
+
+        previous_sections = self.previous.get('sections', [])
+        if index >= len(previous_sections):
+            return None
+
+        previous_section = previous_sections[index]
+        for key in ['name', 'offset', 'size', 'fingerprint']:
+            if previous_section.get(key) != self.sections[index][key]:
+                return None
+
+        digests = previous_section.get('digests')
+        if digests is None:
+            return None
+
+        return [bytes.fromhex(digests[0]), digests[1]]
+
+
+    def set_section_digests(self, index: int, digests: list):
+        """Set the digests of a section, so that they can be reused by the next generation.
+
+        Parameters
+        ----------
+        index : int
+            Index of the section.
+        digests : list
+            The MD5 digest as bytes and the CRC32.
+        """
+        self.sections[index]['digests'] = [digests[0].hex(), digests[1]]
+
+
+    def invalidate(self):
+        """Remove the manifest file.
+
+        This should be called before modifying the image, so that an interrupted generation
+        forces a full generation the next time.
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            raise RuntimeError(f'Unable to remove image manifest {self.path}: {exc}') from exc
+
+
+    def save(self, image_path: str):
+        """Save the manifest.
+
+        This should be called once the image has been generated.
+
+        Parameters
+        ----------
+        image_path : str
+            Path of the generated image.
+        """
+        stat = os.stat(image_path)
+
+        content = {
+            'version': MANIFEST_VERSION,
+            'image': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'erased_value': self.erased_value},
+            'files': self.files,
+            'sections': self.sections
+        }
+
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as file_desc:
+                json.dump(content, file_desc, indent=4, default=str)
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            raise RuntimeError(f'Unable to write image manifest {self.path}: {exc}') from exc
+
+
+    def __get_section_entry(self, section: 'gapylib.flash.FlashSection') -> dict:
+        writer = FingerprintWriter(self)
+        with gapylib.trace.span('section fingerprint', flash=section.get_flash().get_name(),
+                section=section.get_name(), template=type(section).__name__):
+            section.write_image(writer)
+
+        properties = {}
+        for prop in section.properties.values():
+            properties[prop.name] = prop.value
+
+        return {
+            'name': section.get_name(),
+            'offset': section.get_offset(),
+            'size': section.get_size(),
+            'properties': properties,
+            'fingerprint': writer.digest()
+        }
+
+
+    def __load(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file_desc:
+                content = json.load(file_desc)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(content, dict) or content.get('version') != MANIFEST_VERSION:
+            return None
+
+        return content
+
+
+    @staticmethod
+    def __hash_file(path: str) -> str:
+        with gapylib.trace.span('file hash', path=path, bytes=os.path.getsize(path)):
+            return hash_file(path)
@@ -0,0 +1,284 @@
+"""Provides the content-addressed store of generated images shared between work directories"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import gapylib.trace
+from gapylib.utils import clone_file
+
+
+# Version of the store, included in the keys so that a new format never hits old objects
+STORE_VERSION = 1
+
+# Name of the file containing the content of an object, in the object directory
+DATA_FILE = 'data'
+
+# Temporary directories older than this, in seconds, were left by interrupted processes
+TMP_MAX_AGE = 3600
+
+
+def unshare_file(path: str, keep_content: bool):
+    """Make sure a file is not shared with the image store before it is modified.
+
+    Files taken from the image store may be hardlinks to its objects, they must be replaced by
+    a private file before being written, otherwise the object and the other work directories
+    using it would be modified too.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file.
+    keep_content : bool
+        True if the file is going to be patched, in which case it is replaced by a copy,
+        otherwise it is just removed.
+    """
+    try:
+        if os.stat(path).st_nlink <= 1:
+            return
+    except OSError:
+        return
+
+    if not keep_content:
+        os.remove(path)
+        return
+
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        shutil.copyfile(path, tmp_path)
+        shutil.copystat(path, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        _remove(tmp_path)
+        raise
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ImageStore():
+    """
+    Content-addressed store of generated images.
+
+    Objects are identified by a key computed from everything their content depends on, so
+    that several work directories generating the same image share a single copy. Objects are
+    given to work directories as copy-on-write clones or hardlinks when possible, this is why
+    files must be unshared with unshare_file before being modified.
+    The store is safe to use from concurrent processes: objects are created in a temporary
+    directory and atomically renamed, and the least recently used objects are evicted when the
+    store gets bigger than its maximum size.
+
+    Attributes
+    ----------
+    path : str
+        Path of the store directory.
+    max_size : int
+        Maximum size in bytes of the store.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.objects_dir = os.path.join(self.path, 'objects')
+        self.tmp_dir = os.path.join(self.path, 'tmp')
+
+        try:
+            os.makedirs(self.objects_dir, exist_ok=True)
+            os.makedirs(self.tmp_dir, exist_ok=True)
+        except OSError as exc:
+            raise RuntimeError(f'Unable to create image store {self.path}: {exc}') from exc
+
+
+    @staticmethod
+    def get_key(*parts: any) -> str:
+        """Return the key of an object.
+
+        Parameters
+        ----------
+        parts : any
+            Everything the object content depends on. They must be serializable to JSON.
+
+        Returns
+        -------
+        str
+            The key.
+        """
+        content = json.dumps([STORE_VERSION] + list(parts), sort_keys=True, default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+    def get(self, key: str, path: str) -> bool:
+        """Give the content of an object to a file.
+
+        Parameters
+        ----------
+        key : str
+            Key of the object.
+        path : str
+            Path of the file, which is replaced if it exists.
+
+        Returns
+        -------
+        bool
+            True if the object was found, False otherwise.
+        """
+        object_dir = self.__get_object_dir(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+        with gapylib.trace.span('image store get', path=path) as span:
+            try:
+                clone_file(os.path.join(object_dir, DATA_FILE), tmp_path)
+                os.replace(tmp_path, path)
+            except OSError:
+                # Also happens if the object is evicted concurrently
+                _remove(tmp_path)
+                span.set_arg('hit', False)
+                return False
+
+            span.set_arg('hit', True)
+
+        self.__touch(object_dir)
+        return True
+
+
+    def add(self, key: str, path: str):
+        """Add the content of a file to the store.
+
+        Nothing is done if the object is already there.
+
+        Parameters
+        ----------
+        key : str
+            Key of the object.
+        path : str
+            Path of the file.
+        """
+        object_dir = self.__get_object_dir(key)
+        if os.path.isdir(object_dir):
+            self.__touch(object_dir)
+            return
+
+        tmp_dir = None
+        try:
+            tmp_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+            clone_file(path, os.path.join(tmp_dir, DATA_FILE))
+            os.makedirs(os.path.dirname(object_dir), exist_ok=True)
+            os.rename(tmp_dir, object_dir)
+        except OSError as exc:
+            # Another process may have added it in the meantime, the store is just a cache
+            logging.debug('Unable to add %s to image store: %s', path, exc)
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+    def trim(self):
+        """Evict the least recently used objects until the store fits in its maximum size.
+
+        Nothing is done if another process is already doing it.
+        """
+        try:
+            # pylint: disable=import-outside-toplevel
+            import fcntl
+        except ImportError:
+            fcntl = None
+
+        try:
+            with open(os.path.join(self.path, 'lock'), 'a', encoding='utf-8') as lock_desc:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_desc.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        return
+
+                self.__trim()
+        except OSError as exc:
+            logging.debug('Unable to trim image store %s: %s', self.path, exc)
+
+
+    def __trim(self):
+        now = time.time()
+
+        for entry in os.scandir(self.tmp_dir):
+            try:
+                if now - entry.stat(follow_symlinks=False).st_mtime > TMP_MAX_AGE:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
+
+        objects = []
+        total_size = 0
+        for prefix in os.scandir(self.objects_dir):
+            if not prefix.is_dir(follow_symlinks=False):
+                continue
+
+            for entry in os.scandir(prefix.path):
+                try:
+                    last_use = entry.stat(follow_symlinks=False).st_mtime
+                    stat = os.stat(os.path.join(entry.path, DATA_FILE))
+                except OSError:
+                    continue
+
+                # Images are sparse, count what they really use
+                size = stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+                objects.append([last_use, size, entry.path])
+                total_size += size
+
+        if total_size <= self.max_size:
+            return
+
+        for _, size, object_dir in sorted(objects):
+            # Move it out of the objects first, so that it disappears atomically for the others
+            tmp_path = os.path.join(self.tmp_dir, f'evict-{os.path.basename(object_dir)}')
+            try:
+                os.rename(object_dir, tmp_path)
+            except OSError:
+                continue
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+            total_size -= size
+            if total_size <= self.max_size:
+                break
+
+
+    def __get_object_dir(self, key: str) -> str:
+        return os.path.join(self.objects_dir, key[:2], key)
+
+
+    @staticmethod
+    def __touch(object_dir: str):
+        # The object directory modification time is its last use. The data file is not touched
+        # since it may be shared with work directories.
+        try:
+            os.utime(object_dir)
+        except OSError:
+            pass
@@ -0,0 +1,321 @@
+"""Provides the streaming writer used to dump flash and section images"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import os
+import typing
+
+import gapylib.trace
+
+
+# Granularity used to detect zero regions in the written data. Smaller zero regions are written
+# as-is since they would not produce any hole in the file anyway.
+ZERO_CHUNK_SIZE = 1 << 16
+
+_ZERO_CHUNK = bytes(ZERO_CHUNK_SIZE)
+
+# Size of the chunks used when host files have to be copied through python
+COPY_CHUNK_SIZE = 1 << 20
+
+
+class ImageWriter():
+    """
+    Streaming writer for flash and section images.
+
+    Data is appended sequentially. In sparse mode, regions which only contain zeros are not written
+    but skipped, so that they become holes in the file and never need to be materialized in memory.
+    Sparse mode must only be used on a file which has just been created or truncated, since
+    skipped regions are expected to read as zeros.
+
+    The content is described as a sequence of extents: data, host file ranges, regions filled
+    with a pattern, and uninitialized regions, which get the erased value of the flash. None of
+    them needs to be materialized in memory for big regions.
+
+    Attributes
+    ----------
+    file_desc
+        File descriptor where the image is written. It must be opened in binary mode.
+    sparse : bool
+        True if zero regions can be skipped instead of written.
+    erased_value : int
+        Byte value written for uninitialized regions.
+    """
+
+    def __init__(self, file_desc: typing.BinaryIO, sparse: bool=True, erased_value: int=0):
+        self.file_desc = file_desc
+        self.sparse = sparse
+        self.erased_value = erased_value
+        # Logical position in the image, including skipped regions
+        self.position = file_desc.tell()
+        # Position where the next real write will happen in the file
+        self.file_position = self.position
+        # End of the data really written to the file
+        self.file_end = self.position
+        # Digests updated with the whole image content while it is written
+        self.digests = []
+
+    def tell(self) -> int:
+        """Return the current position in the image.
+
+        Returns
+        -------
+        int
+            The position.
+        """
+        return self.position
+
+    def add_digest(self, digest: any):
+        """Add a digest to be computed on the image content.
+
+        The digest is updated with everything written after this call, including zero regions
+        and host file ranges, so that the image does not need to be read back to be hashed.
+
+        Parameters
+        ----------
+        digest : any
+            Digest object, only its update method is used, like with hashlib.
+        """
+        self.digests.append(digest)
+
+    def remove_digest(self, digest: any):
+        """Stop computing a digest on the image content.
+
+        This can be used to compute a digest on a part of the image only.
+
+        Parameters
+        ----------
+        digest : any
+            Digest object previously given to add_digest.
+        """
+        self.digests.remove(digest)
+
+    def write(self, data: bytes):
+        """Append data to the image.
+
+        In sparse mode, the data is scanned by chunks and chunks full of zeros are skipped.
+
+        Parameters
+        ----------
+        data : bytes
+            The data to be written.
+        """
+        for digest in self.digests:
+            digest.update(data)
+
+        size = len(data)
+        if not self.sparse or size < ZERO_CHUNK_SIZE:
+            self.__write_raw(data)
+            return
+
+        if isinstance(data, memoryview):
+            data = data.cast('B')
+
+        start = 0
+        for offset in range(0, size, ZERO_CHUNK_SIZE):
+            chunk = data[offset:offset + ZERO_CHUNK_SIZE]
+            if isinstance(chunk, memoryview):
+                is_zero = chunk.tobytes() == _ZERO_CHUNK[:len(chunk)]
+            else:
+                is_zero = chunk == _ZERO_CHUNK[:len(chunk)]
+
+            if is_zero:
+                # Flush what is pending before this chunk and skip it
+                if offset > start:
+                    self.__write_raw(data[start:offset])
+                self.position += len(chunk)
+                start = offset + len(chunk)
+
+        if start < size:
+            self.__write_raw(data[start:])
+
+    def write_zeros(self, size: int):
+        """Append zeros to the image.
+
+        In sparse mode, nothing is written, the region will become a hole in the file.
+
+        Parameters
+        ----------
+        size : int
+            Number of zero bytes.
+        """
+        if size <= 0:
+            return
+
+        for digest in self.digests:
+            remaining = size
+            while remaining > 0:
+                iter_size = min(remaining, ZERO_CHUNK_SIZE)
+                digest.update(_ZERO_CHUNK[:iter_size])
+                remaining -= iter_size
+
+        if self.sparse:
+            self.position += size
+            return
+
+        while size > 0:
+            iter_size = min(size, ZERO_CHUNK_SIZE)
+            self.__write_raw(_ZERO_CHUNK[:iter_size])
+            size -= iter_size
+
+    def write_fill(self, size: int, pattern: bytes):
+        """Append a region filled with a pattern to the image.
+
+        The pattern is repeated from the beginning of the region, only one chunk of it is built.
+
+        Parameters
+        ----------
+        size : int
+            Size of the region.
+        pattern : bytes
+            The pattern.
+        """
+        if size <= 0:
+            return
+
+        if pattern.count(0) == len(pattern):
+            self.write_zeros(size)
+            return
+
+        chunk = pattern * max(1, ZERO_CHUNK_SIZE // len(pattern))
+        while size > 0:
+            iter_size = min(size, len(chunk))
+            self.write(chunk[:iter_size])
+            size -= iter_size
+
+    def write_uninitialized(self, size: int):
+        """Append an uninitialized region to the image.
+
+        The region is filled with the erased value.
+
+        Parameters
+        ----------
+        size : int
+            Size of the region.
+        """
+        self.write_fill(size, bytes([self.erased_value]))
+
+    def copy_file(self, path: str, file_offset: int, size: int):
+        """Append a range of a host file to the image.
+
+        The data is copied by the kernel when possible so that it never goes through python
+        buffers. This is not done if digests are computed, since they need to see the data.
+
+        Parameters
+        ----------
+        path : str
+            Path of the host file.
+        file_offset : int
+            Offset in the host file of the first byte to be copied.
+        size : int
+            Number of bytes to be copied.
+        """
+        if size <= 0:
+            return
+
+        with gapylib.trace.span('file copy', path=path, bytes=size):
+            self.__copy_file(path, file_offset, size)
+
+    def __copy_file(self, path: str, file_offset: int, size: int):
+        try:
+            with open(path, 'rb') as src_desc:
+                copied = 0
+                if len(self.digests) == 0:
+                    copied = self.__copy_file_fast(src_desc, file_offset, size)
+
+                # Copy what could not be copied by the kernel through python buffers
+                src_desc.seek(file_offset + copied)
+                remaining = size - copied
+                while remaining > 0:
+                    data = src_desc.read(min(remaining, COPY_CHUNK_SIZE))
+                    if len(data) == 0:
+                        raise RuntimeError(f'File {path} is smaller than expected')
+                    self.write(data)
+                    remaining -= len(data)
+        except OSError as exc:
+            raise RuntimeError(f'Unable to read file {path}: {exc}') from exc
+
+    def close(self):
+        """Close the writer.
+
+        This must be called once everything has been written, so that the file is extended
+        when it finishes with a skipped region. The file descriptor itself is not closed.
+        """
+        if self.position > self.file_end:
+            # The file may already be bigger if it is written by several writers, in which case
+            # it must not be shrunk
+            self.file_desc.flush()
+            if self.file_desc.seek(0, os.SEEK_END) < self.position:
+                self.file_desc.truncate(self.position)
+            self.file_end = self.position
+            self.file_position = None
+
+    def __copy_file_fast(self, src_desc: typing.BinaryIO, file_offset: int, size: int) -> int:
+        # Kernel copies need a real file on both sides
+        try:
+            dst_fd = self.file_desc.fileno()
+        except (OSError, AttributeError):
+            return 0
+
+        self.file_desc.flush()
+        src_fd = src_desc.fileno()
+        copied = 0
+
+        for method in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, method):
+                continue
+            try:
+                while copied < size:
+                    if method == 'copy_file_range':
+                        iter_size = os.copy_file_range(src_fd, dst_fd, size - copied,
+                            file_offset + copied, self.position + copied)
+                    else:
+                        os.lseek(dst_fd, self.position + copied, os.SEEK_SET)
+                        iter_size = os.sendfile(dst_fd, src_fd, file_offset + copied,
+                            size - copied)
+                    if iter_size == 0:
+                        break
+                    copied += iter_size
+                break
+            except OSError:
+                # Not supported between these files, try the next method from where the
+                # previous one stopped
+                continue
+
+        if copied > 0:
+            self.position += copied
+            # The kernel copy does not go through the file position, force a seek on next write
+            self.file_position = None
+            self.file_end = max(self.file_end, self.position)
+
+        return copied
+
+    def __write_raw(self, data: bytes):
+        if len(data) == 0:
+            return
+
+        if self.file_position != self.position:
+            self.file_desc.seek(self.position)
+
+        self.file_desc.write(data)
+        self.position += len(data)
+        self.file_position = self.position
+        self.file_end = max(self.file_end, self.position)
@@ -0,0 +1,77 @@
+"""Provides helpers for running independent gapy jobs concurrently"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import typing
+
+
+# Batch size for processing many files concurrently, small files are too cheap to be processed
+# one by one by the pool
+FILE_BATCH_SIZE = 256
+
+
+def run_parallel(jobs: int, func: typing.Callable, items: list, batch_size: int=1) -> list:
+    """Apply a function to a list of items, possibly concurrently.
+
+    Items are processed by a pool of threads, which is enough since the heavy parts of image
+    generation (file copies, hashing, external tools) release the python interpreter lock.
+    The results are returned in the order of the items, and the first exception raised by a job
+    is raised again once all jobs are done.
+
+    Parameters
+    ----------
+    jobs : int
+        Maximum number of concurrent jobs. With 1 or less, items are processed sequentially.
+    func : typing.Callable
+        Function called on each item.
+    items : list
+        Items to be processed.
+    batch_size : int
+        Number of items processed by each job. This should be increased when there are many
+        cheap items, like files, so that the pool overhead does not dominate.
+
+    Returns
+    -------
+    list
+        The result of each call, in the order of the items.
+    """
+    items = list(items)
+
+    if jobs is None or jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    import concurrent.futures # pylint: disable=import-outside-toplevel
+
+    batches = [items[index:index + batch_size] for index in range(0, len(items), batch_size)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(jobs, len(batches))) as executor:
+        futures = [executor.submit(_run_batch, func, batch) for batch in batches]
+        concurrent.futures.wait(futures)
+
+    result = []
+    for future in futures:
+        result += future.result()
+    return result
+
+
+def _run_batch(func: typing.Callable, batch: list) -> list:
+    return [func(item) for item in batch]
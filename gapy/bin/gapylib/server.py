@@ -0,0 +1,457 @@
+"""Provides the gapy server, which keeps targets loaded between gapy commands, and its client"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+# The client part is used by gapy before anything else is imported, this module must stay cheap
+# to import
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+
+
+# Modules loaded by the server before it accepts commands, so that they are already loaded in
+# the processes executing the commands
+PRELOAD_MODULES = [
+    'gapylib.cli',
+    'gapylib.compression',
+    'gapylib.elf',
+    'gapylib.flash',
+    'gapylib.utils',
+    'gapylib.image_manifest',
+    'gapylib.parallel',
+    'gapylib.signing',
+    'gapylib.target_index',
+    'gapylib.chips.pulp.flash',
+    'gapylib.chips.pulp.rom_v2',
+    'gapylib.fs.hostfs',
+    'gapylib.fs.littlefs',
+    'gapylib.fs.partition',
+    'gapylib.fs.raw',
+    'gapylib.fs.readfs',
+    'concurrent.futures',
+    'elftools.elf.elffile',
+    'lz4.block',
+    'prettytable',
+    'rich.table',
+]
+
+# Standard input, output and error of the client are given to the server
+NB_FDS = 3
+
+# Period at which the server reaps the processes of finished commands
+REAP_PERIOD = 1.0
+
+
+def get_default_socket_path() -> str:
+    """Return the default path of the gapy server socket.
+
+    Returns
+    -------
+    str
+        The socket path.
+    """
+    # pylint: disable=import-outside-toplevel
+    from gapylib.cache import get_cache_dir
+
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        raise RuntimeError('No cache directory available for the server socket, specify its path')
+
+    return os.path.join(cache_dir, 'server.sock')
+
+
+def run_client(socket_path: str, argv: list) -> int:
+    """Execute a gapy command through a gapy server.
+
+    The command-line arguments, the current directory and the environment are forwarded to
+    the server, as well as the standard input, output and error, so that the command behaves
+    as if it was executed locally.
+
+    Parameters
+    ----------
+    socket_path : str
+        Path of the server socket.
+    argv : list
+        Command-line arguments, including the executable name.
+
+    Returns
+    -------
+    int
+        The exit status of the command, or None if the server could not be reached, in which
+        case the command should be executed locally.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock:
+        request = json.dumps({'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)})
+        request = request.encode('utf-8')
+
+        try:
+            socket.send_fds(sock, [struct.pack('<I', len(request))], [0, 1, 2])
+            sock.sendall(request)
+            status = _recv_exact(sock, 4)
+        except KeyboardInterrupt:
+            # Closing the connection interrupts the command
+            return 128 + signal.SIGINT
+        except OSError:
+            return 1
+
+        if status is None:
+            return 1
+
+        return struct.unpack('<i', status)[0]
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if len(chunk) == 0:
+            return None
+        data += chunk
+    return data
+
+
+class Server():
+    """
+    Gapy server.
+
+    The server loads gapy modules and the targets used by the commands it receives, and then
+    executes each command in a process forked from it, so that nothing needs to be imported
+    again and commands are isolated from each other.
+
+    Attributes
+    ----------
+    socket_path : str
+        Path of the unix socket where the server listens, or an empty string for the default
+        one.
+    """
+
+    def __init__(self, socket_path: str):
+        if not socket_path:
+            socket_path = get_default_socket_path()
+
+        self.socket_path = os.path.abspath(socket_path)
+        # Target directories used to load each target
+        self.targets = {}
+        # Process which created the socket, the only one allowed to remove it
+        self.pid = None
+
+
+    def serve_forever(self):
+        """Execute commands until the server is interrupted."""
+        self.__preload()
+
+        listener = self.__listen()
+
+        # Terminating the server removes its socket, like interrupting it
+        signal.signal(signal.SIGTERM, self.__terminate)
+
+        print(f'Gapy server listening on {self.socket_path}', flush=True)
+
+        try:
+            while True:
+                self.__reap_children()
+
+                try:
+                    conn, _ = listener.accept()
+                except socket.timeout:
+                    continue
+
+                with conn:
+                    self.__handle_connection(conn, listener)
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            listener.close()
+            # Children executing commands must never remove the socket of the server
+            if os.getpid() == self.pid:
+                try:
+                    os.remove(self.socket_path)
+                except OSError:
+                    pass
+
+
+    @staticmethod
+    def __terminate(*args):
+        # pylint: disable=unused-argument
+        raise KeyboardInterrupt()
+
+
+    def __listen(self) -> socket.socket:
+        # Remove the socket of a previous server, unless it is still alive
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                os.remove(self.socket_path)
+            else:
+                raise RuntimeError(f'A gapy server is already listening on {self.socket_path}')
+            finally:
+                probe.close()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Commands are executed with the rights of the server, only its user can use it. The
+        # socket is created with the right permissions so that nobody else can connect to it
+        # before they are set.
+        umask = os.umask(0o077)
+        try:
+            listener.bind(self.socket_path)
+            listener.listen()
+        except OSError as exc:
+            listener.close()
+            raise RuntimeError(f'Unable to listen on {self.socket_path}: {exc}') from exc
+        finally:
+            os.umask(umask)
+
+        self.pid = os.getpid()
+
+        listener.settimeout(REAP_PERIOD)
+
+        return listener
+
+
+    @staticmethod
+    def __preload():
+        # pylint: disable=import-outside-toplevel
+        import importlib
+        import logging
+
+        for module_name in PRELOAD_MODULES:
+            try:
+                importlib.import_module(module_name)
+            except ImportError as exc:
+                logging.debug('Unable to preload module %s: %s', module_name, exc)
+
+        # The default flash content is parsed once for all commands
+        try:
+            import gapylib.chips.pulp.flash
+            gapylib.chips.pulp.flash.load_default_flash_content()
+        except (ImportError, RuntimeError) as exc:
+            logging.debug('Unable to preload default flash content: %s', exc)
+
+
+    @staticmethod
+    def __reap_children():
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+
+    def __handle_connection(self, conn: socket.socket, listener: socket.socket):
+        try:
+            request, fds = self.__receive_request(conn)
+        except (OSError, ValueError) as exc:
+            print(f'Invalid gapy server request: {exc}', file=sys.stderr)
+            return
+
+        try:
+            self.__load_target(request)
+
+            # Flush what is pending so that it is not output again by the child
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            if os.fork() == 0:
+                self.__execute_request(conn, listener, request, fds)
+        finally:
+            for file_desc in fds:
+                os.close(file_desc)
+
+
+    @staticmethod
+    def __receive_request(conn: socket.socket) -> (dict, list):
+        header, fds, _, _ = socket.recv_fds(conn, 4, NB_FDS)
+
+        try:
+            if len(fds) != NB_FDS:
+                raise ValueError('missing file descriptors')
+
+            if len(header) < 4:
+                remaining = _recv_exact(conn, 4 - len(header))
+                if remaining is None:
+                    raise ValueError('truncated request')
+                header += remaining
+
+            body = _recv_exact(conn, struct.unpack('<I', header)[0])
+            if body is None:
+                raise ValueError('truncated request')
+
+            request = json.loads(body.decode('utf-8'))
+
+        except (OSError, ValueError):
+            for file_desc in fds:
+                os.close(file_desc)
+            raise
+
+        return request, fds
+
+
+    def __get_request_target(self, request: dict) -> (str, list):
+        # pylint: disable=import-outside-toplevel
+        import argparse
+
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument("--target", dest="target", default=None)
+        parser.add_argument("--target-dir", dest="target_dirs", default=[], action="append")
+
+        try:
+            [args, _] = parser.parse_known_args(request['argv'][1:])
+        except SystemExit:
+            return None, []
+
+        target_dirs = [os.path.join(request['cwd'], path) for path in args.target_dirs]
+
+        if args.target is None:
+            return None, target_dirs
+
+        return args.target.split(':')[0], target_dirs
+
+
+    def __load_target(self, request: dict):
+        # Import the target in the server, so that it is already loaded for the next commands
+        # using it
+        target_name, target_dirs = self.__get_request_target(request)
+        if target_name is None or self.targets.get(target_name) is not None:
+            return
+
+        # pylint: disable=import-outside-toplevel
+        import logging
+        import gapylib.target
+
+        for path in reversed(target_dirs):
+            if path not in sys.path:
+                sys.path.insert(0, path)
+
+        try:
+            gapylib.target.get_target(target_name)
+        except Exception as exc: # pylint: disable=broad-except
+            # The error is reported by the command itself
+            logging.debug('Unable to load target %s: %s', target_name, exc)
+            return
+
+        self.targets[target_name] = target_dirs
+
+
+    def __execute_request(self, conn: socket.socket, listener: socket.socket, request: dict,
+            fds: list):
+        status = 1
+        try:
+            listener.close()
+
+            # The server may have been started with signals ignored or handled differently
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+            for index, file_desc in enumerate(fds):
+                os.dup2(file_desc, index)
+                os.close(file_desc)
+            fds.clear()
+
+            sys.stdout.reconfigure(line_buffering=os.isatty(1))
+
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+
+            _, target_dirs = self.__get_request_target(request)
+            self.__forget_other_targets(target_dirs)
+
+            # The command is interrupted if the client goes away
+            threading.Thread(target=self.__watch_client, args=(conn,), daemon=True).start()
+
+            # pylint: disable=import-outside-toplevel
+            import gapylib.cli
+            status = gapylib.cli.execute(request['argv'])
+
+        except OSError as exc:
+            print(f'Unable to execute gapy command: {exc}', file=sys.stderr)
+
+        except KeyboardInterrupt:
+            pass
+
+        except BaseException: # pylint: disable=broad-except
+            # Nothing must escape, the child would otherwise continue in the server loop
+            import traceback # pylint: disable=import-outside-toplevel
+            traceback.print_exc()
+
+        finally:
+            try:
+                # The client exits as soon as it gets the status, which makes the watcher
+                # interrupt this process, this must not prevent it from exiting below
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                sys.stdout.flush()
+                sys.stderr.flush()
+                conn.sendall(struct.pack('<i', status))
+            except BaseException: # pylint: disable=broad-except
+                pass
+
+            # pylint: disable=protected-access
+            os._exit(status & 0xff)
+
+
+    def __forget_other_targets(self, target_dirs: list):
+        # Modules loaded from the target directories of other commands must not be used by this
+        # one, in case it has a module with the same name in its own directories
+        other_dirs = []
+        for dirs in self.targets.values():
+            for path in dirs:
+                if path not in target_dirs and path not in other_dirs:
+                    other_dirs.append(path)
+
+        if len(other_dirs) == 0:
+            return
+
+        sys.path = [path for path in sys.path if path not in other_dirs]
+
+        prefixes = tuple(os.path.join(path, '') for path in other_dirs)
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, '__file__', None)
+            if path is not None and path.startswith(prefixes):
+                del sys.modules[name]
+
+
+    @staticmethod
+    def __watch_client(conn: socket.socket):
+        try:
+            data = conn.recv(1)
+        except OSError:
+            data = b''
+
+        if len(data) == 0:
+            os.kill(os.getpid(), signal.SIGINT)
@@ -0,0 +1,200 @@
+"""Provides the backend used to sign OTA section images"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import functools
+import importlib
+import logging
+import os
+import subprocess
+import threading
+
+import gapylib.trace
+
+# Openssl digest names and the corresponding pycryptodome hash modules
+DIGEST_MODULES = {
+    'md5': 'MD5',
+    'sha1': 'SHA1',
+    'sha224': 'SHA224',
+    'sha256': 'SHA256',
+    'sha384': 'SHA384',
+    'sha512': 'SHA512',
+    'sha3-224': 'SHA3_224',
+    'sha3-256': 'SHA3_256',
+    'sha3-384': 'SHA3_384',
+    'sha3-512': 'SHA3_512',
+}
+
+
+class Signer():
+    """
+    Signer for section images.
+
+    The private key is parsed once and signatures are computed in-process from a digest which
+    is updated while the image is written, so that images do not need to be read back.
+    The signatures are the same as the ones produced by "openssl dgst -<dgst> -sign". If the key
+    or the digest is not supported in-process, or if pycryptodome is not installed, openssl is
+    called on the written image instead.
+
+    Attributes
+    ----------
+    pem_path : str
+        Path of the PEM private key.
+    dgst : str
+        Openssl name of the digest algorithm.
+    """
+
+    def __init__(self, pem_path: str, dgst: str='sha256'):
+        self.pem_path = pem_path
+        self.dgst = dgst
+        self.hash_module = None
+        self.scheme = None
+        # Signature schemes are not documented as thread-safe, sections may be signed
+        # concurrently
+        self.lock = threading.Lock()
+
+        self.__load_key()
+
+
+    def new_digest(self) -> any:
+        """Return a new digest object for an image to be signed.
+
+        The digest must be updated with the whole image content and then given to sign.
+
+        Returns
+        -------
+        any
+            The digest object, or None if the signature is done with openssl.
+        """
+        if self.scheme is None:
+            return None
+
+        return self.hash_module.new()
+
+
+    def sign(self, image_path: str, digest: any=None) -> int:
+        """Sign an image.
+
+        The signature is dumped to the image path with the .sig extension.
+
+        Parameters
+        ----------
+        image_path : str
+            Path of the image.
+        digest : any
+            Digest of the image content returned by new_digest, or None to sign with openssl.
+
+        Returns
+        -------
+        int
+            The size of the signature, or None if the image could not be signed.
+        """
+        signature_path = image_path + '.sig'
+
+        if digest is not None:
+            try:
+                with self.lock, gapylib.trace.span('sign', path=image_path):
+                    signature = self.scheme.sign(digest)
+            except (ValueError, TypeError) as exc:
+                logging.debug('In-process signing failed, using openssl (%s)', exc)
+            else:
+                try:
+                    with open(signature_path, 'wb') as file_desc:
+                        file_desc.write(signature)
+                except OSError as exc:
+                    raise RuntimeError('Unable to open signature for writing ' +
+                        str(exc)) from exc
+
+                return len(signature)
+
+        with gapylib.trace.span('openssl sign', path=image_path):
+            proc = subprocess.run(['openssl', 'dgst', f'-{self.dgst}', '-sign', self.pem_path,
+                '-out', signature_path, image_path], check=False)
+
+        if proc.returncode != 0:
+            print(f'Failed to sign binary {image_path}')
+            return None
+
+        return os.path.getsize(signature_path)
+
+
+    def __load_key(self):
+        # pycryptodome is imported only when something is signed since it is slow to import
+        try:
+            # pylint: disable=import-outside-toplevel
+            from Crypto.PublicKey import RSA, ECC, DSA
+            from Crypto.Signature import pkcs1_15, DSS
+        except ImportError:
+            logging.debug('pycryptodome is not available, signing with openssl')
+            return
+
+        module_name = DIGEST_MODULES.get(self.dgst.lower())
+        if module_name is None:
+            logging.debug('Digest %s not supported in-process, signing with openssl', self.dgst)
+            return
+
+        try:
+            with open(self.pem_path, 'rb') as file_desc:
+                pem = file_desc.read()
+        except OSError as exc:
+            raise RuntimeError(f'Unable to open signing key {self.pem_path}: {exc}') from exc
+
+        for key_module in [RSA, ECC, DSA]:
+            try:
+                key = key_module.import_key(pem)
+            except (ValueError, IndexError, TypeError):
+                continue
+
+            if key_module is RSA:
+                self.scheme = pkcs1_15.new(key)
+            elif key_module is ECC and key.curve.lower().startswith('ed'):
+                # EdDSA keys can not be used with a pre-computed digest
+                break
+            else:
+                self.scheme = DSS.new(key, 'fips-186-3', encoding='der')
+
+            self.hash_module = importlib.import_module('Crypto.Hash.' + module_name)
+            return
+
+        logging.debug('Key %s not supported in-process, signing with openssl', self.pem_path)
+
+
+@functools.lru_cache(maxsize=None)
+def get_signer(pem_path: str, dgst: str='sha256') -> Signer:
+    """Return the signer for a key and a digest.
+
+    The signer is created only once so that the key is parsed only once for all sections and
+    all flashes.
+
+    Parameters
+    ----------
+    pem_path : str
+        Path of the PEM private key.
+    dgst : str
+        Openssl name of the digest algorithm.
+
+    Returns
+    -------
+    Signer
+        The signer.
+    """
+    return Signer(pem_path, dgst)
@@ -0,0 +1,184 @@
+"""Provides the profiler of the gapy startup time"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+# This module is imported before anything else by gapy, it must stay cheap to import
+import sys
+import time
+
+
+class StartupProfiler():
+    """
+    Profiler of the gapy startup time.
+
+    It records the time spent in each phase of the command and, for each module imported while
+    it is enabled, the time spent executing the module, with and without its own imports.
+    When it is disabled, phases cost nothing and imports are not tracked.
+
+    Attributes
+    ----------
+    enabled : bool
+        True if the profiler records anything.
+    """
+
+    def __init__(self, enabled: bool=True):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.phases = []
+        # Self and cumulative import time, indexed by module name
+        self.imports = {}
+        self.import_stack = []
+
+        if enabled:
+            sys.meta_path.insert(0, _ImportTimer(self))
+
+    def phase(self, name: str) -> '_Phase':
+        """Return a context manager measuring a phase.
+
+        Parameters
+        ----------
+        name : str
+            Name of the phase.
+
+        Returns
+        -------
+        _Phase
+            The context manager.
+        """
+        return _Phase(self, name)
+
+    def enter_import(self, name: str):
+        """Notify the beginning of a module execution.
+
+        Parameters
+        ----------
+        name : str
+            Name of the module.
+        """
+        self.import_stack.append([name, time.perf_counter(), 0])
+
+    def leave_import(self, name: str):
+        """Notify the end of a module execution.
+
+        Parameters
+        ----------
+        name : str
+            Name of the module.
+        """
+        _, start, children_time = self.import_stack.pop()
+        duration = time.perf_counter() - start
+        if len(self.import_stack) > 0:
+            self.import_stack[-1][2] += duration
+
+        self.imports[name] = [duration - children_time, duration]
+
+    def dump(self, nb_imports: int=20):
+        """Print the profile to the standard error.
+
+        Parameters
+        ----------
+        nb_imports : int
+            Number of imports to be printed, the slowest ones are printed first.
+        """
+        if not self.enabled:
+            return
+
+        total = time.perf_counter() - self.start
+        out = sys.stderr
+
+        print(f'\nStartup profile (total {total * 1000:.1f} ms, from gapy script start)',
+            file=out)
+
+        print(f'\n  {"Phase":40s} {"Time (ms)":>10s}', file=out)
+        for name, duration in self.phases:
+            print(f'  {name:40s} {duration * 1000:10.1f}', file=out)
+
+        imports = sorted(self.imports.items(), key=lambda item: item[1][1], reverse=True)
+        imports_time = sum(times[0] for times in self.imports.values())
+
+        print(f'\n  {len(self.imports)} modules imported in {imports_time * 1000:.1f} ms, '
+            f'slowest ones:', file=out)
+        print(f'  {"Module":40s} {"Self (ms)":>10s} {"Cumul (ms)":>10s}', file=out)
+        for name, times in imports[:nb_imports]:
+            print(f'  {name:40s} {times[0] * 1000:10.1f} {times[1] * 1000:10.1f}', file=out)
+
+
+class _Phase():
+
+    def __init__(self, profiler: StartupProfiler, name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.profiler.enabled:
+            self.profiler.phases.append([self.name, time.perf_counter() - self.start])
+
+
+class _ImportTimer():
+    # Meta path finder which finds modules with the other finders and wraps their loaders to
+    # measure the module executions
+
+    def __init__(self, profiler: StartupProfiler):
+        self.profiler = profiler
+
+    def find_spec(self, fullname: str, path: any, target: any=None) -> any:
+        """Find the module spec with the other finders and wrap its loader."""
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, self.profiler)
+                return spec
+
+        return None
+
+
+class _TimedLoader():
+    # Loader measuring the module execution, everything else is given to the real loader
+
+    def __init__(self, loader: any, profiler: StartupProfiler):
+        self.loader = loader
+        self.profiler = profiler
+
+    def __getattr__(self, name: str) -> any:
+        return getattr(self.loader, name)
+
+    def create_module(self, spec: any) -> any:
+        """Create the module with the real loader."""
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module: any):
+        """Execute the module with the real loader and measure it."""
+        self.profiler.enter_import(module.__name__)
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.profiler.leave_import(module.__name__)
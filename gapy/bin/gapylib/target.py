@@ -22,20 +22,18 @@
 
 
 
-import traceback
 import argparse
-import inspect
 import os
 import importlib
 import json
 from collections import OrderedDict
 import sys
-import gapylib.flash
-from prettytable import PrettyTable
-import rich.table
 
+# Modules only needed by some commands, like gapylib.flash, prettytable or rich, are imported
+# when they are used, to keep the startup time low for commands which do not need them.
 
-def get_target(target: str) -> 'Target':
+
+def get_target(target: str, target_dirs: list=None) -> 'Target':
     """Returns the class implementing the support for the specified target.
 
     The target is specified as a python module which is imported from python path.
@@ -45,6 +43,9 @@ def get_target(target: str) -> 'Target':
     ----------
     target : str
         Name of the target. The name must corresponds to a python module.
+    target_dirs : list
+        Directories where targets are looked for, used to suggest targets when the specified one
+        is not found.
 
     Returns
     -------
@@ -57,7 +58,13 @@ def get_target(target: str) -> 'Target':
 
     except ModuleNotFoundError as exc:
         if exc.name == target:
-            raise RuntimeError(f'Invalid target specified: {target}') from exc
+            message = f'Invalid target specified: {target}'
+            if target_dirs is not None:
+                import gapylib.target_index # pylint: disable=import-outside-toplevel
+                suggestions = gapylib.target_index.TargetIndex(target_dirs).get_suggestions(target)
+                if len(suggestions) > 0:
+                    message += f' (did you mean: {", ".join(suggestions)}?)'
+            raise RuntimeError(message) from exc
 
         raise RuntimeError(f"Dependency '{exc.name}' of the target module '{target}' is"
             " missing (add --py-stack for more information).") from exc
@@ -67,7 +74,7 @@ def get_target(target: str) -> 'Target':
         target_class = getattr(module, 'Target', None)
 
         # Check that the class comes from the module itself and not from an imported one
-        if inspect.isclass(target_class) and target_class.__module__ == module.__name__:
+        if isinstance(target_class, type) and target_class.__module__ == module.__name__:
 
             return target_class
 
@@ -150,6 +157,25 @@ class Target():
             parser.add_argument("--flash-no-auto", dest="flash_auto", action="store_false",
                 help="Flash auto-mode, will force the flash content update only if needed")
 
+            parser.add_argument("--jobs", dest="jobs", type=int, default=1,
+                help="Maximum number of flashes and sections whose images are generated "
+                    "concurrently")
+
+            parser.add_argument("--flash-no-incremental", dest="flash_incremental",
+                action="store_false",
+                help="Always generate the whole flash images instead of only the sections "
+                    "which changed since the previous generation")
+
+            parser.add_argument("--flash-image-store", dest="image_store", default=None,
+                help="Directory of a cache of generated images shared between work directories. "
+                    "Images which were already generated with the same content are taken from "
+                    "it instead of being generated again")
+
+            parser.add_argument("--flash-image-store-size", dest="image_store_size", type=int,
+                default=4096,
+                help="Maximum size in MiB of the image store, the least recently used images "
+                    "are removed beyond it")
+
             parser.add_argument("--binary", dest = "binary", default = None,
                 help = "Binary to execute on the target")
 
@@ -188,6 +214,7 @@ class Target():
         self.layout_level = 0
         self.pem_path = None
         self.sign_dgst = None
+        self.jobs = 1
         self.args = None
         self.target_properties = {}
         self.args_properties = {}
@@ -222,7 +249,7 @@ class Target():
 
 
 
-    def register_flash(self, flash: gapylib.flash.Flash):
+    def register_flash(self, flash: 'gapylib.flash.Flash'):
         """Register a flash.
 
         The flash should inherit from gapylib.flash.Flash.
@@ -279,15 +306,23 @@ class Target():
         This can be called if a class is overloading the image command, in order to still
         execute the generic part of this command.
         """
-        for flash in self.flashes.values():
-            if not flash.is_empty():
-                sections = flash.get_sections()
+        import gapylib.parallel # pylint: disable=import-outside-toplevel
+
+        # Flashes are independent, their images can be generated concurrently
+        gapylib.parallel.run_parallel(self.jobs, self.__dump_flash_image, self.flashes.values())
+
+    @staticmethod
+    def __dump_flash_image(flash: 'gapylib.flash.Flash'):
+        if not flash.is_empty():
+            sections = flash.get_sections()
 
-                first_index = 0
-                index_to_last= 0
-                while sections[-1 - index_to_last].is_empty():
-                    index_to_last+=1
+            first_index = 0
+            index_to_last= 0
+            while sections[-1 - index_to_last].is_empty():
+                index_to_last+=1
 
+            import gapylib.trace # pylint: disable=import-outside-toplevel
+            with gapylib.trace.span('flash dump_image', flash=flash.get_name()):
                 flash.dump_image(first_index, len(sections)-1-index_to_last)
 
     def handle_command(self, cmd: str):
@@ -377,6 +412,7 @@ class Target():
         self.parse_target_properties()
 
         if self.target_properties.get(descriptor.full_name) is not None:
+            import traceback # pylint: disable=import-outside-toplevel
             traceback.print_stack()
             raise RuntimeError(f'Property {descriptor.full_name} already declared')
 
@@ -472,6 +508,8 @@ class Target():
     def dump_target_properties(self):
         """Dump the properties of the target.
         """
+        from prettytable import PrettyTable # pylint: disable=import-outside-toplevel
+
         table = PrettyTable()
         table.field_names = ["Property name", "Value", "Allowed values", "Description"]
         for prop in self.target_properties.values():
@@ -508,6 +546,19 @@ class Target():
         self.pem_path = args.pem_path
         self.sign_dgst = args.sign_dgst
 
+        self.jobs = args.jobs
+
+        image_store = None
+        if args.image_store is not None:
+            import gapylib.image_store # pylint: disable=import-outside-toplevel
+            image_store = gapylib.image_store.ImageStore(args.image_store,
+                args.image_store_size * 1024 * 1024)
+
+        for flash in self.flashes.values():
+            flash.set_incremental(args.flash_incremental)
+            flash.set_jobs(args.jobs)
+            flash.set_image_store(image_store)
+
         # Parse the flash properties so that we can propagate to each flash only its properties
         if len(args.flash_properties) != 0:
             self.__extract_flash_properties(args.flash_properties)
@@ -597,61 +648,21 @@ class Target():
         return self.work_dir
 
 
-    def __get_target_files(self):
-
-        result = []
-
-        for path in self.target_dirs:
-            for root, __, files in os.walk(path):
-
-                for file in files:
-                    if file.endswith('.py') and file != '__init__.py':
-                        if root == path:
-                            file_path = file
-                        else:
-                            rel_dir = os.path.relpath(root, path)
-                            file_path = os.path.join(rel_dir, file)
-
-                        target_name = file_path.replace('/', '.').replace('.py', '')
-
-                        result.append(target_name)
-
-        return result
-
-
     def __display_targets(self):
+        # pylint: disable=import-outside-toplevel
+        import rich
+        import rich.table
+        import gapylib.target_index
 
         table = rich.table.Table(title='Available targets')
         table.add_column('Name')
         table.add_column('Description')
 
-        targets = {}
-
-        # Go through all files from target directories and check which one is having a valid
-        # Gapy target
-        for target_name in self.__get_target_files():
-            try:
-                module = importlib.import_module(target_name)
-
-            except ModuleNotFoundError:
-                continue
-
-            # Gapy targets have a Target class inside the module
-            if 'Target' in dir(module):
-
-                target_class = getattr(module, 'Target', None)
-
-                # Check that the class comes from the module itself and not from an imported one
-                if inspect.isclass(target_class) and target_class.__module__ == module.__name__:
-
-                    # And must have the is_gapy_target attribute
-                    if getattr(target_class, 'is_gapy_target') is True:
-
-                        if targets.get(target_name) is None:
-                            targets[target_name] = True
-
-                            table.add_row(target_name,
-                                f'{getattr(target_class, "gapy_description")}')
+        # Targets are found from the index of the target directories, which only imports the
+        # modules which can not be checked statically
+        for target_name, description in \
+                gapylib.target_index.TargetIndex(self.target_dirs).get_targets().items():
+            table.add_row(target_name, description)
 
         rich.print(table)
 
@@ -0,0 +1,384 @@
+"""Provides the persistent index of the targets found in target directories"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+import ast
+import difflib
+import importlib
+import inspect
+import json
+import logging
+import os
+from collections import OrderedDict
+
+from gapylib.cache import get_cache_dir
+
+
+# Version of the index format, an index with a different version is ignored
+INDEX_VERSION = 1
+
+# Name of the index file in the cache directory
+INDEX_FILE = 'targets.json'
+
+# The module contains a gapy target
+KIND_TARGET = 'target'
+# The module does not contain any gapy target
+KIND_NONE = 'none'
+# The module may contain a gapy target, it must be imported to know it
+KIND_AMBIGUOUS = 'ambiguous'
+
+# Base classes of gapy targets, a class deriving from another class may not be a gapy target
+TARGET_BASE_CLASSES = ['gapylib.target.Target', 'gvsoc.runner.Target']
+
+
+def inspect_target_file(path: str) -> dict:
+    """Check if a python file contains a gapy target without importing it.
+
+    A gapy target is a class named Target defined by the module itself. The class is looked for
+    in the module syntax tree. A module marked with GAPY_TARGET set to True is a target as soon
+    as it defines this class, otherwise the class must derive from one of the gapy target base
+    classes, as imported by the module.
+    The result is ambiguous if the class is built dynamically or conditionally, if it derives
+    from other classes, or if its description is not given as a literal in the class, since it
+    is then inherited.
+
+    Parameters
+    ----------
+    path : str
+        Path of the python file.
+
+    Returns
+    -------
+    dict
+        The index entry, with the kind of module and the target description.
+    """
+    try:
+        with open(path, 'rb') as file_desc:
+            source = file_desc.read()
+    except OSError:
+        return {'kind': KIND_NONE}
+
+    # Most files do not even mention it, no need to parse them
+    if b'Target' not in source:
+        return {'kind': KIND_NONE}
+
+    try:
+        tree = ast.parse(source, filename=path)
+    except (SyntaxError, ValueError):
+        return {'kind': KIND_AMBIGUOUS}
+
+    target_node = None
+    gapy_target = None
+    # Modules or objects bound by the imports of the module, by name
+    imports = {}
+    for node in tree.body:
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            if node.name == 'Target':
+                target_node = node
+
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            names = _get_assigned_names(targets)
+            if 'Target' in names:
+                target_node = node
+            if 'GAPY_TARGET' in names and isinstance(node.value, ast.Constant):
+                gapy_target = node.value.value
+
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if (alias.asname or alias.name.split('.')[0]) == 'Target':
+                    target_node = node
+            _add_imports(imports, node)
+
+        elif isinstance(node, (ast.If, ast.Try, ast.With, ast.For, ast.While)):
+            # Definitions in blocks depend on the execution
+            for child in ast.walk(node):
+                if (isinstance(child, ast.ClassDef) and child.name == 'Target') or \
+                        (isinstance(child, ast.Name) and child.id == 'Target' and
+                        isinstance(child.ctx, ast.Store)):
+                    return {'kind': KIND_AMBIGUOUS}
+
+    if isinstance(target_node, (ast.Assign, ast.AnnAssign)):
+        return {'kind': KIND_AMBIGUOUS}
+
+    # Imported classes are rejected since they do not come from the module itself
+    if not isinstance(target_node, ast.ClassDef):
+        return {'kind': KIND_NONE}
+
+    if gapy_target is not True:
+        if len(target_node.bases) == 0:
+            return {'kind': KIND_NONE}
+
+        # Only the import can tell if other classes are gapy targets
+        if not any(_resolve_name(imports, base) in TARGET_BASE_CLASSES
+                for base in target_node.bases):
+            return {'kind': KIND_AMBIGUOUS}
+
+    attributes = {}
+    for node in target_node.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant):
+            for name in _get_assigned_names(node.targets):
+                attributes[name] = node.value.value
+
+    if attributes.get('is_gapy_target', True) is not True:
+        return {'kind': KIND_NONE}
+
+    description = attributes.get('gapy_description')
+    if description is None:
+        return {'kind': KIND_AMBIGUOUS}
+
+    return {'kind': KIND_TARGET, 'description': str(description)}
+
+
+def _add_imports(imports: dict, node: ast.stmt):
+    for alias in node.names:
+        if isinstance(node, ast.Import):
+            if alias.asname is not None:
+                imports[alias.asname] = alias.name
+            else:
+                name = alias.name.split('.')[0]
+                imports[name] = name
+        elif node.level == 0 and node.module is not None:
+            imports[alias.asname or alias.name] = f'{node.module}.{alias.name}'
+        else:
+            # Relative imports can not be resolved without knowing the package
+            imports.pop(alias.asname or alias.name, None)
+
+
+def _resolve_name(imports: dict, node: ast.expr) -> str:
+    # Return the full name of the object designated by an expression like a.b.c, according to
+    # the imports of the module
+    attributes = []
+    while isinstance(node, ast.Attribute):
+        attributes.insert(0, node.attr)
+        node = node.value
+
+    if not isinstance(node, ast.Name) or imports.get(node.id) is None:
+        return None
+
+    return '.'.join([imports[node.id]] + attributes)
+
+
+def _get_assigned_names(targets: list) -> list:
+    result = []
+    for target in targets:
+        for node in ast.walk(target):
+            if isinstance(node, ast.Name):
+                result.append(node.id)
+    return result
+
+
+class TargetIndex():
+    """
+    Persistent index of the targets found in target directories.
+
+    Each python file of the target directories is inspected statically to know if it contains a
+    gapy target, and is only imported when this is ambiguous. The result is kept in the gapy
+    cache directory, keyed by file path, modification time and size, so that files are only
+    inspected again when they are modified.
+
+    Attributes
+    ----------
+    target_dirs : list
+        Directories where targets are looked for.
+    """
+
+    def __init__(self, target_dirs: list):
+        self.target_dirs = target_dirs
+        cache_dir = get_cache_dir()
+        self.path = None if cache_dir is None else os.path.join(cache_dir, INDEX_FILE)
+        self.entries = self.__load()
+        self.modified = False
+
+
+    def get_target_names(self) -> list:
+        """Return the names of the modules which may contain a target.
+
+        No module is imported, ambiguous modules are included.
+
+        Returns
+        -------
+        list
+            The module names.
+        """
+        result = []
+        seen = set()
+        for name, entry in self.__scan():
+            if name in seen:
+                continue
+            seen.add(name)
+
+            if entry['kind'] != KIND_NONE:
+                result.append(name)
+
+        self.save()
+        return result
+
+
+    def get_targets(self) -> OrderedDict:
+        """Return the targets.
+
+        Ambiguous modules are imported to know if they contain a target.
+
+        Returns
+        -------
+        OrderedDict
+            The description of each target, indexed by module name.
+        """
+        result = OrderedDict()
+        seen = set()
+        for name, entry in self.__scan():
+            # Modules are imported from the first directory containing them
+            if name in seen:
+                continue
+            seen.add(name)
+
+            if entry['kind'] == KIND_AMBIGUOUS:
+                self.__resolve(name, entry)
+
+            if entry['kind'] == KIND_TARGET:
+                result[name] = entry['description']
+
+        self.save()
+        return result
+
+
+    def get_suggestions(self, name: str) -> list:
+        """Return the targets with a name close to the specified one.
+
+        Parameters
+        ----------
+        name : str
+            The name.
+
+        Returns
+        -------
+        list
+            The names of the closest targets.
+        """
+        names = self.get_target_names()
+
+        result = [target for target in names if target.endswith('.' + name)]
+        for target in difflib.get_close_matches(name, names, n=3):
+            if target not in result:
+                result.append(target)
+
+        return result[:3]
+
+
+    def save(self):
+        """Save the index to the cache directory, if it has been modified."""
+        if self.path is None or not self.modified:
+            return
+
+        content = {'version': INDEX_VERSION, 'files': self.entries}
+
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as file_desc:
+                json.dump(content, file_desc)
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            logging.debug('Unable to save target index %s: %s', self.path, exc)
+            return
+
+        self.modified = False
+
+
+    def __scan(self) -> list:
+        result = []
+
+        for path in self.target_dirs:
+            dir_path = os.path.abspath(path)
+            seen = set()
+
+            for root, __, files in os.walk(dir_path):
+                for file in files:
+                    if not file.endswith('.py') or file == '__init__.py':
+                        continue
+
+                    file_path = os.path.join(root, file)
+                    name = os.path.relpath(file_path, dir_path)[:-3].replace(os.sep, '.')
+
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue
+
+                    seen.add(file_path)
+                    entry = self.entries.get(file_path)
+                    if entry is None or entry.get('mtime_ns') != stat.st_mtime_ns or \
+                            entry.get('size') != stat.st_size:
+                        entry = inspect_target_file(file_path)
+                        entry['mtime_ns'] = stat.st_mtime_ns
+                        entry['size'] = stat.st_size
+                        self.entries[file_path] = entry
+                        self.modified = True
+
+                    result.append([name, entry])
+
+            # Forget files which were removed from this directory
+            for file_path in list(self.entries.keys()):
+                if file_path.startswith(dir_path + os.sep) and file_path not in seen:
+                    del self.entries[file_path]
+                    self.modified = True
+
+        return result
+
+
+    def __resolve(self, name: str, entry: dict):
+        logging.debug('Importing module %s to check if it is a target', name)
+
+        try:
+            module = importlib.import_module(name)
+        except ModuleNotFoundError:
+            # Keep it ambiguous, it may be imported next time
+            return
+
+        entry['kind'] = KIND_NONE
+        self.modified = True
+
+        target_class = getattr(module, 'Target', None)
+
+        # Check that the class comes from the module itself and not from an imported one
+        if inspect.isclass(target_class) and target_class.__module__ == module.__name__:
+
+            # And must have the is_gapy_target attribute
+            if getattr(target_class, 'is_gapy_target', False) is True:
+                entry['kind'] = KIND_TARGET
+                entry['description'] = f'{getattr(target_class, "gapy_description")}'
+
+
+    def __load(self) -> dict:
+        if self.path is None:
+            return {}
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file_desc:
+                content = json.load(file_desc)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(content, dict) or content.get('version') != INDEX_VERSION:
+            return {}
+
+        return content.get('files', {})
@@ -0,0 +1,260 @@
+"""Provides the performance tracing of gapy, exported as Chrome trace events"""
+
+#
+# Copyright (C) 2022 GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Authors: Germain Haugou, GreenWaves Technologies (germain.haugou@greenwaves-technologies.com)
+#
+
+
+#
+# Code measures its phases with spans, which cost nothing when tracing is disabled:
+#
+#   with gapylib.trace.span('section write', flash=flash_name, section=section_name) as span:
+#       ...
+#       span.set_arg('bytes', size)
+#
+# Spans can be nested and can be opened from several threads. The trace can be opened with
+# chrome://tracing or https://ui.perfetto.dev.
+#
+
+
+import json
+import os
+import sys
+import threading
+import time
+
+
+# Tracer recording the spans, None when tracing is disabled
+_tracer = None
+
+
+def enable(path: str):
+    """Enable tracing.
+
+    Parameters
+    ----------
+    path : str
+        Path of the Chrome trace file written by dump.
+    """
+    global _tracer # pylint: disable=global-statement
+    _tracer = Tracer(path)
+
+
+def is_enabled() -> bool:
+    """Tell if tracing is enabled.
+
+    Returns
+    -------
+    bool
+        True if tracing is enabled.
+    """
+    return _tracer is not None
+
+
+def span(name: str, **args: any) -> 'Span':
+    """Return a context manager measuring a span.
+
+    Parameters
+    ----------
+    name : str
+        Name of the span, the summary groups spans by name.
+    args : any
+        Arguments of the span, like flash and section names or byte counts. A template argument
+        also groups the spans in the summary.
+
+    Returns
+    -------
+    Span
+        The context manager.
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return Span(_tracer, name, args)
+
+
+def dump():
+    """Write the trace file and print the summary of the spans to the standard error.
+
+    Nothing is done if tracing is disabled.
+    """
+    if _tracer is not None:
+        _tracer.dump()
+
+
+class Tracer():
+    """
+    Recorder of the spans of a gapy execution.
+
+    Attributes
+    ----------
+    path : str
+        Path of the Chrome trace file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.start = time.perf_counter()
+        self.events = []
+        # Span names and durations, with and without nested spans, for the summary
+        self.summary = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.threads = {}
+
+    def get_stack(self) -> list:
+        """Return the stack of the spans opened by the current thread.
+
+        Returns
+        -------
+        list
+            The stack, the last element is the innermost span.
+        """
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def add_span(self, name: str, args: dict, start: float, duration: float, self_duration: float):
+        """Record a finished span.
+
+        Parameters
+        ----------
+        name : str
+            Name of the span.
+        args : dict
+            Arguments of the span.
+        start : float
+            Start time, from time.perf_counter.
+        duration : float
+            Duration in seconds, including nested spans.
+        self_duration : float
+            Duration in seconds, excluding nested spans.
+        """
+        thread_id = threading.get_ident()
+
+        with self.lock:
+            tid = self.threads.get(thread_id)
+            if tid is None:
+                tid = self.threads[thread_id] = len(self.threads)
+
+            self.events.append({
+                'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                'ts': round((start - self.start) * 1000000, 3),
+                'dur': round(duration * 1000000, 3),
+                'args': args
+            })
+
+            key = name if args.get('template') is None else f'{name} [{args["template"]}]'
+            entry = self.summary.get(key)
+            if entry is None:
+                entry = self.summary[key] = [0, 0.0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] += self_duration
+            entry[3] += args.get('bytes', 0)
+
+    def dump(self):
+        """Write the trace file and print the summary of the spans to the standard error."""
+        content = {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+        try:
+            with open(self.path, 'w', encoding='utf-8') as file_desc:
+                json.dump(content, file_desc, default=str)
+        except OSError as exc:
+            raise RuntimeError(f'Unable to write trace file {self.path}: {exc}') from exc
+
+        out = sys.stderr
+        total = time.perf_counter() - self.start
+
+        print(f'\nTrace summary (total {total * 1000:.1f} ms, trace written to {self.path})',
+            file=out)
+        print(f'\n  {"Span":50s} {"Count":>7s} {"Total (ms)":>11s} {"Self (ms)":>11s} '
+            f'{"MiB":>9s}', file=out)
+
+        summary = sorted(self.summary.items(), key=lambda item: item[1][2], reverse=True)
+        for name, (count, duration, self_duration, nb_bytes) in summary:
+            size = f'{nb_bytes / (1024 * 1024):9.2f}' if nb_bytes != 0 else f'{"-":>9s}'
+            print(f'  {name:50s} {count:7d} {duration * 1000:11.1f} {self_duration * 1000:11.1f} '
+                f'{size}', file=out)
+
+
+class Span():
+    """
+    Span being measured.
+
+    Attributes
+    ----------
+    tracer : Tracer
+        Tracer recording the span.
+    name : str
+        Name of the span.
+    args : dict
+        Arguments of the span.
+    """
+
+    def __init__(self, tracer: Tracer, name: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+        # Time spent in nested spans
+        self.children_duration = 0.0
+
+    def set_arg(self, name: str, value: any):
+        """Set an argument of the span.
+
+        Parameters
+        ----------
+        name : str
+            Name of the argument.
+        value : any
+            Value of the argument. The bytes argument is summed in the summary.
+        """
+        self.args[name] = value
+
+    def __enter__(self):
+        self.tracer.get_stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        duration = time.perf_counter() - self.start
+
+        stack = self.tracer.get_stack()
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1].children_duration += duration
+
+        self.tracer.add_span(self.name, self.args, self.start, duration,
+            duration - self.children_duration)
+
+
+class _NullSpan():
+    # Span returned when tracing is disabled
+
+    def set_arg(self, name: str, value: any):
+        """Ignore the argument."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
@@ -22,10 +22,21 @@
 
 
 from collections import OrderedDict
+import hashlib
+import io
+import os.path
+import shutil
 import struct
-from prettytable import PrettyTable
+import sys
+import typing
 
+import gapylib.crc
+import gapylib.trace
 from gapylib.flash import FlashSection
+from gapylib.image_writer import ImageWriter, ZERO_CHUNK_SIZE
+
+if typing.TYPE_CHECKING:
+    from prettytable import PrettyTable
 
 def compute_crc(init : int, buff: bytes):
     """
@@ -41,16 +52,76 @@ def compute_crc(init : int, buff: bytes):
     crc : int
         crc of the scalar bytes
     """
-    crc = init
-    for _, data in enumerate(buff):
-        crc = crc ^ data
-        for _ in range(7, -1, -1):
-            if crc & 1 == 1:
-                mask = 0xffffffff
-            else:
-                mask = 0
-            crc = (crc >> 1) ^ (0xEDB88320 & mask)
-    return crc ^ 0xffffffff
+    return gapylib.crc.compute_crc(init, buff)
+
+# Size of the chunks read when hashing a file
+HASH_CHUNK_SIZE = 1 << 20
+
+def hash_file(path: str) -> str:
+    """
+    Compute the SHA-256 hash of the content of a host file
+    Parameters
+    -----------
+    path : str
+        Path of the host file
+    Returns
+    -------
+    str
+        The hash as an hexadecimal string
+    """
+    file_hash = hashlib.sha256()
+    try:
+        with open(path, 'rb') as file_desc:
+            while True:
+                data = file_desc.read(HASH_CHUNK_SIZE)
+                if len(data) == 0:
+                    break
+                file_hash.update(data)
+    except OSError as exc:
+        raise RuntimeError(f'Unable to read file {path}: {exc}') from exc
+
+    return file_hash.hexdigest()
+
+# Linux ioctl cloning a file into another one, on file systems supporting it
+FICLONE = 0x40049409
+
+def clone_file(src: str, dst: str, hardlink: bool=True):
+    """
+    Give the content of a host file to another path in the cheapest possible way
+
+    This is a copy-on-write clone if the file system supports it, then a hardlink if they are
+    allowed, and a copy as last resort. With a hardlink, the two paths share the same file,
+    so that modifying one also modifies the other.
+    Parameters
+    -----------
+    src : str
+        Path of the host file
+    dst : str
+        Path of the new file, which must not exist
+    hardlink : bool
+        True if a hardlink can be used
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            # pylint: disable=import-outside-toplevel
+            import fcntl
+            with open(src, 'rb') as src_desc, open(dst, 'wb') as dst_desc:
+                fcntl.ioctl(dst_desc.fileno(), FICLONE, src_desc.fileno())
+            return
+        except (ImportError, OSError):
+            try:
+                os.remove(dst)
+            except OSError:
+                pass
+
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
 
 class CStructField():
     """
@@ -68,12 +139,43 @@ class CStructField():
         Offset of this field in the flash.
     """
 
+    # Fields can be numerous, they are kept small by avoiding per-instance dictionaries
+    __slots__ = ('name', 'size', '__offset', 'values', 'index')
+
     def __init__(self, name: str, size: int, value: any, offset: int):
         self.name = name
         self.size = size
-        self.value = value
+        # The value is stored in a list, which is the compact list of values of the structure
+        # once the field is attached to it
+        self.values = [value]
+        self.index = 0
         self.__offset = offset
 
+    @property
+    def value(self) -> any:
+        """Field value."""
+        return self.values[self.index]
+
+    @value.setter
+    def value(self, value: any):
+        self.values[self.index] = value
+
+    def attach(self, values: list):
+        """Attach the field to a list of values.
+
+        The field value is moved to the end of the list and is then stored there, so that a
+        structure can keep the values of all its fields in a single list which is directly given
+        to struct for packing.
+
+        Parameters
+        ----------
+        values : list
+            The list of values.
+        """
+        values.append(self.values[self.index])
+        self.values = values
+        self.index = len(values) - 1
+
     def get_offset(self) -> any:
         """Get field offset in flash.
 
@@ -101,7 +203,9 @@ class CStructScalar(CStructField):
     Class for scalar fields.
     """
 
-    def dump_table(self, table: PrettyTable, level: int):
+    __slots__ = ()
+
+    def dump_table(self, table: 'PrettyTable', level: int):
         """Dump the field to a table.
 
         This declaration is propagated towards the parents so that the runner taking care of
@@ -130,12 +234,24 @@ class CStructScalar(CStructField):
         """
         return self.value.to_bytes(self.size, 'little')
 
+    def write_image(self, writer: ImageWriter):
+        """Stream the field value to the specified writer.
+
+        Parameters
+        ----------
+        writer : ImageWriter
+            The writer where the field is dumped.
+        """
+        writer.write(self.get_bytes())
+
 class CStructArray(CStructField):
     """
     Class for scalar fields.
     """
 
-    def dump_table(self, table: PrettyTable, level: int):
+    __slots__ = ()
+
+    def dump_table(self, table: 'PrettyTable', level: int):
         """Dump the field to a table.
 
         This declaration is propagated towards the parents so that the runner taking care of
@@ -153,14 +269,14 @@ class CStructArray(CStructField):
         # content in rows of 32 items of 16bits hex numbers
         if level > 0:
             value = ''
-            size = len(self.value)
-            size = min(size, 1 << 10)
+            data = self.get_head(1 << 10)
+            size = len(data)
             index = 0
             while size > 0:
                 iter_size = min(32, size)
                 line = ''
                 for i in range(0, iter_size):
-                    line += '%2.2x' % self.value[index]
+                    line += '%2.2x' % data[index]
                     if i % 2 == 1:
                         line += ' '
                     index += 1
@@ -189,6 +305,326 @@ class CStructArray(CStructField):
         #return to_str.encode()
         return self.value
 
+    def get_head(self, size: int) -> bytes:
+        """Get the beginning of the field value.
+
+        Parameters
+        ----------
+        size : int
+            Maximum number of bytes to be returned.
+
+        Returns
+        ----------
+        bytes
+            The first bytes of the value.
+        """
+        return self.value[:size]
+
+    def is_streamed(self) -> bool:
+        """Tell if the field should be streamed instead of being packed with its structure.
+
+        This is the case when the part of the array which has not been set, and which is
+        implicitly filled with zeros, is big enough to be worth not being allocated.
+
+        Returns
+        -------
+        bool
+            True if the field should be streamed.
+        """
+        return self.size - len(self.value) >= ZERO_CHUNK_SIZE
+
+    def write_image(self, writer: ImageWriter):
+        """Stream the field value to the specified writer.
+
+        The part of the array which has not been set is written as zeros, which means nothing
+        needs to be allocated for empty arrays.
+
+        Parameters
+        ----------
+        writer : ImageWriter
+            The writer where the field is dumped.
+        """
+        value = self.value[:self.size]
+        writer.write(value)
+        writer.write_zeros(self.size - len(value))
+
+class CStructFileArray(CStructArray):
+    """
+    Class for array fields whose content is a range of a host file.
+
+    The file content is not read when the field is set, it is only copied to the output file
+    when the image is written, so that big files never need to be loaded in memory.
+    If the file range is smaller than the array, the rest is filled with zeros.
+
+    Attributes
+    ----------
+    path : str
+        Path of the host file, or None if the content is given as bytes.
+    file_offset : int
+        Offset of the content in the host file.
+    file_size : int
+        Size of the content taken from the host file.
+    """
+
+    def __init__(self, name: str, size: int, offset: int):
+        self.path = None
+        self.file_offset = 0
+        self.file_size = 0
+        self.__data = b''
+        super().__init__(name, size, value=b'', offset=offset)
+
+    @property
+    def value(self) -> bytes:
+        """Field value, read from the host file if the field is file-backed."""
+        if self.path is None:
+            return self.__data
+
+        return self.__read(self.file_size)
+
+    @value.setter
+    def value(self, value: bytes):
+        self.path = None
+        self.__data = value
+
+    def set_file(self, path: str, file_offset: int=0, size: int=None):
+        """Set the field content from a range of a host file.
+
+        Parameters
+        ----------
+        path : str
+            Path of the host file.
+        file_offset : int
+            Offset of the content in the host file.
+        size : int
+            Size of the content. If it is None, the rest of the file is taken. In any case, the
+            content is limited to the array size.
+        """
+        if size is None:
+            try:
+                size = os.path.getsize(path) - file_offset
+            except OSError as exc:
+                raise RuntimeError(f'Unable to access file {path}: {exc}') from exc
+
+        self.path = path
+        self.file_offset = file_offset
+        self.file_size = min(size, self.size)
+
+    def get_head(self, size: int) -> bytes:
+        if self.path is None:
+            return super().get_head(size)
+
+        return self.__read(min(size, self.file_size))
+
+    def is_streamed(self) -> bool:
+        return self.path is not None or super().is_streamed()
+
+    def write_image(self, writer: ImageWriter):
+        if self.path is None:
+            super().write_image(writer)
+            return
+
+        writer.copy_file(self.path, self.file_offset, self.file_size)
+        writer.write_zeros(self.size - self.file_size)
+
+    def __read(self, size: int) -> bytes:
+        try:
+            with open(self.path, 'rb') as file_desc:
+                file_desc.seek(self.file_offset)
+                return file_desc.read(size)
+        except OSError as exc:
+            raise RuntimeError(f'Unable to read file {self.path}: {exc}') from exc
+
+
+class CStructReservedArray(CStructArray):
+    """
+    Class for array fields reserving a region without any data.
+
+    The region is either filled with a pattern or left uninitialized, in which case it gets
+    the erased value of the flash. It is never materialized in memory.
+
+    Attributes
+    ----------
+    pattern : bytes
+        Pattern filling the region, or None if it is uninitialized.
+    parent : CStructParent
+        Sub-section containing the field, giving the erased value of the flash.
+    """
+
+    def __init__(self, name: str, size: int, offset: int, pattern: bytes=None,
+            parent: 'CStructParent'=None):
+        self.pattern = pattern
+        self.parent = parent
+        super().__init__(name, size, value=b'', offset=offset)
+
+    @property
+    def value(self) -> bytes:
+        """Field value, built from the pattern or the erased value of the flash."""
+        if self.pattern is not None:
+            pattern = self.pattern
+        elif self.parent is not None:
+            pattern = bytes([self.parent.get_erased_value()])
+        else:
+            pattern = b'\0'
+
+        return (pattern * (self.size // len(pattern) + 1))[:self.size]
+
+    def dump_table(self, table: 'PrettyTable', level: int):
+        if level <= 0:
+            value = '-'
+        elif self.pattern is None:
+            value = 'uninitialized'
+        else:
+            value = f'fill 0x{self.pattern.hex()}'
+
+        table.add_row(['0x%x' % self.get_offset(), self.name, '0x%x' % self.size, value])
+
+    def is_streamed(self) -> bool:
+        return True
+
+    def write_image(self, writer: ImageWriter):
+        if self.pattern is None:
+            writer.write_uninitialized(self.size)
+        else:
+            writer.write_fill(self.size, self.pattern)
+
+
+class CStructExtentArray(CStructArray):
+    """
+    Class for array fields made of a sequence of extents.
+
+    Each extent is either some bytes, a range of a host file or an uninitialized region, so that
+    big structured contents like file system images can be described without being built in
+    memory. The part of the array not covered by extents is left uninitialized.
+
+    Attributes
+    ----------
+    extents : list
+        The extents, as [data, path, file_offset, size] lists, where data is the content if it
+        is given as bytes and path is the host file if it comes from a file. If both are None,
+        the extent is uninitialized.
+    extents_size : int
+        Size covered by the extents.
+    parent : CStructParent
+        Sub-section containing the field, giving the erased value of the flash.
+    """
+
+    def __init__(self, name: str, size: int, offset: int, parent: 'CStructParent'=None):
+        self.extents = []
+        self.extents_size = 0
+        self.parent = parent
+        super().__init__(name, size, value=b'', offset=offset)
+
+    @property
+    def value(self) -> bytes:
+        """Field value, assembled from the extents.
+
+        This builds the whole content in memory, write_image should be used to dump it.
+        """
+        erased_value = self.parent.get_erased_value() if self.parent is not None else 0
+        file_desc = io.BytesIO()
+        writer = ImageWriter(file_desc, sparse=False, erased_value=erased_value)
+        self.write_image(writer)
+        writer.close()
+
+        return file_desc.getvalue()
+
+    @value.setter
+    def value(self, value: bytes):
+        self.extents = []
+        self.extents_size = 0
+        self.add_bytes(value)
+
+    def add_bytes(self, data: bytes):
+        """Append bytes to the array.
+
+        Parameters
+        ----------
+        data : bytes
+            The bytes.
+        """
+        if len(self.extents) != 0 and self.extents[-1][0] is not None:
+            # Contiguous bytes are merged so that they are written at once
+            self.extents[-1][0] += data
+            self.extents[-1][3] += len(data)
+        else:
+            self.extents.append([bytearray(data), None, 0, len(data)])
+
+        self.__extend(len(data))
+
+    def add_file(self, path: str, file_offset: int, size: int):
+        """Append a range of a host file to the array.
+
+        The file content is only read when the image is written.
+
+        Parameters
+        ----------
+        path : str
+            Path of the host file.
+        file_offset : int
+            Offset of the range in the host file.
+        size : int
+            Size of the range.
+        """
+        self.extents.append([None, path, file_offset, size])
+        self.__extend(size)
+
+    def add_uninitialized(self, size: int):
+        """Append an uninitialized region to the array.
+
+        Parameters
+        ----------
+        size : int
+            Size of the region.
+        """
+        if len(self.extents) != 0 and self.extents[-1][0] is None and \
+                self.extents[-1][1] is None:
+            self.extents[-1][3] += size
+        else:
+            self.extents.append([None, None, 0, size])
+
+        self.__extend(size)
+
+    def get_head(self, size: int) -> bytes:
+        # Only the extents with a content are shown, up to the first uninitialized one
+        result = b''
+        for data, path, file_offset, extent_size in self.extents:
+            if len(result) >= size:
+                break
+            if data is not None:
+                result += bytes(data[:size - len(result)])
+            elif path is not None:
+                try:
+                    with open(path, 'rb') as file_desc:
+                        file_desc.seek(file_offset)
+                        result += file_desc.read(min(extent_size, size - len(result)))
+                except OSError as exc:
+                    raise RuntimeError(f'Unable to read file {path}: {exc}') from exc
+            else:
+                break
+
+        return result
+
+    def is_streamed(self) -> bool:
+        return True
+
+    def write_image(self, writer: ImageWriter):
+        for data, path, file_offset, size in self.extents:
+            if data is not None:
+                writer.write(data)
+            elif path is not None:
+                writer.copy_file(path, file_offset, size)
+            else:
+                writer.write_uninitialized(size)
+
+        writer.write_uninitialized(self.size - self.extents_size)
+
+    def __extend(self, size: int):
+        self.extents_size += size
+        if self.extents_size > self.size:
+            raise RuntimeError(f'Content of field {self.name} is bigger than its size '
+                f'(0x{self.extents_size:x} > 0x{self.size:x})')
+
+
 class CStruct():
     """
     Class for gathering CStruct fields together into a common structure.
@@ -203,6 +639,12 @@ class CStruct():
 
     def __init__(self, name: str, parent: 'CStructParent'):
         self.fields = OrderedDict()
+        # Values of all fields, in field order, as they are given to struct for packing
+        self.values = []
+        # Array fields, which are the only ones which may need to be streamed
+        self.arrays = []
+        # Fields which store their value outside the list of values
+        self.has_external_values = False
         self.struct = None
         self.format = '<'
         self.__size = 0
@@ -233,7 +675,7 @@ class CStruct():
             return 0
 
         # Otherwise return the offset of the first field
-        return list(self.fields.values())[0].get_offset()
+        return next(iter(self.fields.values())).get_offset()
 
     def get_size(self) -> int:
         """Get sub-section size.
@@ -295,12 +737,8 @@ class CStruct():
         size = self.parent.align_offset(align)
 
         field = CStructArray(name, size, value=b'', offset=offset)
-        self.fields[name] = field
-
-        self.format += f'{size}s'
-        self.__size += size
 
-        return field
+        return self.__add_field(field, f'{size}s')
 
 
 
@@ -326,12 +764,8 @@ class CStruct():
 
 
         field = CStructScalar(name, size, value=0, offset=offset)
-        self.fields[name] = field
-
-        self.format += field_format
-        self.__size += size
 
-        return field
+        return self.__add_field(field, field_format)
 
 
     def add_field_array(self, name: str, size: int) -> CStructField:
@@ -354,12 +788,87 @@ class CStruct():
         offset = self.parent.alloc_offset(size)
 
         field = CStructArray(name, size, value=b'', offset=offset)
-        self.fields[name] = field
 
-        self.format += f'{size}s'
-        self.__size += size
+        return self.__add_field(field, f'{size}s')
 
-        return field
+    def add_field_file_array(self, name: str, size: int) -> CStructFileArray:
+        """Add an array field whose content can come from a host file.
+
+        The field is added to the structure. The fields are dumped in the order they are added.
+        The content can then be given with set_file so that the file is only read when the image
+        is written.
+
+        Parameters
+        ----------
+        name : str
+            Name of the field
+        size: int
+            Size of the array
+
+        Returns
+        -------
+        CStructFileArray
+            The field.
+        """
+        offset = self.parent.alloc_offset(size)
+
+        field = CStructFileArray(name, size, offset=offset)
+
+        return self.__add_field(field, f'{size}s')
+
+    def add_field_reserved(self, name: str, size: int,
+            pattern: bytes=None) -> CStructReservedArray:
+        """Add an array field reserving a region without any data.
+
+        The field is added to the structure. The fields are dumped in the order they are added.
+        The region is filled with the specified pattern or, if there is none, is left
+        uninitialized, so that it gets the erased value of the flash.
+
+        Parameters
+        ----------
+        name : str
+            Name of the field
+        size: int
+            Size of the array
+        pattern: bytes
+            Pattern filling the region, or None for an uninitialized region.
+
+        Returns
+        -------
+        CStructReservedArray
+            The field.
+        """
+        offset = self.parent.alloc_offset(size)
+
+        field = CStructReservedArray(name, size, offset=offset, pattern=pattern,
+            parent=self.parent)
+
+        return self.__add_field(field, f'{size}s')
+
+    def add_field_extent_array(self, name: str, size: int) -> CStructExtentArray:
+        """Add an array field whose content is given as a sequence of extents.
+
+        The field is added to the structure. The fields are dumped in the order they are added.
+        The content is then appended with add_bytes, add_file and add_uninitialized, and is only
+        assembled when the image is written.
+
+        Parameters
+        ----------
+        name : str
+            Name of the field
+        size: int
+            Size of the array
+
+        Returns
+        -------
+        CStructExtentArray
+            The field.
+        """
+        offset = self.parent.alloc_offset(size)
+
+        field = CStructExtentArray(name, size, offset=offset, parent=self.parent)
+
+        return self.__add_field(field, f'{size}s')
 
     def dump_table(self, level: int) -> str:
         """Dump the structure to a table.
@@ -376,6 +885,8 @@ class CStruct():
         str
             The table.
         """
+        from prettytable import PrettyTable # pylint: disable=import-outside-toplevel
+
         table = PrettyTable()
         table.field_names = ["Offset", "Name", "Size", "Value"]
         for field in self.fields.values():
@@ -395,14 +906,77 @@ class CStruct():
         bytes
             The values of the fields packed into a byte array.
         """
-        if self.struct is None:
-            self.struct = struct.Struct(self.format)
+        return self.__get_struct().pack(*self.__get_values())
+
+    def pack_into(self, buffer: bytearray, offset: int):
+        """Pack all fields in binary form into a buffer.
+
+        This can be used to dump several structures into a buffer allocated once.
+
+        Parameters
+        ----------
+        buffer : bytearray
+            The buffer where the fields are packed.
+        offset : int
+            Offset in the buffer where the structure starts.
+        """
+        self.__get_struct().pack_into(buffer, offset, *self.__get_values())
+
+    def is_streamed(self) -> bool:
+        """Tell if the structure should be streamed field by field instead of being packed.
+
+        This is the case when some arrays are only partially set, like big reserved areas, or
+        come from host files, so that their content is never built in memory.
+
+        Returns
+        -------
+        bool
+            True if the structure should be streamed.
+        """
+        for field in self.arrays:
+            if field.is_streamed():
+                return True
+        return False
+
+    def write_image(self, writer: ImageWriter):
+        """Stream all fields in binary form to the specified writer.
+
+        Parameters
+        ----------
+        writer : ImageWriter
+            The writer where the structure is dumped.
+        """
+        if not self.is_streamed():
+            writer.write(self.pack())
+            return
 
-        values = []
         for field in self.fields.values():
-            values.append(field.value)
+            field.write_image(writer)
+
+    def __add_field(self, field: CStructField, field_format: str) -> CStructField:
+        self.fields[field.name] = field
+        field.attach(self.values)
+        if isinstance(field, CStructArray):
+            self.arrays.append(field)
+        if isinstance(field, (CStructFileArray, CStructReservedArray, CStructExtentArray)):
+            self.has_external_values = True
+
+        self.format += field_format
+        self.__size += field.size
+        self.struct = None
+
+        return field
 
-        return self.struct.pack(*values)
+    def __get_struct(self) -> struct.Struct:
+        # The format is compiled only once, the layout can not change after the fields are added
+        if self.struct is None:
+            self.struct = struct.Struct(self.format)
+        return self.struct
+
+    def __get_values(self) -> list:
+        if self.has_external_values:
+            return [field.value for field in self.fields.values()]
+        return self.values
 
 
 class CStructParent():
@@ -455,6 +1029,20 @@ class CStructParent():
         return self.parent.get_current_offset()
 
 
+    def get_erased_value(self) -> int:
+        """Get the value of the bytes of an erased flash.
+
+        Returns
+        -------
+        int
+            The byte value, 0 if the sub-section is not in a flash.
+        """
+        if self.parent is None:
+            return 0
+
+        return self.parent.get_flash().get_erased_value()
+
+
     def alloc_offset(self, size: int) -> int:
         """Allocate an offset.
 
@@ -500,6 +1088,8 @@ class CStructParent():
         str
             The table.
         """
+        from prettytable import PrettyTable # pylint: disable=import-outside-toplevel
+
         table = PrettyTable()
         names = ["Offset", "Size", "Name"]
         if level > 0:
@@ -538,8 +1128,51 @@ class CStructParent():
         bytes
             The values of the fields packed into a byte array.
         """
-        result = bytearray()
+        file_desc = io.BytesIO()
+        writer = ImageWriter(file_desc, sparse=False, erased_value=self.get_erased_value())
+        self.write_image(writer)
+        writer.close()
+
+        return file_desc.getvalue()
+
+
+    def write_image(self, writer: ImageWriter):
+        """Stream all structures in binary form to the specified writer.
+
+        Consecutive structures which can be packed are packed into a single buffer, allocated
+        once, at their offset in this buffer. Other ones are streamed.
+
+        Parameters
+        ----------
+        writer : ImageWriter
+            The writer where the sub-section is dumped.
+        """
+        packed_structs = []
         for cstruct in self.structs:
-            result += cstruct.pack()
+            if isinstance(cstruct, CStruct) and not cstruct.is_streamed():
+                packed_structs.append(cstruct)
+            else:
+                self.__write_packed(writer, packed_structs)
+                packed_structs = []
+                cstruct.write_image(writer)
 
-        return result
+        self.__write_packed(writer, packed_structs)
+
+
+    @staticmethod
+    def __write_packed(writer: ImageWriter, cstructs: list):
+        if len(cstructs) == 0:
+            return
+
+        offsets = []
+        size = 0
+        for cstruct in cstructs:
+            offsets.append(size)
+            size += cstruct.get_size()
+
+        with gapylib.trace.span('cstruct pack', structs=len(cstructs), bytes=size):
+            buffer = bytearray(size)
+            for cstruct, offset in zip(cstructs, offsets):
+                cstruct.pack_into(buffer, offset)
+
+        writer.write(buffer)